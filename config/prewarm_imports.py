@@ -0,0 +1,26 @@
+# IPython startup file, installed into the default profile by the
+# Dockerfile.
+#
+# Importing pandas, numpy and ebmdatalab takes several seconds in a
+# fresh kernel.  We start those imports in a background thread as soon
+# as the kernel starts, so that by the time the first cell of a notebook
+# runs they are already in `sys.modules` (or nearly so; Python's import
+# locks make the notebook's own import wait for ours to finish rather
+# than start again).  Nothing is added to the notebook's namespace.
+
+import threading
+
+
+def _prewarm():
+    try:
+        import numpy  # noqa: F401
+        import pandas  # noqa: F401
+        import matplotlib.pyplot  # noqa: F401
+        from ebmdatalab import bq, charts, maps  # noqa: F401
+    except Exception:
+        # the notebook will report any real import problem itself
+        pass
+
+
+threading.Thread(target=_prewarm, name="prewarm-imports", daemon=True).start()
+del threading, _prewarm
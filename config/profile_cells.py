@@ -0,0 +1,19 @@
+# IPython startup file, installed into the default profile by the
+# Dockerfile.
+#
+# When the NOTEBOOK_PROFILE environment variable is set (e.g. by
+# `run_notebook_tests.py --profile`, or `docker run --env
+# NOTEBOOK_PROFILE=1 ...`), time every cell and write a report next to
+# the notebook's jupytext output; see lib/cell_profiler.py.
+
+import os
+
+if os.environ.get("NOTEBOOK_PROFILE", "") not in ("", "0"):
+    try:
+        get_ipython().extension_manager.load_extension("lib.cell_profiler")
+    except Exception as e:
+        import sys
+
+        print(f"Cell profiling not started: {e}", file=sys.stderr)
+        del sys
+del os
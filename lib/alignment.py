@@ -0,0 +1,214 @@
+"""Aligned comparison of two result sets, without an outer merge.
+
+Comparing the old and new methodologies has meant
+
+    merged = df_dmd.merge(df_measure, indicator=True, how="outer")
+    merged["difference"] = ...
+
+or `pd.concat([old, new]).drop_duplicates(keep=False)`, each of which
+copies every column of both inputs (several times, once derived columns
+are added) just to line rows up.  Here the rows are lined up once: the
+key columns of both sides are factorized into one sorted union of keys,
+and each side is reduced to an array giving its row for each union key
+(-1 where absent).  Values are then gathered straight from the inputs'
+own arrays when asked for, and derived columns computed into a single
+buffer each:
+
+    aligned = align(df_dmd, df_measure, on=["bnf_code", "bnf_name"])
+    aligned.frame(
+        ome_dose=aligned.left("ome_dose"),
+        total_ome=aligned.right("total_ome"),
+        difference=aligned.difference("ome_dose", "total_ome", decimals=0),
+        difference_ratio=aligned.ratio("ome_dose", "total_ome", decimals=3),
+        _merge=aligned.status(),
+    )
+
+Keys must be unique within each side.
+
+"""
+import numpy as np
+import pandas as pd
+
+STATUSES = ["left_only", "right_only", "both"]
+
+
+def _union(left_keys, right_keys):
+    """Return (codes of each key column for each union key, uniques of
+    each key column, union position of each left row, of each right row)
+    """
+    n_left = len(left_keys)
+    column_codes, column_uniques = [], []
+    combined = np.zeros(n_left + len(right_keys), dtype=np.int64)
+    for column in left_keys.columns:
+        values = pd.concat(
+            [left_keys[column], right_keys[column]], ignore_index=True
+        ).to_numpy()
+        codes, uniques = pd.factorize(values, sort=True)
+        column_codes.append(codes)
+        column_uniques.append(uniques)
+        # missing keys (-1) sort last, as in a merge; combined codes are
+        # kept dense after each column, so they can't overflow
+        radix = len(uniques) + 1
+        combined = combined * radix + np.where(codes < 0, radix - 1, codes)
+        _, combined = np.unique(combined, return_inverse=True)
+    _, first, positions = np.unique(combined, return_index=True, return_inverse=True)
+    key_codes = [codes[first] for codes in column_codes]
+    return key_codes, column_uniques, positions[:n_left], positions[n_left:]
+
+
+def _keys_frame(on, key_codes, key_uniques):
+    return pd.DataFrame(
+        {
+            # -1 (a missing key) isn't a label, so reindexes to NaN
+            column: pd.Series(uniques).reindex(codes).to_numpy()
+            for column, codes, uniques in zip(on, key_codes, key_uniques)
+        }
+    )
+
+
+def _rows(positions, n, side):
+    counts = np.bincount(positions, minlength=n)
+    if (counts > 1).any():
+        raise ValueError(f"Keys are not unique in the {side} result set")
+    rows = np.full(n, -1, dtype=np.int64)
+    rows[positions] = np.arange(len(positions))
+    return rows
+
+
+class Alignment:
+    """Two result sets lined up on the union of their keys
+    """
+
+    def __init__(self, left, right, on):
+        self.on = list(on)
+        self._left = left
+        self._right = right
+        key_codes, uniques, left_positions, right_positions = _union(
+            left[self.on], right[self.on]
+        )
+        self._key_codes = key_codes
+        self._key_uniques = uniques
+        self.n = len(key_codes[0]) if key_codes else 0
+        self.left_rows = _rows(left_positions, self.n, "left")
+        self.right_rows = _rows(right_positions, self.n, "right")
+        self.left_present = self.left_rows >= 0
+        self.right_present = self.right_rows >= 0
+
+    def __len__(self):
+        return self.n
+
+    def keys(self):
+        """Return a dataframe of the union of keys, in sorted order
+        """
+        return _keys_frame(self.on, self._key_codes, self._key_uniques)
+
+    def _gather(self, df, column, rows, present, out=None):
+        values = df[column].to_numpy(dtype="float64")
+        if (
+            len(values) == self.n
+            and present.all()
+            and (rows == np.arange(self.n)).all()
+        ):
+            # already in key order: no need to gather
+            if out is None:
+                return values
+            out[:] = values
+            return out
+        out = np.take(values, np.maximum(rows, 0), out=out)
+        out[~present] = np.nan
+        return out
+
+    def left(self, column, out=None):
+        """Return `column` of the left result set aligned with the union of
+        keys, with NaN where a key is only on the right
+        """
+        return self._gather(self._left, column, self.left_rows, self.left_present, out)
+
+    def right(self, column, out=None):
+        """Return `column` of the right result set aligned with the union of
+        keys, with NaN where a key is only on the left
+        """
+        return self._gather(
+            self._right, column, self.right_rows, self.right_present, out
+        )
+
+    def status(self):
+        """Return whether each key is in the left, right or both result sets
+        (as the `_merge` column of an outer merge)
+        """
+        codes = self.left_present.astype(np.int8) + 2 * self.right_present - 1
+        return pd.Categorical.from_codes(codes, categories=STATUSES)
+
+    def only(self):
+        """Return a mask of the keys in just one of the result sets
+        """
+        return self.left_present != self.right_present
+
+    def _operands(self, left_column, right_column, decimals):
+        out = np.empty(self.n)
+        self.right(right_column, out=out)
+        left = self.left(left_column)
+        if decimals is not None:
+            np.round(out, decimals, out=out)
+            left = np.round(left, decimals)
+        return left, out
+
+    def difference(self, left_column, right_column, decimals=None):
+        """Return left `left_column` minus right `right_column` for each key,
+        optionally rounding each to `decimals` first
+        """
+        left, out = self._operands(left_column, right_column, decimals)
+        return np.subtract(left, out, out=out)
+
+    def ratio(self, left_column, right_column, decimals=None):
+        """Return left `left_column` divided by right `right_column` for
+        each key, rounded to `decimals`
+        """
+        left, out = self._operands(left_column, right_column, None)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(left, out, out=out)
+        if decimals is not None:
+            np.round(out, decimals, out=out)
+        return out
+
+    def frame(self, mask=None, **columns):
+        """Return a dataframe of the keys and `columns` (arrays aligned with
+        the keys), optionally for just the keys in `mask`
+        """
+        df = self.keys().assign(**columns)
+        if mask is not None:
+            df = df[mask].reset_index(drop=True)
+        return df
+
+
+def align(left, right, on=None):
+    """Return the `Alignment` of two dataframes on the `on` columns
+    (default: the columns they have in common, as in a merge)
+    """
+    if on is None:
+        on = [column for column in left.columns if column in right.columns]
+    return Alignment(left, right, on)
+
+
+def symmetric_difference(left, right, on=None, indicator=False):
+    """Return the keys (by default every common column, so whole rows)
+    which occur exactly once in `left` and `right` together
+
+    This is `pd.concat([left, right]).drop_duplicates(keep=False)`, in
+    sorted key order, so keys needn't be unique.  With `indicator`, a `_merge` column says
+    which side each key is on, as in an outer merge.
+
+    """
+    if on is None:
+        on = [column for column in left.columns if column in right.columns]
+    key_codes, uniques, left_positions, right_positions = _union(left[on], right[on])
+    n = len(key_codes[0]) if key_codes else 0
+    left_counts = np.bincount(left_positions, minlength=n)
+    right_counts = np.bincount(right_positions, minlength=n)
+    once = (left_counts + right_counts) == 1
+    keys = _keys_frame(on, key_codes, uniques)
+    if indicator:
+        keys["_merge"] = pd.Categorical.from_codes(
+            np.where(left_counts == 1, 0, 1), categories=STATUSES
+        )
+    return keys[once].reset_index(drop=True)
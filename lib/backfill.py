@@ -0,0 +1,314 @@
+"""Sharded backfill of the opioid measure history.
+
+Rebuilding every month of the measure (e.g. after a change to the OME
+table) is split into month x region shards, which are handed out to
+workers through a coordinator directory:
+
+    <root>/pending/<shard>.json   waiting to be run
+    <root>/claimed/<shard>.json   being run by a worker
+    <root>/done/<shard>.json      finished
+    <root>/results/<shard>.csv    output of the shard
+
+Workers claim a shard by renaming its file from `pending/` to
+`claimed/`, which succeeds for exactly one of them, so any number of
+worker processes can share the directory.  Putting the root on storage
+shared between machines lets workers on each machine join in with
+
+    python -m lib.backfill worker <root> <module>:<function>
+
+while `run_local` runs the whole thing with worker processes on a single
+host.  Each shard writes exactly one results file (atomically), so
+re-running a shard replaces its output rather than duplicating it, and
+`merge_results` can be called at any point.
+
+While a worker runs a shard, it touches the shard's claim file every
+`heartbeat` seconds, so `requeue_stale` can tell a shard whose worker
+has died (its claim stops being touched) from one that is just slow.
+Its `max_age` should be several heartbeats.
+
+The compute function takes a `Shard` and returns a dataframe.  It must
+be importable (i.e. defined at module level) so worker processes can
+run it.
+
+"""
+import collections
+import glob
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import pandas as pd
+
+Shard = collections.namedtuple("Shard", ["month", "region"])
+
+STATES = ("pending", "claimed", "done", "results")
+
+DEFAULT_HEARTBEAT = 60
+
+
+def _escape(value):
+    # percent-encode everything but letters, digits and "-.~", so values
+    # can't contain path separators or the "_" between them
+    return urllib.parse.quote(value, safe="").replace("_", "%5F")
+
+
+def shard_id(shard):
+    """Return a name for `shard` which is safe to use as a file name
+    """
+    return f"{_escape(shard.month)}_{_escape(shard.region)}"
+
+
+def make_shards(months, regions):
+    """Return a shard for every combination of month and region
+    """
+    return [Shard(str(month), str(region)) for month in months for region in regions]
+
+
+class FileCoordinator:
+    """Hands out shards to workers through a (possibly shared) directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        for state in STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state, shard, ext="json"):
+        return os.path.join(self.root, state, f"{shard_id(shard)}.{ext}")
+
+    def submit(self, shards, rerun=False):
+        """Queue `shards` to be run, skipping those already queued, running
+        or finished unless `rerun` is set
+        """
+        queued = 0
+        for shard in shards:
+            if not rerun and any(
+                os.path.exists(self._path(state, shard))
+                for state in ("pending", "claimed", "done")
+            ):
+                continue
+            _atomic_write(self._path("pending", shard), json.dumps(shard._asdict()))
+            queued += 1
+        return queued
+
+    def claim(self, worker_id):
+        """Return the next pending shard, now claimed by `worker_id`, or
+        None if there are none left
+        """
+        for path in sorted(glob.glob(os.path.join(self.root, "pending", "*.json"))):
+            target = os.path.join(self.root, "claimed", os.path.basename(path))
+            try:
+                os.rename(path, target)
+            except FileNotFoundError:
+                # another worker got there first
+                continue
+            with open(target) as f:
+                fields = json.load(f)
+            # the file of a shard that was claimed before (and released or
+            # requeued) also records the worker that claimed it
+            shard = Shard(**{name: fields[name] for name in Shard._fields})
+            _atomic_write(target, json.dumps(dict(shard._asdict(), worker=worker_id)))
+            return shard
+        return None
+
+    def complete(self, shard, result):
+        """Store the result of `shard` and mark it as done
+        """
+        _atomic_write(self._path("results", shard, "csv"), result.to_csv(index=False))
+        _atomic_write(self._path("done", shard), json.dumps(shard._asdict()))
+        # the claim may have been requeued as stale while we were running
+        for state in ("claimed", "pending"):
+            try:
+                os.remove(self._path(state, shard))
+            except FileNotFoundError:
+                pass
+
+    def release(self, shard):
+        """Return a claimed shard to the queue, e.g. after a failure
+        """
+        os.replace(self._path("claimed", shard), self._path("pending", shard))
+
+    def heartbeat(self, shard):
+        """Mark the claim on `shard` as still being worked on
+        """
+        try:
+            os.utime(self._path("claimed", shard))
+        except FileNotFoundError:
+            # requeued as stale, or already complete
+            pass
+
+    def requeue_stale(self, max_age):
+        """Return shards whose claim hasn't been touched (by `heartbeat`)
+        for more than `max_age` seconds to the queue, in case the worker
+        running them has died
+        """
+        now = time.time()
+        requeued = 0
+        for path in glob.glob(os.path.join(self.root, "claimed", "*.json")):
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    target = os.path.join(self.root, "pending", os.path.basename(path))
+                    os.rename(path, target)
+                    requeued += 1
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def status(self):
+        """Return the number of shards in each state
+        """
+        return {
+            state: len(glob.glob(os.path.join(self.root, state, "*.json")))
+            for state in STATES[:-1]
+        }
+
+    def merge_results(self):
+        """Return the combined results of all finished shards
+        """
+        paths = sorted(glob.glob(os.path.join(self.root, "results", "*.csv")))
+        frames = [
+            pd.read_csv(path, dtype={"month": str, "region": str}) for path in paths
+        ]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+
+class _Heartbeat:
+    """Context manager calling `coordinator.heartbeat(shard)` every
+    `interval` seconds in a background thread
+    """
+
+    def __init__(self, coordinator, shard, interval):
+        self.coordinator = coordinator
+        self.shard = shard
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.coordinator.heartbeat(self.shard)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+def run_worker(
+    root, compute, worker_id=None, max_failures=3, heartbeat=DEFAULT_HEARTBEAT
+):
+    """Claim and run shards from the coordinator at `root` until none are
+    left, returning the number run
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    coordinator = FileCoordinator(root)
+    failures = collections.Counter()
+    completed = 0
+    while True:
+        shard = coordinator.claim(worker_id)
+        if shard is None:
+            return completed
+        try:
+            with _Heartbeat(coordinator, shard, heartbeat):
+                result = compute(shard)
+        except Exception:
+            failures[shard] += 1
+            if failures[shard] >= max_failures:
+                # leave it claimed, so it shows up in `status` for a human
+                raise
+            coordinator.release(shard)
+            continue
+        coordinator.complete(shard, result)
+        completed += 1
+
+
+def run_local(shards, compute, root, processes=None, rerun=False):
+    """Run `shards` with `processes` worker processes on this host and
+    return the merged results
+    """
+    coordinator = FileCoordinator(root)
+    coordinator.submit(shards, rerun=rerun)
+    processes = processes or multiprocessing.cpu_count()
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(root, compute))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [w.exitcode for w in workers if w.exitcode != 0]
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} backfill worker(s) failed; see {coordinator.status()}"
+        )
+    return coordinator.merge_results()
+
+
+def bigquery_shard(shard, sql):
+    """Compute a shard by running `sql`, with `{month}` and `{region}`
+    placeholders, in BigQuery
+
+    Use with `functools.partial` to fix the SQL, e.g.
+    `partial(bigquery_shard, sql=OME_SQL)`.
+
+    """
+    from ebmdatalab import bq
+
+    with tempfile.TemporaryDirectory() as tmp:
+        df = bq.cached_read(
+            sql.format(month=shard.month, region=shard.region),
+            csv_path=os.path.join(tmp, f"{shard_id(shard)}.csv"),
+            use_cache=False,
+        )
+    df.insert(0, "month", shard.month)
+    df.insert(1, "region", shard.region)
+    return df
+
+
+def _atomic_write(path, text):
+    """Write `text` to `path` so readers never see a partial file
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _load_function(spec):
+    module_name, _, function_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def main(argv):
+    usage = (
+        "usage: python -m lib.backfill worker <root> <module>:<function>\n"
+        "       python -m lib.backfill status <root>"
+    )
+    if len(argv) == 3 and argv[0] == "worker":
+        completed = run_worker(argv[1], _load_function(argv[2]))
+        print(f"Completed {completed} shards")
+    elif len(argv) == 2 and argv[0] == "status":
+        print(FileCoordinator(argv[1]).status())
+    else:
+        print(usage)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
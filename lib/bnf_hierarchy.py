@@ -0,0 +1,156 @@
+"""Rollups of prescribing quantity and OME over the BNF code hierarchy.
+
+BNF presentation codes are hierarchical by prefix (e.g. `0407020A0AAAHAH`
+sits under chemical `0407020A0`, sub-paragraph `0407020`, section
+`0407` and chapter `04`), so once the codes are sorted every prefix
+covers a contiguous range of rows.  We keep the sorted codes alongside
+cumulative sums of each value column, which means the total for any
+prefix is the difference of two cumulative sums, and each level of the
+hierarchy can be rolled up with a single vectorised pass rather than a
+string slice and groupby over the full frame.
+
+"""
+import numpy as np
+import pandas as pd
+
+from lib.exact_sum import from_fixed, to_fixed
+
+# (name, prefix length) for each level of the BNF hierarchy
+LEVELS = (
+    ("chapter", 2),
+    ("section", 4),
+    ("paragraph", 6),
+    ("subparagraph", 7),
+    ("chemical", 9),
+    ("product", 11),
+    ("presentation", 15),
+)
+LEVEL_LENGTHS = dict(LEVELS)
+
+# BNF codes only contain digits and upper case letters, so appending this
+# to a prefix gives an upper bound for every code starting with it
+_UPPER_BOUND = "\x7f"
+
+
+def level_length(level):
+    """Return the prefix length for `level`, which may be a level name or
+    a length
+    """
+    if isinstance(level, str):
+        try:
+            return LEVEL_LENGTHS[level]
+        except KeyError:
+            raise ValueError(
+                f"Unknown BNF level {level!r}; expected one of {list(LEVEL_LENGTHS)}"
+            )
+    return int(level)
+
+
+class BNFHierarchy:
+    """Prefix index over the BNF codes in a prescribing or OME dataframe
+
+    `values` are the numeric columns to be totalled, e.g. `quantity` and
+    `ome_dose`.  Rows sharing a BNF code are collapsed when the index is
+    built, and missing values count as zero.  With `exact` set, the
+    cumulative sums are held in fixed point (see `lib.exact_sum`), so
+    every total is exact and independent of row order.
+
+    """
+
+    def __init__(
+        self, df, values=("quantity", "ome_dose"), code_col="bnf_code", exact=False
+    ):
+        self.values = list(values)
+        self.exact = exact
+        codes = df[code_col].to_numpy().astype(str)
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        # missing values count as zero, as in a pandas sum, rather than
+        # making every later cumulative sum NaN
+        data = np.nan_to_num(df[self.values].to_numpy(dtype="float64")[order])
+        if exact:
+            data = to_fixed(data)
+
+        # collapse duplicate codes so each presentation appears once
+        starts = _run_starts(codes)
+        self.codes = codes[starts]
+        if len(data):
+            data = np.add.reduceat(data, starts, axis=0)
+        self._cumsum = np.zeros((len(self.codes) + 1, len(self.values)), data.dtype)
+        np.cumsum(data, axis=0, out=self._cumsum[1:])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def bounds(self, prefixes):
+        """Return arrays of (start, stop) row positions covering each prefix
+        """
+        prefixes = np.asarray(prefixes, dtype=str)
+        lo = np.searchsorted(self.codes, prefixes, side="left")
+        hi = np.searchsorted(self.codes, np.char.add(prefixes, _UPPER_BOUND))
+        return lo, hi
+
+    def totals(self, prefixes):
+        """Return a dataframe of the summed values for each prefix
+        """
+        prefixes = np.atleast_1d(np.asarray(prefixes, dtype=str))
+        lo, hi = self.bounds(prefixes)
+        return self._frame(prefixes, self._cumsum[hi] - self._cumsum[lo])
+
+    def total(self, prefix):
+        """Return a series of the summed values for a single prefix
+        """
+        return self.totals([prefix]).iloc[0]
+
+    def rollup(self, level, prefix=""):
+        """Return totals for every code at `level`, optionally restricted
+        to codes under `prefix`
+
+        For example, `rollup("chemical", "0407020")` gives the OME for
+        every chemical in sub-paragraph 0407020.
+
+        """
+        length = level_length(level)
+        if len(prefix) > length:
+            raise ValueError(f"Prefix {prefix!r} is below the {level} level")
+        lo, hi = self.bounds([prefix])
+        lo, hi = lo[0], hi[0]
+        truncated = self.codes[lo:hi].astype(f"<U{length}")
+        starts = _run_starts(truncated)
+        stops = np.append(starts[1:], len(truncated))
+        sums = self._cumsum[lo + stops] - self._cumsum[lo + starts]
+        return self._frame(truncated[starts], sums)
+
+    def children(self, prefix, level):
+        """Alias of `rollup` with the arguments in query order
+        """
+        return self.rollup(level, prefix=prefix)
+
+    def rollup_all(self, levels=None):
+        """Return totals for every level of the hierarchy in one frame,
+        with a `level` column naming the level of each row
+        """
+        if levels is None:
+            levels = [name for name, _ in LEVELS]
+        frames = []
+        for level in levels:
+            frame = self.rollup(level)
+            frame.insert(0, "level", level)
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+
+    def _frame(self, prefixes, sums):
+        if self.exact:
+            sums = from_fixed(sums)
+        frame = pd.DataFrame(sums, columns=self.values)
+        frame.insert(0, "bnf_code", prefixes)
+        return frame
+
+
+def _run_starts(sorted_codes):
+    """Return the positions at which a new value starts in a sorted array
+    """
+    if len(sorted_codes) == 0:
+        return np.zeros(0, dtype=np.intp)
+    changed = sorted_codes[1:] != sorted_codes[:-1]
+    return np.concatenate([[0], np.flatnonzero(changed) + 1])
@@ -0,0 +1,256 @@
+"""Per-cell profiling of notebooks.
+
+When the `NOTEBOOK_PROFILE` environment variable is set, the IPython
+startup file installed by the Dockerfile (`config/profile_cells.py`)
+loads this module as an extension, and for every cell it records:
+
+* wall time and CPU time;
+* the growth in the kernel's peak resident memory (cheap, but only
+  shows cells which take the kernel to a new high) or, if
+  `NOTEBOOK_PROFILE_MEMORY` is set, the peak memory allocated while the
+  cell ran, above what was already allocated when it started, from
+  `tracemalloc` (exact, but slows allocation-heavy code);
+* for cells taking longer than `NOTEBOOK_PROFILE_THRESHOLD` seconds
+  (default 1), the functions taking the most time, from `cProfile`, and
+  with `NOTEBOOK_PROFILE_MEMORY`, the lines allocating the most memory.
+
+Most of the time in these notebooks is spent inside pandas and numpy,
+where `cProfile` adds little overhead, so this is cheap enough to leave on
+in CI (see `run_notebook_tests.py --profile`).
+
+The report is rewritten after every cell, next to the notebook's
+jupytext output, as `diffable_python/<notebook>.profile.md`, with the
+raw `cProfile` output for slow cells in `diffable_python/<notebook>.prof/`
+(for `snakeviz` or `pstats`).  The notebook name comes from
+`NOTEBOOK_PROFILE_NAME` (set by `run_notebook_tests.py`), falling back
+to the kernel's process id.
+
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ENV_VAR = "NOTEBOOK_PROFILE"
+NAME_ENV_VAR = "NOTEBOOK_PROFILE_NAME"
+THRESHOLD_ENV_VAR = "NOTEBOOK_PROFILE_THRESHOLD"
+MEMORY_ENV_VAR = "NOTEBOOK_PROFILE_MEMORY"
+FUNCTIONS_ENV_VAR = "NOTEBOOK_PROFILE_FUNCTIONS"
+
+REPORT_SUFFIX = ".profile.md"
+DEFAULT_THRESHOLD = 1.0
+TOP_FUNCTIONS = 15
+TOP_ALLOCATIONS = 10
+
+# the profiler for this kernel, if profiling is on
+_profiler = None
+
+
+def enabled():
+    return os.environ.get(ENV_VAR, "") not in ("", "0")
+
+
+def _max_rss():
+    """Return the peak resident memory of this process in bytes, or None
+    """
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _format_bytes(n):
+    if n is None:
+        return ""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def _first_line(source):
+    for line in source.splitlines():
+        if line.strip():
+            return line.strip().replace("|", "\\|")[:60]
+    return ""
+
+
+class CellProfiler:
+    """Collects timings for each cell run, and writes them as a report
+    """
+
+    def __init__(
+        self, report_path, threshold=DEFAULT_THRESHOLD, memory=False, functions=True
+    ):
+        self.report_path = report_path
+        if report_path.endswith(REPORT_SUFFIX):
+            self.stats_dir = report_path[: -len(REPORT_SUFFIX)] + ".prof"
+        else:
+            self.stats_dir = os.path.splitext(report_path)[0] + ".prof"
+        self.threshold = threshold
+        self.memory = memory
+        self.functions = functions
+        self.cells = []
+        self._current = None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def pre_run_cell(self, info=None):
+        source = getattr(info, "raw_cell", "") or ""
+        traced = None
+        if self.memory:
+            _reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+        profile = None
+        if self.functions:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler (e.g. %prun) is active
+                profile = None
+        self._current = {
+            "source": source,
+            "profile": profile,
+            "rss": _max_rss(),
+            "traced": traced,
+            "wall": time.perf_counter(),
+            "cpu": time.process_time(),
+        }
+
+    def post_run_cell(self, result=None):
+        if self._current is None:
+            return
+        wall = time.perf_counter() - self._current["wall"]
+        cpu = time.process_time() - self._current["cpu"]
+        profile = self._current["profile"]
+        if profile is not None:
+            profile.disable()
+        rss = _max_rss()
+        cell = {
+            "number": getattr(result, "execution_count", None) or len(self.cells) + 1,
+            "first_line": _first_line(self._current["source"]),
+            "wall": wall,
+            "cpu": cpu,
+            "rss_growth": None if rss is None else rss - self._current["rss"],
+            "peak": (
+                tracemalloc.get_traced_memory()[1] - self._current["traced"]
+                if self.memory
+                else None
+            ),
+            "functions": None,
+            "allocations": None,
+        }
+        if wall >= self.threshold:
+            if profile is not None:
+                cell["functions"] = self._top_functions(profile, cell["number"])
+            if self.memory:
+                cell["allocations"] = _top_allocations()
+        self.cells.append(cell)
+        self._current = None
+        self.write_report()
+
+    def _top_functions(self, profile, number):
+        os.makedirs(self.stats_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(self.stats_dir, f"cell-{number}.prof"))
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out).strip_dirs()
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        return out.getvalue()
+
+    def report(self):
+        """Return the report as markdown
+        """
+        lines = [
+            "# Cell profile",
+            "",
+            "| Cell | First line | Wall (s) | CPU (s) | Peak RSS growth | Peak allocated |",
+            "| ---: | --- | ---: | ---: | ---: | ---: |",
+        ]
+        for cell in self.cells:
+            lines.append(
+                f"| {cell['number']} | `{cell['first_line']}` "
+                f"| {cell['wall']:.3f} | {cell['cpu']:.3f} "
+                f"| {_format_bytes(cell['rss_growth'])} "
+                f"| {_format_bytes(cell['peak'])} |"
+            )
+        total_wall = sum(cell["wall"] for cell in self.cells)
+        total_cpu = sum(cell["cpu"] for cell in self.cells)
+        lines += ["", f"Total: {total_wall:.3f}s wall, {total_cpu:.3f}s CPU", ""]
+
+        for cell in self.cells:
+            if cell["functions"] or cell["allocations"]:
+                lines += [f"## Cell {cell['number']}: `{cell['first_line']}`", ""]
+                for text in (cell["functions"], cell["allocations"]):
+                    if text:
+                        lines += ["```", text.strip("\n"), "```", ""]
+        return "\n".join(lines)
+
+    def write_report(self):
+        os.makedirs(os.path.dirname(self.report_path) or ".", exist_ok=True)
+        tmp_path = f"{self.report_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.report())
+        os.replace(tmp_path, self.report_path)
+
+
+def _reset_peak():
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        # Python < 3.9: clearing the traces also resets the peak
+        tracemalloc.clear_traces()
+
+
+def _top_allocations():
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    lines = ["Largest allocations still held, by line:"]
+    for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        lines.append(f"{_format_bytes(stat.size):>10}  {frame.filename}:{frame.lineno}")
+    return "\n".join(lines)
+
+
+def default_report_path(directory=None, name=None):
+    """Return the report path for the notebook `name` (default: from the
+    environment) run from `directory` (default: the working directory,
+    which is the notebook's own directory for both Jupyter and nbval)
+    """
+    directory = directory or os.getcwd()
+    name = name or os.environ.get(NAME_ENV_VAR) or f"kernel-{os.getpid()}"
+    return os.path.join(directory, "diffable_python", f"{name}{REPORT_SUFFIX}")
+
+
+def load_ipython_extension(ipython):
+    """Start profiling every cell run in `ipython`, configured from the
+    environment
+    """
+    global _profiler
+    if _profiler is not None:
+        return
+    _profiler = CellProfiler(
+        default_report_path(),
+        threshold=float(os.environ.get(THRESHOLD_ENV_VAR, DEFAULT_THRESHOLD)),
+        memory=os.environ.get(MEMORY_ENV_VAR, "") not in ("", "0"),
+        functions=os.environ.get(FUNCTIONS_ENV_VAR, "1") != "0",
+    )
+    ipython.events.register("pre_run_cell", _profiler.pre_run_cell)
+    ipython.events.register("post_run_cell", _profiler.post_run_cell)
+
+
+def unload_ipython_extension(ipython):
+    global _profiler
+    if _profiler is None:
+        return
+    ipython.events.unregister("pre_run_cell", _profiler.pre_run_cell)
+    ipython.events.unregister("post_run_cell", _profiler.post_run_cell)
+    _profiler = None
@@ -0,0 +1,202 @@
+"""Memory-mapped columnar tables stored as plain numpy files.
+
+A table is a directory holding one `.npy` file per column and a
+`_meta.json` describing them:
+
+    <table>/_meta.json
+    <table>/quantity.npy
+    <table>/bnf_code.codes.npy     int32 codes into the dictionary
+    <table>/bnf_code.values.npy    sorted, fixed-width dictionary
+
+String (and other non-numeric) columns are dictionary encoded, with the
+dictionary sorted so that comparing codes gives the same order as
+comparing values.  Opening a table memory-maps its files, so it costs
+next to nothing, several processes reading the same table share one
+copy in the page cache, and only the pages a query touches are read.
+
+A dataset is a directory of tables, one per part (e.g. per month), as
+written by `DatasetWriter`.
+
+"""
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+META_FILE = "_meta.json"
+
+
+def encode_column(values):
+    """Return (codes, dictionary) for a column of values, where
+    dictionary is sorted and codes are int32 positions in it (-1 for
+    missing values)
+    """
+    values = pd.Categorical(values)
+    categories = np.asarray(values.categories).astype(str)
+    order = np.argsort(categories, kind="stable")
+    # the extra last entry maps the missing value code (-1) to itself
+    remap = np.full(len(order) + 1, -1, dtype=np.int32)
+    remap[order] = np.arange(len(order), dtype=np.int32)
+    return remap[values.codes], categories[order]
+
+
+def write_table(path, df):
+    """Write `df` as a table at `path`, replacing any existing table
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    columns = {}
+    for name in df.columns:
+        series = df[name]
+        if _is_plain(series.dtype):
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), series.to_numpy())
+            columns[name] = "plain"
+        else:
+            codes, dictionary = encode_column(series)
+            np.save(os.path.join(tmp_dir, f"{name}.codes.npy"), codes)
+            np.save(os.path.join(tmp_dir, f"{name}.values.npy"), dictionary)
+            columns[name] = "dictionary"
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump({"rows": len(df), "columns": columns}, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_dir, path)
+
+
+class Table:
+    """A read-only, memory-mapped view of a table written by `write_table`
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self._mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.rows = meta["rows"]
+        self.kinds = meta["columns"]
+        self.columns = list(self.kinds)
+        self._arrays = {}
+
+    def __len__(self):
+        return self.rows
+
+    def _load(self, filename):
+        if filename not in self._arrays:
+            self._arrays[filename] = np.load(
+                os.path.join(self.path, filename), mmap_mode=self._mmap_mode
+            )
+        return self._arrays[filename]
+
+    def is_dictionary(self, name):
+        return self.kinds[name] == "dictionary"
+
+    def codes(self, name):
+        """Return the int32 codes of a dictionary-encoded column
+        """
+        return self._load(f"{name}.codes.npy")
+
+    def dictionary(self, name):
+        """Return the sorted dictionary of a dictionary-encoded column
+        """
+        return self._load(f"{name}.values.npy")
+
+    def array(self, name):
+        """Return a plain column, or the codes of a dictionary-encoded one
+        """
+        if self.is_dictionary(name):
+            return self.codes(name)
+        return self._load(f"{name}.npy")
+
+    def column(self, name, positions=None):
+        """Return a column as a series, with dictionary-encoded columns as
+        categoricals, optionally only at `positions`
+        """
+        values = self.array(name)
+        if positions is not None:
+            values = values[positions]
+        if self.is_dictionary(name):
+            return pd.Series(
+                pd.Categorical.from_codes(
+                    np.asarray(values), categories=self.dictionary(name)
+                ),
+                name=name,
+            )
+        return pd.Series(np.asarray(values), name=name)
+
+    def to_frame(self, columns=None, positions=None):
+        columns = columns or self.columns
+        return pd.concat(
+            [self.column(name, positions) for name in columns], axis=1
+        ).reindex(columns=columns)
+
+
+def open_table(path, mmap=True):
+    return Table(path, mmap=mmap)
+
+
+def read_table(path, columns=None):
+    """Read a table, or every part of a dataset, into a dataframe
+    """
+    if os.path.exists(os.path.join(path, META_FILE)):
+        return open_table(path).to_frame(columns)
+    frames = [open_table(part).to_frame(columns) for part in dataset_parts(path)]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return _concat_categoricals(frames)
+
+
+def dataset_parts(path):
+    """Return the paths of the tables in a dataset, in sorted order
+    """
+    return sorted(
+        os.path.dirname(meta)
+        for meta in glob.glob(os.path.join(path, "**", META_FILE), recursive=True)
+    )
+
+
+class DatasetWriter:
+    """Writes a stream of dataframes as the parts of a dataset, so a large
+    result never has to be held in memory at once
+    """
+
+    def __init__(self, path, prefix="part"):
+        self.path = path
+        self.prefix = prefix
+        os.makedirs(path, exist_ok=True)
+        self.parts = len(dataset_parts(path))
+
+    def write(self, df, partition=None):
+        """Write `df` as the next part, optionally in a `partition`
+        subdirectory (e.g. "month=2020-01")
+        """
+        directory = os.path.join(self.path, partition) if partition else self.path
+        part_path = os.path.join(directory, f"{self.prefix}-{self.parts:05d}")
+        write_table(part_path, df)
+        self.parts += 1
+        return part_path
+
+
+def _is_plain(dtype):
+    """Return whether a column of `dtype` is stored as-is rather than
+    dictionary encoded
+    """
+    return dtype.kind in "iufb"
+
+
+def _concat_categoricals(frames):
+    """Concatenate frames whose categorical columns have different
+    dictionaries
+    """
+    result = pd.concat(frames, ignore_index=True)
+    for name in frames[0].columns:
+        if isinstance(frames[0][name].dtype, pd.CategoricalDtype):
+            union = pd.api.types.union_categoricals(
+                [frame[name] for frame in frames], sort_categories=True
+            )
+            result[name] = union
+    return result
@@ -0,0 +1,184 @@
+"""Which presentations each methodology captures, and how that changes.
+
+The DMD notebook finds the presentations only captured by the new dm+d
+methodology (`left_only`) or only by the old one (`right_only`) with a
+full outer merge of the two result frames.  Here each result is reduced
+to the set of BNF codes it covers, for each methodology, dm+d release
+and month, held as a sorted array of integer codes:
+
+    coverage = PresentationCoverage()
+    coverage.add_frame(df_opioid_total_ome_old_class_dmd, "dmd")
+    coverage.add_frame(df_opioid_total_ome_old_class_measure, "measure")
+    coverage.compare("measure", "dmd")
+
+BNF codes are interned as integers the first time they're seen, so sets
+from any number of frames share one code space.  Comparisons build a
+boolean bitmap over that space for every set involved and compute all
+the differences with a couple of array operations, so comparing every
+monthly release is one call and never merges the frames themselves.
+
+"""
+import collections
+
+import numpy as np
+import pandas as pd
+
+CoverageKey = collections.namedtuple("CoverageKey", ["methodology", "release", "month"])
+
+DELTA_COLUMNS = [
+    "methodology_old",
+    "methodology_new",
+    "release_old",
+    "release_new",
+    "month",
+    "bnf_code",
+    "bnf_name",
+    "change",
+]
+
+
+class PresentationCoverage:
+    """Sets of BNF codes covered by each (methodology, release, month)
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._codes = []
+        self._names = []
+        self._sets = {}
+
+    def __len__(self):
+        return len(self._sets)
+
+    def keys(self):
+        return sorted(self._sets, key=lambda key: tuple(map(str, key)))
+
+    def _intern(self, bnf_codes, bnf_names=None):
+        """Return the integer ids of `bnf_codes`, adding new codes
+        """
+        codes, uniques = pd.factorize(pd.Series(bnf_codes).astype(str))
+        if bnf_names is not None:
+            names = pd.Series(bnf_names).astype(str).groupby(codes).first()
+        ids = np.empty(len(uniques), dtype=np.int32)
+        for i, code in enumerate(uniques):
+            if code not in self._ids:
+                self._ids[code] = len(self._codes)
+                self._codes.append(code)
+                self._names.append(names[i] if bnf_names is not None else None)
+            ids[i] = self._ids[code]
+        return ids[codes]
+
+    def add(self, methodology, bnf_codes, bnf_names=None, release=None, month=None):
+        """Add `bnf_codes` to the set for (methodology, release, month)
+        """
+        key = CoverageKey(methodology, release, month)
+        ids = np.unique(self._intern(bnf_codes, bnf_names))
+        if key in self._sets:
+            ids = np.union1d(self._sets[key], ids)
+        self._sets[key] = ids
+
+    def add_frame(
+        self,
+        df,
+        methodology,
+        release=None,
+        month_column=None,
+        code_column="bnf_code",
+        name_column="bnf_name",
+    ):
+        """Add the BNF codes in a result frame, split by month if
+        `month_column` is given
+        """
+        names = df[name_column] if name_column in df.columns else None
+        if month_column is None:
+            self.add(methodology, df[code_column], names, release=release)
+            return
+        ids = self._intern(df[code_column], names)
+        months = df[month_column].astype(str).to_numpy()
+        order = np.lexsort((ids, months))
+        months, ids = months[order], ids[order]
+        starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        for start, stop in zip(starts, np.r_[starts[1:], len(months)]):
+            key = CoverageKey(methodology, release, months[start])
+            month_ids = np.unique(ids[start:stop])
+            if key in self._sets:
+                month_ids = np.union1d(self._sets[key], month_ids)
+            self._sets[key] = month_ids
+
+    def codes(self, methodology, release=None, month=None):
+        """Return the BNF codes in one set, in sorted order
+        """
+        ids = self._sets[CoverageKey(methodology, release, month)]
+        return np.sort(np.asarray(self._codes, dtype=object)[ids])
+
+    def bitmap(self, keys):
+        """Return a boolean array with a row for each of `keys` and a column
+        for each interned BNF code, True where the set contains the code
+        """
+        result = np.zeros((len(keys), len(self._codes)), dtype=bool)
+        sets = [self._sets.get(CoverageKey(*key), []) for key in keys]
+        rows = np.repeat(np.arange(len(keys)), [len(ids) for ids in sets])
+        if len(rows):
+            result[rows, np.concatenate(sets)] = True
+        return result
+
+    def delta(self, pairs):
+        """Return the BNF codes added and removed between each (old key,
+        new key) in `pairs`, as a dataframe with `DELTA_COLUMNS`
+        """
+        pairs = [(CoverageKey(*old), CoverageKey(*new)) for old, new in pairs]
+        old = self.bitmap([old for old, _ in pairs])
+        new = self.bitmap([new for _, new in pairs])
+        frames = []
+        for change, mask in (("added", new & ~old), ("removed", old & ~new)):
+            pair_positions, ids = np.nonzero(mask)
+            frames.append(self._delta_frame(pairs, pair_positions, ids, change))
+        result = pd.concat(frames, ignore_index=True)
+        return result.sort_values(
+            ["month", "release_new", "change", "bnf_code"], kind="mergesort"
+        ).reset_index(drop=True)
+
+    def _delta_frame(self, pairs, pair_positions, ids, change):
+        old_keys = [pairs[i][0] for i in pair_positions]
+        new_keys = [pairs[i][1] for i in pair_positions]
+        return pd.DataFrame(
+            {
+                "methodology_old": [key.methodology for key in old_keys],
+                "methodology_new": [key.methodology for key in new_keys],
+                "release_old": [key.release for key in old_keys],
+                "release_new": [key.release for key in new_keys],
+                "month": [key.month for key in new_keys],
+                "bnf_code": np.asarray(self._codes, dtype=object)[ids],
+                "bnf_name": np.asarray(self._names, dtype=object)[ids],
+                "change": change,
+            },
+            columns=DELTA_COLUMNS,
+        )
+
+    def compare(self, old_methodology, new_methodology):
+        """Return the presentations captured only by `new_methodology`
+        ("added") or only by `old_methodology` ("removed"), for every
+        release and month both have a set for
+        """
+        pairs = [
+            (key, key._replace(methodology=new_methodology))
+            for key in self.keys()
+            if key.methodology == old_methodology
+            and key._replace(methodology=new_methodology) in self._sets
+        ]
+        return self.delta(pairs)
+
+    def release_changes(self, methodology):
+        """Return the presentations added and removed by each dm+d release
+        of `methodology`, compared with the release before it, month by
+        month
+        """
+        by_month = collections.defaultdict(list)
+        for key in self.keys():
+            if key.methodology == methodology:
+                by_month[key.month].append(key)
+        pairs = []
+        for keys in by_month.values():
+            keys = sorted(keys, key=lambda key: str(key.release))
+            pairs.extend(zip(keys[:-1], keys[1:]))
+        return self.delta(pairs)
@@ -0,0 +1,311 @@
+"""Local snapshots of the dm+d tables used by the OME calculation.
+
+The OME calculation (`lib.ome`) needs six dm+d tables -- `vpi`, `ing`,
+`vmp`, `ont`, `ontformroute` and `unitofmeasure` -- which otherwise
+have to be queried from the warehouse.  `load_release` reads them from
+a dm+d release, either the XML files published by NHSBSA (`f_vmp2_*.xml`,
+`f_ingredient2_*.xml`, `f_lookup2_*.xml` and the supplementary
+`f_bnf1_*.xml` for BNF codes) or a directory of CSV exports named after
+the tables (e.g. `vmp.csv`, with the same columns as the `dmd` dataset
+in BigQuery).  `write_snapshot` stores them as columnar tables (see
+`lib.columnar`):
+
+    <snapshot>/_snapshot.json
+    <snapshot>/vmp/...           sorted by id
+    <snapshot>/vpi/...
+    ...
+
+Tables with a SNOMED id (`vmp`, `ing`) or lookup code (`unitofmeasure`,
+`ontformroute`) are sorted by it, so the dense int32 index of an id is
+its row in that table.  Every column referring to one of those tables
+gets a companion `<column>_row` column holding that index (-1 where
+there is no match), so joins are array lookups.
+
+Opening a snapshot memory-maps it, so it's effectively instant:
+
+    snapshot = DmdSnapshot("data/dmd_snapshot")
+    factors = ingredient_factors(opioid_class=opioid_class, **snapshot.tables())
+
+Build one with
+
+    python -m lib.dmd <release directory> <snapshot path>
+
+"""
+import datetime
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+from lib import columnar
+
+SNAPSHOT_FILE = "_snapshot.json"
+
+# table -> {column: "id" (int64, -1 when missing), "float" or "str"}
+COLUMNS = {
+    "vmp": {"id": "id", "nm": "str", "bnf_code": "str", "udfs": "float"},
+    "vpi": {
+        "vmp": "id",
+        "ing": "id",
+        "strnt_nmrtr_val": "float",
+        "strnt_nmrtr_uom": "id",
+        "strnt_dnmtr_val": "float",
+        "strnt_dnmtr_uom": "id",
+    },
+    "ing": {"id": "id", "nm": "str"},
+    "ont": {"vmp": "id", "form": "id"},
+    "ontformroute": {"cd": "id", "descr": "str"},
+    "unitofmeasure": {"cd": "id", "descr": "str"},
+}
+
+# tables sorted by (and indexed on) a key column
+KEYS = {"vmp": "id", "ing": "id", "ontformroute": "cd", "unitofmeasure": "cd"}
+
+# (table, column) -> the keyed table it refers to
+REFERENCES = {
+    ("vpi", "vmp"): "vmp",
+    ("vpi", "ing"): "ing",
+    ("vpi", "strnt_nmrtr_uom"): "unitofmeasure",
+    ("vpi", "strnt_dnmtr_uom"): "unitofmeasure",
+    ("ont", "vmp"): "vmp",
+    ("ont", "form"): "ontformroute",
+}
+
+# file pattern -> {(parent tag, record tag): (table, {tag: column})}
+XML_RECORDS = {
+    "f_vmp2_*.xml": {
+        ("VMPS", "VMP"): ("vmp", {"VPID": "id", "NM": "nm", "UDFS": "udfs"}),
+        ("VIRTUAL_PRODUCT_INGREDIENT", "VPI"): (
+            "vpi",
+            {
+                "VPID": "vmp",
+                "ISID": "ing",
+                "STRNT_NMRTR_VAL": "strnt_nmrtr_val",
+                "STRNT_NMRTR_UOMCD": "strnt_nmrtr_uom",
+                "STRNT_DNMTR_VAL": "strnt_dnmtr_val",
+                "STRNT_DNMTR_UOMCD": "strnt_dnmtr_uom",
+            },
+        ),
+        ("ONT_DRUG_FORM", "ONT"): ("ont", {"VPID": "vmp", "FORMCD": "form"}),
+    },
+    "f_ingredient2_*.xml": {
+        ("INGREDIENT_SUBSTANCES", "ING"): ("ing", {"ISID": "id", "NM": "nm"}),
+    },
+    "f_lookup2_*.xml": {
+        ("UNIT_OF_MEASURE", "INFO"): ("unitofmeasure", {"CD": "cd", "DESC": "descr"}),
+        ("ONT_FORM_ROUTE", "INFO"): ("ontformroute", {"CD": "cd", "DESC": "descr"}),
+    },
+    "f_bnf1_*.xml": {("VMPS", "VMP"): ("vmp_bnf", {"VPID": "id", "BNF": "bnf_code"})},
+}
+
+# the name of the VMP table in some exports
+CSV_ALIASES = {"vmp": ("vmp", "vmp_full")}
+
+
+def load_release(directory):
+    """Return a dict of dataframes of the tables in `COLUMNS` from a dm+d
+    release directory, of XML files or of CSV exports
+    """
+    if glob.glob(os.path.join(directory, "f_vmp2_*.xml")):
+        return read_xml_release(directory)
+    return read_csv_release(directory)
+
+
+def read_csv_release(directory):
+    tables = {}
+    for table, columns in COLUMNS.items():
+        for name in CSV_ALIASES.get(table, (table,)):
+            path = os.path.join(directory, f"{name}.csv")
+            if os.path.exists(path):
+                break
+        else:
+            raise FileNotFoundError(f"No CSV export of {table} in {directory}")
+        tables[table] = _coerce(pd.read_csv(path, usecols=list(columns)), table)
+    return tables
+
+
+def read_xml_release(directory):
+    rows = {}
+    for pattern, records in XML_RECORDS.items():
+        paths = sorted(glob.glob(os.path.join(directory, pattern)))
+        if not paths:
+            raise FileNotFoundError(f"No {pattern} in {directory}")
+        for table, records_rows in _parse_xml(paths[-1], records).items():
+            rows.setdefault(table, []).extend(records_rows)
+    frames = {
+        table: pd.DataFrame(rows.get(table, []), columns=list(columns))
+        for table, columns in COLUMNS.items()
+        if table != "vmp"
+    }
+    # BNF codes come from the supplementary release, not the VMP file
+    vmp = pd.DataFrame(rows.get("vmp", []), columns=["id", "nm", "udfs"])
+    bnf = pd.DataFrame(rows.get("vmp_bnf", []), columns=["id", "bnf_code"])
+    frames["vmp"] = vmp.merge(bnf, on="id", how="left")[list(COLUMNS["vmp"])]
+    return {table: _coerce(df, table) for table, df in frames.items()}
+
+
+def _parse_xml(path, records):
+    """Return {table: list of row dicts} for the records in the XML file
+    at `path`, reading it incrementally
+    """
+    rows = {table: [] for table, _ in records.values()}
+    parents = []
+    # records started but not yet ended, whose fields are still needed
+    open_records = 0
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            parent = parents[-1].tag if parents else None
+            if (parent, element.tag) in records:
+                open_records += 1
+            parents.append(element)
+            continue
+        parents.pop()
+        record = records.get((parents[-1].tag if parents else None, element.tag))
+        if record is not None:
+            open_records -= 1
+            table, fields = record
+            rows[table].append(
+                {
+                    fields[child.tag]: child.text
+                    for child in element
+                    if child.tag in fields
+                }
+            )
+        if open_records == 0:
+            # every finished element outside a record, matched or not, is
+            # dropped from the tree, so memory use doesn't grow with the
+            # size of the file
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+    return rows
+
+
+def _coerce(df, table):
+    """Return `df` with the columns and types given in `COLUMNS`
+    """
+    result = {}
+    for column, kind in COLUMNS[table].items():
+        if kind == "id":
+            values = pd.to_numeric(df[column], errors="coerce")
+            result[column] = values.fillna(-1).astype(np.int64).to_numpy()
+        elif kind == "float":
+            result[column] = pd.to_numeric(df[column], errors="coerce").to_numpy(
+                dtype="float64"
+            )
+        else:
+            result[column] = df[column].to_numpy(dtype=object)
+    return pd.DataFrame(result)
+
+
+def write_snapshot(tables, path, release=None):
+    """Write the tables from `load_release` as a snapshot at `path`,
+    replacing any existing snapshot
+    """
+    tables = {
+        table: (
+            tables[table].sort_values(KEYS[table], kind="mergesort")
+            if table in KEYS
+            else tables[table]
+        ).reset_index(drop=True)
+        for table in COLUMNS
+    }
+    for (table, column), target in REFERENCES.items():
+        tables[table][f"{column}_row"] = _rows(
+            tables[target][KEYS[target]].to_numpy(), tables[table][column].to_numpy()
+        )
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    for table, df in tables.items():
+        columnar.write_table(os.path.join(tmp_dir, table), df)
+    with open(os.path.join(tmp_dir, SNAPSHOT_FILE), "w") as f:
+        json.dump(
+            {
+                "release": release,
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "rows": {table: len(df) for table, df in tables.items()},
+            },
+            f,
+            indent=2,
+        )
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_dir, path)
+
+
+class DmdSnapshot:
+    """Read-only, memory-mapped access to a snapshot written by
+    `write_snapshot`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SNAPSHOT_FILE)) as f:
+            self.meta = json.load(f)
+        self._tables = {
+            table: columnar.open_table(os.path.join(path, table)) for table in COLUMNS
+        }
+
+    def table(self, name):
+        """Return the `lib.columnar.Table` for a dm+d table
+        """
+        return self._tables[name]
+
+    def frame(self, name):
+        """Return a dm+d table as a dataframe, with its original columns
+        """
+        return self._tables[name].to_frame(list(COLUMNS[name]))
+
+    def tables(self):
+        """Return all the tables as dataframes, keyed by the argument
+        names of `lib.ome.ingredient_factors`
+        """
+        return {name: self.frame(name) for name in COLUMNS}
+
+    def rows(self, name, ids):
+        """Return the dense int32 index (row) in table `name` of each SNOMED
+        id or code in `ids`, or -1 for ids not in the table
+        """
+        keys = self._tables[name].array(KEYS[name])
+        return _rows(keys, np.asarray(ids, dtype=np.int64))
+
+    def join_index(self, table, column):
+        """Return the rows of the table referred to by `column` of `table`
+        (e.g. `join_index("vpi", "ing")` gives the `ing` row of every VPI)
+        """
+        if (table, column) not in REFERENCES:
+            raise KeyError(f"{table}.{column} doesn't refer to another table")
+        return self._tables[table].array(f"{column}_row")
+
+
+def _rows(keys, ids):
+    """Return the position of each of `ids` in sorted `keys`, or -1
+    """
+    if len(keys) == 0:
+        return np.full(len(ids), -1, dtype=np.int32)
+    positions = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+    return np.where(keys[positions] == ids, positions, -1).astype(np.int32)
+
+
+def main(argv):
+    if len(argv) != 2:
+        print("usage: python -m lib.dmd <release directory> <snapshot path>")
+        return 1
+    release, path = argv
+    tables = load_release(release)
+    write_snapshot(tables, path, release=os.path.basename(os.path.normpath(release)))
+    for table, df in tables.items():
+        print(f"{table}: {len(df)} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
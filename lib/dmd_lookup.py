@@ -0,0 +1,123 @@
+"""Vectorised dm+d id <-> name lookups over a local snapshot.
+
+Labelling OME results with ingredient, VMP or form names usually means
+another join in SQL.  A dm+d snapshot (see `lib.dmd`) already holds
+everything needed for that as memory-mapped arrays: each table is
+sorted by id, and its name column is stored as int32 codes into a
+sorted dictionary of distinct names.  So decoding a whole column of ids
+is a binary search for the rows, and a gather of the name codes, giving
+a categorical over the snapshot's own dictionary -- no strings are
+copied, however many rows there are:
+
+    lookup = open_lookup("data/dmd_snapshot")
+    lookup.decode("ing", [387173000, 373492002])
+    lookup.label(ome, ing="ing", vmp="vmp")    # adds ing_name, vmp_name
+
+Because the arrays are memory-mapped, every kernel using the same
+snapshot shares one copy in the page cache, and `open_lookup` keeps one
+`DmdLookup` per snapshot in each process.
+
+"""
+import functools
+
+import numpy as np
+import pandas as pd
+
+from lib.dmd import KEYS, DmdSnapshot
+
+# kind of id -> (snapshot table, name column)
+KINDS = {
+    "vmp": ("vmp", "nm"),
+    "ing": ("ing", "nm"),
+    "form": ("ontformroute", "descr"),
+    "unit": ("unitofmeasure", "descr"),
+}
+
+
+class DmdLookup:
+    """Batch decoding of dm+d ids to names (and other columns), and
+    encoding of names back to ids
+    """
+
+    def __init__(self, snapshot):
+        if isinstance(snapshot, str):
+            snapshot = DmdSnapshot(snapshot)
+        self.snapshot = snapshot
+        self._name_ids = {}
+
+    def _table(self, kind):
+        table_name, name_column = KINDS[kind]
+        return table_name, self.snapshot.table(table_name), name_column
+
+    def rows(self, kind, ids):
+        """Return the snapshot row of each id, or -1 for unknown ids
+        """
+        ids = pd.to_numeric(pd.Series(np.asarray(ids)), errors="coerce")
+        ids = ids.fillna(-1).to_numpy(dtype=np.int64)
+        return self.snapshot.rows(KINDS[kind][0], ids)
+
+    def decode(self, kind, ids, column=None):
+        """Return the names (or values of `column`, e.g. `bnf_code` for
+        VMPs) of `ids` as a categorical, missing for unknown ids
+
+        Numeric columns (e.g. `udfs`) are returned as float arrays, with
+        NaN for unknown ids.
+
+        """
+        _, table, name_column = self._table(kind)
+        column = column or name_column
+        rows = self.rows(kind, ids)
+        if not table.is_dictionary(column):
+            values = np.asarray(table.array(column), dtype="float64")[
+                np.maximum(rows, 0)
+            ]
+            return np.where(rows >= 0, values, np.nan)
+        codes = np.asarray(table.codes(column))[np.maximum(rows, 0)]
+        codes = np.where(rows >= 0, codes, -1)
+        return pd.Categorical.from_codes(codes, categories=table.dictionary(column))
+
+    def _ids_by_name_code(self, kind):
+        """Return an array giving, for each entry of the name dictionary,
+        the id of the first row with that name
+        """
+        if kind not in self._name_ids:
+            table_name, table, name_column = self._table(kind)
+            codes = np.asarray(table.codes(name_column))
+            keys = np.asarray(table.array(KEYS[table_name]))
+            ids = np.full(len(table.dictionary(name_column)), -1, dtype=np.int64)
+            present = codes >= 0
+            # assign in reverse, so the first row with each name wins
+            ids[codes[present][::-1]] = keys[present][::-1]
+            self._name_ids[kind] = ids
+        return self._name_ids[kind]
+
+    def encode(self, kind, names):
+        """Return the id for each of `names`, or -1 for unknown names
+        """
+        _, table, name_column = self._table(kind)
+        dictionary = table.dictionary(name_column)
+        names = np.asarray(names).astype(str)
+        if len(dictionary) == 0:
+            return np.full(len(names), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(dictionary, names), len(dictionary) - 1)
+        found = dictionary[positions] == names
+        return np.where(found, self._ids_by_name_code(kind)[positions], -1)
+
+    def label(self, df, suffix="_name", **columns):
+        """Return `df` with a name column for each id column given as
+        `column=kind`, e.g. `label(df, ing="ing", vmp="vmp")`
+        """
+        return df.assign(
+            **{
+                f"{column}{suffix}": self.decode(kind, df[column])
+                for column, kind in columns.items()
+            }
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def open_lookup(path):
+    """Return the `DmdLookup` for the snapshot at `path`, opening it only
+    once per process
+    """
+    return DmdLookup(path)
@@ -0,0 +1,131 @@
+"""Reproducible sums of OME and quantity.
+
+Floating point addition isn't associative, so summing the same values in
+a different order (a different chunk size, or a different split between
+parallel workers) gives slightly different totals -- hence values like
+`9292816.800000008` in the extracts, and the rounding the DMD notebook
+does before comparing methodologies.
+
+Here values are converted to integer fixed point (micro-units by
+default, i.e. micrograms when summing mg), summed as int64 and converted
+back at the end.  Integer addition is exact and associative, so totals
+are bit-identical however the work is divided, and partial sums from
+chunks or workers can be merged exactly with `FixedPointAccumulator`.
+
+Each value is rounded to the nearest micro-unit on the way in, which is
+exact for values below about 10^9 (the point at which a float64 can no
+longer represent every micro-unit).  Totals must stay below about
+4.6 x 10^12; larger sums raise `OverflowError` rather than wrapping.
+
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+SCALE = 10 ** 6
+
+# int64 can hold up to ~9.2e18; leave headroom for the rounding of each
+# value
+_MAX_FIXED = 2 ** 62
+
+
+def to_fixed(values, scale=SCALE):
+    """Return `values` as int64 multiples of 1/`scale`
+    """
+    scaled = np.rint(np.asarray(values, dtype="float64") * scale)
+    if np.nansum(np.abs(scaled)) >= _MAX_FIXED:
+        raise OverflowError("Values too large to sum exactly at this scale")
+    return np.nan_to_num(scaled).astype(np.int64)
+
+
+def from_fixed(values, scale=SCALE):
+    """Return fixed point `values` as floats
+    """
+    return np.asarray(values, dtype=np.int64) / scale
+
+
+def exact_sum(values, scale=SCALE):
+    """Return the sum of `values`, independent of their order
+    """
+    return from_fixed(to_fixed(values, scale).sum(), scale)
+
+
+def exact_groupby_sum(df, by, columns, scale=SCALE, method="fixed"):
+    """Return the per-group sums of `columns`, as `df.groupby(by)[columns].sum()`
+    but independent of the order of the rows
+
+    `method` is "fixed" (fixed point, as described above) or "fsum"
+    (`math.fsum` per group, which is correctly rounded and so also order
+    independent, but slower and can't be merged across chunks).
+
+    """
+    columns = list(columns)
+    if method == "fsum":
+        return df.groupby(by)[columns].agg(math.fsum)
+    if method != "fixed":
+        raise ValueError(f"Unknown method {method!r}")
+    fixed = pd.DataFrame(
+        {column: to_fixed(df[column], scale) for column in columns}, index=df.index
+    )
+    keys = [df[key] for key in by] if isinstance(by, (list, tuple)) else df[by]
+    totals = fixed.groupby(keys).sum()
+    return totals / scale
+
+
+class FixedPointAccumulator:
+    """Exact per-group sums which can be built up chunk by chunk, or in
+    several workers, and merged in any order with the same result
+    """
+
+    def __init__(self, by, columns, scale=SCALE):
+        self.by = by
+        self.columns = list(columns)
+        self.scale = scale
+        self._totals = None
+
+    def add(self, chunk):
+        """Add a chunk of rows to the totals
+        """
+        fixed = pd.DataFrame(
+            {column: to_fixed(chunk[column], self.scale) for column in self.columns},
+            index=chunk.index,
+        )
+        by = self.by
+        keys = (
+            [chunk[key] for key in by] if isinstance(by, (list, tuple)) else chunk[by]
+        )
+        self._combine(fixed.groupby(keys).sum())
+
+    def merge(self, other):
+        """Add the totals of another accumulator (e.g. from a worker)
+        """
+        if other.scale != self.scale:
+            raise ValueError("Can't merge accumulators with different scales")
+        if other._totals is not None:
+            self._combine(other._totals)
+
+    def _combine(self, totals):
+        if self._totals is None:
+            self._totals = totals
+        else:
+            # concatenating then summing keeps the totals as int64, where
+            # `add(..., fill_value=0)` would go via float64
+            combined = pd.concat([self._totals, totals])
+            self._totals = combined.groupby(
+                level=list(range(combined.index.nlevels))
+            ).sum()
+        if (self._totals.abs() >= _MAX_FIXED).any().any():
+            raise OverflowError("Totals too large to sum exactly at this scale")
+
+    def fixed_totals(self):
+        """Return the totals as int64 fixed point values
+        """
+        return self._totals
+
+    def result(self):
+        """Return the totals as floats
+        """
+        if self._totals is None:
+            return pd.DataFrame(columns=self.columns)
+        return self._totals.sort_index() / self.scale
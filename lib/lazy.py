@@ -0,0 +1,431 @@
+"""A small lazy query planner for exploring OME result sets.
+
+Notebook cells often build a full dataframe only to display its head
+or a sorted top-N.  A `LazyFrame` records filter / sort / limit /
+select steps as a plan instead, and `collect()` optimises the plan
+before running it:
+
+* consecutive filters are fused, and filters are pushed below sorts and
+  column selections down to the scan, so rows are dropped as each chunk
+  of a stored extract is read;
+* column selections are pushed into the scan so unused columns are
+  never parsed;
+* a sort followed by a limit becomes a top-N, which only ever holds `n`
+  rows and uses partial selection rather than sorting the whole frame;
+* a limit over a scan stops reading the extract once enough rows have
+  been found.
+
+For example:
+
+    top = (
+        scan_csv("../data/df_opioid_total_ome_old_class_dmd.csv")
+        .filter(col("bnf_code").startswith("0407020"))
+        .sort("ome_dose", ascending=False)
+        .head(10)
+        .collect()
+    )
+
+Results are the same as running the equivalent pandas operations
+eagerly, including the original row index.
+
+"""
+import operator
+
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from lib.ranking import top_n
+
+DEFAULT_CHUNKSIZE = 100_000
+
+
+class Predicate:
+    """A row filter over named columns, which can be combined with `&`,
+    `|` and `~`
+    """
+
+    def __init__(self, func, columns, description):
+        self.func = func
+        self.columns = frozenset(columns)
+        self.description = description
+
+    def __call__(self, df):
+        return self.func(df)
+
+    def __and__(self, other):
+        return Predicate(
+            lambda df: self(df) & other(df),
+            self.columns | other.columns,
+            f"({self.description} & {other.description})",
+        )
+
+    def __or__(self, other):
+        return Predicate(
+            lambda df: self(df) | other(df),
+            self.columns | other.columns,
+            f"({self.description} | {other.description})",
+        )
+
+    def __invert__(self):
+        return Predicate(lambda df: ~self(df), self.columns, f"~{self.description}")
+
+    def __repr__(self):
+        return self.description
+
+
+class Col:
+    """A reference to a column, used to build predicates, e.g.
+    `col("_merge") == "both"`
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def _compare(self, op, symbol, value):
+        name = self.name
+        return Predicate(
+            lambda df: op(df[name], value), [name], f"{name} {symbol} {value!r}"
+        )
+
+    def __eq__(self, value):
+        return self._compare(operator.eq, "==", value)
+
+    def __ne__(self, value):
+        return self._compare(operator.ne, "!=", value)
+
+    def __lt__(self, value):
+        return self._compare(operator.lt, "<", value)
+
+    def __le__(self, value):
+        return self._compare(operator.le, "<=", value)
+
+    def __gt__(self, value):
+        return self._compare(operator.gt, ">", value)
+
+    def __ge__(self, value):
+        return self._compare(operator.ge, ">=", value)
+
+    def isin(self, values):
+        name, values = self.name, list(values)
+        return Predicate(
+            lambda df: df[name].isin(values), [name], f"{name} in {values!r}"
+        )
+
+    def startswith(self, prefix):
+        name = self.name
+        return Predicate(
+            lambda df: df[name].astype(str).str.startswith(prefix),
+            [name],
+            f"{name} startswith {prefix!r}",
+        )
+
+    def notnull(self):
+        name = self.name
+        return Predicate(lambda df: df[name].notnull(), [name], f"{name} notnull")
+
+    __hash__ = None
+
+
+def col(name):
+    return Col(name)
+
+
+# Plan nodes.  Each is a plain object holding its input node (if any) and
+# parameters; `_optimise` rewrites a tree of them and `_execute` runs it.
+
+
+class Scan:
+    def __init__(self, source, read_kwargs=None):
+        self.source = source
+        self.read_kwargs = read_kwargs or {}
+        self.predicate = None
+        self.columns = None
+        self.limit = None
+
+    def describe(self):
+        name = self.source if isinstance(self.source, str) else "<dataframe>"
+        parts = [f"Scan {name}"]
+        if self.columns is not None:
+            parts.append(f"columns={self.columns}")
+        if self.predicate is not None:
+            parts.append(f"filter={self.predicate!r}")
+        if self.limit is not None:
+            parts.append(f"limit={self.limit}")
+        return " ".join(parts)
+
+
+class Filter:
+    def __init__(self, input, predicate):
+        self.input = input
+        self.predicate = predicate
+
+    def describe(self):
+        return f"Filter {self.predicate!r}"
+
+
+class Select:
+    def __init__(self, input, columns):
+        self.input = input
+        self.columns = list(columns)
+
+    def describe(self):
+        return f"Select {self.columns}"
+
+
+class Sort:
+    def __init__(self, input, by, ascending):
+        self.input = input
+        self.by = by
+        self.ascending = ascending
+
+    def describe(self):
+        return f"Sort by={self.by} ascending={self.ascending}"
+
+
+class Limit:
+    def __init__(self, input, n):
+        self.input = input
+        self.n = n
+
+    def describe(self):
+        return f"Limit {self.n}"
+
+
+class TopN:
+    def __init__(self, input, by, ascending, n):
+        self.input = input
+        self.by = by
+        self.ascending = ascending
+        self.n = n
+
+    def describe(self):
+        return f"TopN {self.n} by={self.by} ascending={self.ascending}"
+
+
+class LazyFrame:
+    """A deferred query over a stored extract or an in-memory dataframe
+    """
+
+    def __init__(self, plan):
+        self._plan = plan
+
+    def filter(self, predicate):
+        return LazyFrame(Filter(self._plan, predicate))
+
+    def select(self, columns):
+        return LazyFrame(Select(self._plan, columns))
+
+    def sort(self, by, ascending=True):
+        by = _as_list(by)
+        return LazyFrame(Sort(self._plan, by, _ascending(ascending, by)))
+
+    sort_values = sort
+
+    def head(self, n=5):
+        return LazyFrame(Limit(self._plan, n))
+
+    limit = head
+
+    def explain(self):
+        """Return a description of the optimised plan, outermost step first
+        """
+        lines = []
+        node = _optimise(self._plan)
+        while node is not None:
+            lines.append("  " * len(lines) + node.describe())
+            node = getattr(node, "input", None)
+        return "\n".join(lines)
+
+    def collect(self):
+        return _execute(_optimise(self._plan))
+
+
+def scan_csv(path, **read_kwargs):
+    """Return a `LazyFrame` over a CSV extract, such as those written by
+    `bq.cached_read`
+    """
+    return LazyFrame(Scan(path, read_kwargs))
+
+
+def from_frame(df):
+    """Return a `LazyFrame` over an existing dataframe
+    """
+    return LazyFrame(Scan(df))
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _ascending(ascending, by):
+    """Return `ascending` as a list of one bool per sort key
+    """
+    if isinstance(ascending, (list, tuple)):
+        if len(ascending) != len(by):
+            raise ValueError(
+                f"Length of ascending ({len(ascending)}) != length of by ({len(by)})"
+            )
+        return [bool(value) for value in ascending]
+    return [bool(ascending)] * len(by)
+
+
+def _optimise(node):
+    """Return an equivalent plan with filters, column selections and
+    limits pushed towards the scan, and sort + limit fused into a top-N
+    """
+    if isinstance(node, Scan):
+        scan = Scan(node.source, node.read_kwargs)
+        scan.predicate, scan.columns, scan.limit = (
+            node.predicate,
+            node.columns,
+            node.limit,
+        )
+        return scan
+
+    child = _optimise(node.input)
+
+    if isinstance(node, Filter):
+        return _push_filter(child, node.predicate)
+
+    if isinstance(node, Select):
+        if isinstance(child, Scan) and child.limit is None:
+            # the scan still needs any columns its own filter refers to
+            child.columns = node.columns
+            if child.predicate is not None and not child.predicate.columns <= set(
+                node.columns
+            ):
+                child.columns = node.columns + sorted(
+                    child.predicate.columns - set(node.columns)
+                )
+                return Select(child, node.columns)
+            return child
+        return Select(child, node.columns)
+
+    if isinstance(node, Sort):
+        return Sort(child, node.by, node.ascending)
+
+    if isinstance(node, TopN):
+        return TopN(child, node.by, node.ascending, node.n)
+
+    if isinstance(node, Limit):
+        if isinstance(child, Sort):
+            return TopN(child.input, child.by, child.ascending, node.n)
+        if isinstance(child, TopN):
+            child.n = min(child.n, node.n)
+            return child
+        if isinstance(child, Scan):
+            child.limit = node.n if child.limit is None else min(child.limit, node.n)
+            return child
+        if isinstance(child, Limit):
+            child.n = min(child.n, node.n)
+            return child
+        if isinstance(child, Select):
+            # limiting commutes with selecting columns
+            return Select(_optimise(Limit(child.input, node.n)), child.columns)
+        return Limit(child, node.n)
+
+    raise TypeError(f"Unknown plan node {node!r}")
+
+
+def _push_filter(node, predicate):
+    if isinstance(node, Scan) and node.limit is None:
+        if node.predicate is None:
+            node.predicate = predicate
+        else:
+            node.predicate = node.predicate & predicate
+        return node
+    if isinstance(node, Sort):
+        # filtering commutes with sorting
+        return Sort(_push_filter(node.input, predicate), node.by, node.ascending)
+    if isinstance(node, Select) and predicate.columns <= set(node.columns):
+        return Select(_push_filter(node.input, predicate), node.columns)
+    return Filter(node, predicate)
+
+
+def _execute(node):
+    if isinstance(node, Scan):
+        return _execute_scan(node)
+    if isinstance(node, TopN) and isinstance(node.input, Scan):
+        return _top_n_chunks(
+            _limited_chunks(node.input),
+            node.by,
+            node.ascending,
+            node.n,
+            node.input.columns,
+        )
+    df = _execute(node.input)
+    if isinstance(node, Filter):
+        return df[node.predicate(df)]
+    if isinstance(node, Select):
+        return df[node.columns]
+    if isinstance(node, Sort):
+        return df.sort_values(node.by, ascending=node.ascending, kind="mergesort")
+    if isinstance(node, Limit):
+        return df.head(node.n)
+    if isinstance(node, TopN):
+        return _top_n_chunks([df], node.by, node.ascending, node.n, df.columns)
+    raise TypeError(f"Unknown plan node {node!r}")
+
+
+def _scan_chunks(scan):
+    """Yield filtered chunks of the scan's source
+    """
+    if isinstance(scan.source, str):
+        kwargs = dict(scan.read_kwargs)
+        kwargs.setdefault("chunksize", DEFAULT_CHUNKSIZE)
+        if scan.columns is not None:
+            kwargs["usecols"] = scan.columns
+        chunks = pd.read_csv(scan.source, **kwargs)
+    else:
+        df = scan.source
+        if scan.columns is not None:
+            df = df[scan.columns]
+        chunks = [df]
+    for chunk in chunks:
+        if scan.predicate is not None:
+            chunk = chunk[scan.predicate(chunk)]
+        if scan.columns is not None:
+            chunk = chunk[scan.columns]
+        yield chunk
+
+
+def _limited_chunks(scan):
+    """Yield filtered chunks of the scan's source, up to its limit
+    """
+    remaining = scan.limit
+    for chunk in _scan_chunks(scan):
+        if remaining is not None:
+            chunk = chunk.head(remaining)
+            remaining -= len(chunk)
+        yield chunk
+        if remaining == 0:
+            break
+
+
+def _execute_scan(scan):
+    found = list(_limited_chunks(scan))
+    if not found:
+        return pd.DataFrame(columns=scan.columns)
+    return pd.concat(found) if len(found) > 1 else found[0]
+
+
+def _top_n_chunks(chunks, by, ascending, n, columns=None):
+    """Return the first `n` rows of the stable sort of all chunks, holding
+    no more than `n` rows between chunks
+
+    `ascending` is a list of one bool per column of `by`, and `columns`
+    the columns of the (empty) result if there are no chunks at all.
+
+    """
+    best = None
+    for chunk in chunks:
+        candidates = chunk if best is None else pd.concat([best, chunk])
+        if len(by) == 1 and is_numeric_dtype(candidates[by[0]]):
+            best = top_n(candidates, by[0], n, largest=not ascending[0])
+        else:
+            best = candidates.sort_values(
+                by, ascending=ascending, kind="mergesort"
+            ).head(n)
+    if best is None:
+        return pd.DataFrame(columns=columns)
+    return best
@@ -0,0 +1,161 @@
+"""Several prescribing measures computed in one pass over the data.
+
+The DMD notebook's approach -- a per-presentation multiplier derived
+from dm+d -- applies equally to DDD and ADQ calculations, and raw
+quantity and items are the same thing with a multiplier of 1.  So a
+measure here is just a table of factors per presentation, and the value
+column (`quantity` or `items`) they multiply:
+
+    measures = [
+        ome_measure(ingredient_factors(...)),
+        table_measure("ddd", ddd_factors),
+        QUANTITY,
+        ITEMS,
+    ]
+    totals = compute_measures(rx, measures, by=("month", "pct"))
+
+Each chunk of prescribing rows is joined to every measure's factors at
+once: the chunk's distinct BNF codes are found once (a few thousand, for
+any number of rows), each measure looks up factors for those codes only,
+and the rows then pick up a row of the resulting codes x measures matrix
+with a single gather.  Each measure then costs one weighted `bincount`
+over the chunk's groups, so adding a measure adds almost nothing to the
+cost of reading the data.
+
+"""
+import collections
+
+import numpy as np
+import pandas as pd
+
+from lib.ome import included, prescribing_join_key, vmp_join_key
+
+Measure = collections.namedtuple(
+    "Measure", ["name", "factors", "value", "key"], defaults=("quantity", None)
+)
+Measure.__doc__ = """A measure: the sum of `value` x factor over prescribing rows
+
+`factors` is a series of factors indexed by presentation key, or None
+for a factor of 1 for every row; `key` optionally maps an array of BNF
+codes to the keys used in `factors` (default: the BNF codes
+themselves).  Rows without a factor contribute nothing.
+"""
+
+QUANTITY = Measure("quantity", None, "quantity", None)
+ITEMS = Measure("items", None, "items", None)
+
+
+def table_measure(
+    name, df, key_column="bnf_code", factor_column="factor", value="quantity"
+):
+    """Return a measure from a table of factors per BNF code (e.g. DDDs
+    per unit of quantity)
+    """
+    factors = df.groupby(key_column)[factor_column].sum()
+    return Measure(name, factors, value, None)
+
+
+def _ome_key(bnf_codes):
+    keys = prescribing_join_key(bnf_codes)
+    return np.where(included(pd.DataFrame({"bnf_code": bnf_codes})), keys, "")
+
+
+def ome_measure(factors, name="ome_dose"):
+    """Return the OME measure from `lib.ome.ingredient_factors`: OME per
+    unit of quantity, summed over each presentation's opioid ingredients,
+    joined on the same key as `lib.ome.compute_ome`
+    """
+    per_unit = factors["mg_per_unit"] * factors["ome"]
+    keys = vmp_join_key(factors["vmp_bnf_code"])
+    return Measure(name, per_unit.groupby(keys).sum(), "quantity", _ome_key)
+
+
+def factor_matrix(measures, bnf_codes):
+    """Return a (codes x measures) array of the factor of each measure
+    for each of `bnf_codes`, with 0 where a measure has no factor
+    """
+    bnf_codes = np.asarray(bnf_codes)
+    matrix = np.ones((len(bnf_codes), len(measures)))
+    for i, measure in enumerate(measures):
+        if measure.factors is None:
+            continue
+        keys = measure.key(bnf_codes) if measure.key else bnf_codes
+        factors = measure.factors.reindex(keys).to_numpy(dtype="float64")
+        matrix[:, i] = np.nan_to_num(factors)
+    return matrix
+
+
+class MeasureBatch:
+    """Totals of several measures by `by`, built up chunk by chunk
+
+    Rows with a missing value in any `by` column are left out, as they
+    are by `groupby`.
+
+    """
+
+    def __init__(self, measures, by=("month", "practice")):
+        self.measures = list(measures)
+        names = [measure.name for measure in self.measures]
+        if len(set(names)) != len(names):
+            raise ValueError("Measure names must be unique")
+        self.by = list(by)
+        self._partials = []
+
+    def totals(self, chunk):
+        """Return the totals of each measure for one chunk, indexed by `by`
+        """
+        grouper = chunk.groupby(self.by, sort=True, observed=True)
+        # rows with a missing key are numbered -1 (or NaN, in later pandas)
+        group_ids = grouper.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        if (group_ids < 0).any():
+            chunk = chunk[group_ids >= 0]
+            group_ids = group_ids[group_ids >= 0]
+        n_groups = grouper.ngroups
+        codes, uniques = pd.factorize(chunk["bnf_code"])
+        factors = factor_matrix(self.measures, np.asarray(uniques).astype(str))
+        # an extra last row for rows without a BNF code (code -1), which
+        # only count towards measures without factors
+        no_code = [[1.0 if m.factors is None else 0.0 for m in self.measures]]
+        factors = np.vstack([factors, no_code])
+        values = {
+            column: chunk[column].to_numpy(dtype="float64")
+            for column in {measure.value for measure in self.measures}
+        }
+        # the single join: each row's factors for every measure
+        row_factors = factors[codes]
+        columns = {}
+        for i, measure in enumerate(self.measures):
+            columns[measure.name] = np.bincount(
+                group_ids,
+                weights=values[measure.value] * row_factors[:, i],
+                minlength=n_groups,
+            )
+        return pd.DataFrame(columns, index=grouper.size().index)
+
+    def add(self, chunk):
+        self._partials.append(self.totals(chunk))
+        if len(self._partials) > 1:
+            # keep memory bounded by the number of groups, not chunks
+            self._partials = [self._combine(self._partials)]
+
+    def _combine(self, partials):
+        combined = pd.concat(partials)
+        return combined.groupby(level=list(range(combined.index.nlevels))).sum()
+
+    def result(self):
+        """Return a dataframe of the totals with `by` as columns
+        """
+        if not self._partials:
+            return pd.DataFrame(columns=self.by + [m.name for m in self.measures])
+        return self._combine(self._partials).reset_index()
+
+
+def compute_measures(rx, measures, by=("month", "practice")):
+    """Return the totals of each of `measures` by `by` for prescribing
+    rows `rx`, a dataframe or an iterable of chunks
+    """
+    batch = MeasureBatch(measures, by)
+    chunks = [rx] if isinstance(rx, pd.DataFrame) else rx
+    for chunk in chunks:
+        batch.add(chunk)
+    return batch.result()
@@ -0,0 +1,260 @@
+"""Local implementation of the dm+d based OME calculation.
+
+This follows the SQL in the DMD notebook step by step, working on
+dataframes of the dm+d tables (with the same column names as the
+`dmd` dataset in BigQuery) instead of querying the warehouse:
+
+* `simple_forms` is the `simp_form` subquery: one simplified route per
+  VMP, with every injection/infusion route collapsed to "injection" and
+  buccal films kept separate;
+* `normalise_vpi` is the `norm_vpi` subquery: ingredient strengths in
+  mg, and denominators in ml;
+* `ingredient_factors` applies the CASE rules in the main query to give,
+  for each VMP and opioid ingredient, the mg of ingredient per unit of
+  quantity prescribed and the OME multiplier for that ingredient/route;
+* `compute_ome` joins prescribing rows to those factors with the
+  concatenated BNF code join, and sums `quantity * ome * mg_per_unit`.
+
+`ingredient_breakdown` gives the same figures with one row per
+presentation and month and a fixed number of ingredient slots, rather
+than one row per ingredient, using a compact `IngredientMap` from
+presentations to their opioid ingredients.
+
+"""
+import numpy as np
+import pandas as pd
+
+FENTANYL = 373492002
+BUPRENORPHINE = 387173000
+
+# drugs used in opiate dependence are excluded from the measure
+EXCLUDED_PREFIXES = ("0410",)
+
+# transdermal buprenorphine patch strengths (micrograms/hour), and the
+# number of hours each patch is worn
+BUPRENORPHINE_7_DAY_STRENGTHS = (5, 10, 15, 20)
+BUPRENORPHINE_4_DAY_STRENGTHS = (35, 52.5, 70)
+FENTANYL_PATCH_HOURS = 72
+
+
+def simple_forms(ont, ontformroute):
+    """Return the distinct (vmp, simple_form) pairs, as the `simp_form`
+    subquery
+    """
+    forms = ont.merge(ontformroute, left_on="form", right_on="cd")
+    descr = forms["descr"].astype(str)
+    simple_form = np.select(
+        [
+            descr.str.contains("injection", regex=False),
+            descr.str.contains("infusion", regex=False),
+            descr == "filmbuccal.buccal",
+        ],
+        ["injection", "injection", "film"],
+        default=descr.str.split(".", n=1).str[-1],
+    )
+    return pd.DataFrame(
+        {"vmp": forms["vmp"].to_numpy(), "simple_form": simple_form}
+    ).drop_duplicates(ignore_index=True)
+
+
+def normalise_vpi(vpi, unitofmeasure):
+    """Return `vpi` with strengths converted to mg (`strnt_nmrtr_val_mg`)
+    and ml (`strnt_dnmtr_val_ml`), as the `norm_vpi` subquery
+
+    Strengths in units other than mg/microgram/gram, or denominators in
+    units other than ml/litre, are left as missing values.
+
+    """
+    units = unitofmeasure.set_index("cd")["descr"]
+    num_unit = vpi["strnt_nmrtr_uom"].map(units)
+    den_unit = vpi["strnt_dnmtr_uom"].map(units)
+    num_scale = num_unit.map({"microgram": 0.001, "gram": 1000.0, "mg": 1.0})
+    den_scale = den_unit.map({"litre": 1000.0, "ml": 1.0})
+    return vpi.assign(
+        num_unit=num_unit,
+        den_unit=den_unit,
+        strnt_nmrtr_val_mg=vpi["strnt_nmrtr_val"] * num_scale,
+        strnt_dnmtr_val_ml=vpi["strnt_dnmtr_val"] * den_scale,
+    )
+
+
+def ingredient_factors(vpi, ing, vmp, ont, ontformroute, unitofmeasure, opioid_class):
+    """Return one row per VMP and opioid ingredient, with the mg of
+    ingredient per unit of quantity prescribed (`mg_per_unit`) and the
+    OME multiplier (`ome`) for that ingredient and route
+    """
+    norm = normalise_vpi(vpi, unitofmeasure)
+    forms = simple_forms(ont, ontformroute)
+    df = (
+        norm.merge(ing[["id", "nm"]], left_on="ing", right_on="id")
+        .merge(
+            vmp[["id", "bnf_code", "udfs"]].rename(
+                columns={"id": "vmp_id", "bnf_code": "vmp_bnf_code"}
+            ),
+            left_on="vmp",
+            right_on="vmp_id",
+        )
+        .merge(forms, on="vmp")
+        .merge(
+            opioid_class[["id", "form", "ome"]],
+            left_on=["ing", "simple_form"],
+            right_on=["id", "form"],
+            suffixes=("", "_opioid"),
+        )
+    )
+    df = df.assign(mg_per_unit=mg_per_unit(df))
+    return df[
+        [
+            "vmp",
+            "vmp_bnf_code",
+            "ing",
+            "nm",
+            "simple_form",
+            "strnt_nmrtr_val",
+            "strnt_nmrtr_val_mg",
+            "strnt_dnmtr_val_ml",
+            "mg_per_unit",
+            "ome",
+        ]
+    ].reset_index(drop=True)
+
+
+def mg_per_unit(df):
+    """Return the mg of ingredient per unit of quantity for each row of
+    normalised VPI joined to its VMP and simplified form, applying the
+    special cases for patches and injections
+    """
+    mg = df["strnt_nmrtr_val_mg"] / df["strnt_dnmtr_val_ml"].fillna(1)
+    transdermal = df["simple_form"] == "transdermal"
+    buprenorphine_patch = transdermal & (df["ing"] == BUPRENORPHINE)
+    return np.select(
+        [
+            transdermal & (df["ing"] == FENTANYL),
+            buprenorphine_patch
+            & df["strnt_nmrtr_val"].isin(BUPRENORPHINE_7_DAY_STRENGTHS),
+            buprenorphine_patch
+            & df["strnt_nmrtr_val"].isin(BUPRENORPHINE_4_DAY_STRENGTHS),
+            df["simple_form"] == "injection",
+        ],
+        [mg * FENTANYL_PATCH_HOURS, mg * 168, mg * 96, mg * df["udfs"]],
+        default=mg,
+    )
+
+
+def prescribing_join_key(bnf_codes):
+    """Return the key used to join prescribing BNF codes (generic or
+    branded) to generic VMP codes: the chemical, "AA", and the strength
+    """
+    codes = pd.Series(bnf_codes).astype(str)
+    return (codes.str[:9] + "AA" + codes.str[-2:]).to_numpy()
+
+
+def vmp_join_key(bnf_codes):
+    """Return the key used to join VMP BNF codes to prescribing
+    """
+    codes = pd.Series(bnf_codes).astype(str)
+    return (codes.str[:11] + codes.str[-2:]).to_numpy()
+
+
+def included(rx):
+    """Return a mask of the prescribing rows included in the measure
+    """
+    return ~rx["bnf_code"].astype(str).str.startswith(EXCLUDED_PREFIXES).to_numpy()
+
+
+def compute_ome(rx, factors, by=("month", "practice", "pct", "bnf_code", "bnf_name")):
+    """Return total quantity and OME dose for prescribing rows `rx`, grouped
+    by `by` and ingredient, as the main query
+
+    `rx` needs `bnf_code` and `quantity` columns plus those in `by`.
+
+    """
+    by = list(by)
+    rx = rx[included(rx)]
+    rx = rx.assign(join_key=prescribing_join_key(rx["bnf_code"]))
+    factors = factors.assign(join_key=vmp_join_key(factors["vmp_bnf_code"]))
+    joined = rx.merge(factors, on="join_key")
+    joined["ome_dose"] = joined["quantity"] * joined["ome"] * joined["mg_per_unit"]
+    return joined.groupby(by + ["ing", "nm", "ome"], as_index=False, dropna=False).agg(
+        quantity=("quantity", "sum"), ome_dose=("ome_dose", "sum")
+    )
+
+
+class IngredientMap:
+    """Compact mapping from prescribing join keys to a fixed number of
+    ingredient slots, each holding an ingredient id, mg per unit and OME
+    multiplier (padded with id -1 and zeros)
+    """
+
+    def __init__(self, factors, width=None):
+        factors = factors.assign(join_key=vmp_join_key(factors["vmp_bnf_code"]))
+        factors = factors.sort_values(["join_key", "ing"], kind="mergesort")
+        keys = factors["join_key"].to_numpy()
+        self.keys, starts, counts = np.unique(
+            keys, return_index=True, return_counts=True
+        )
+        self.width = width or (int(counts.max()) if len(counts) else 1)
+        if len(counts) and counts.max() > self.width:
+            raise ValueError(
+                f"Some presentations have {counts.max()} ingredient rows; "
+                f"width must be at least that"
+            )
+        slot = np.arange(len(factors)) - np.repeat(starts, counts)
+        row = np.repeat(np.arange(len(self.keys)), counts)
+        shape = (len(self.keys), self.width)
+        self.ing = np.full(shape, -1, dtype=np.int64)
+        self.mg_per_unit = np.zeros(shape)
+        self.ome = np.zeros(shape)
+        self.ing[row, slot] = factors["ing"].to_numpy()
+        self.mg_per_unit[row, slot] = np.nan_to_num(factors["mg_per_unit"].to_numpy())
+        self.ome[row, slot] = factors["ome"].to_numpy()
+        self.names = dict(zip(factors["ing"], factors["nm"]))
+
+    def lookup(self, bnf_codes):
+        """Return the row of the map for each prescribing BNF code, or -1
+        where there isn't one
+        """
+        keys = prescribing_join_key(bnf_codes)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[positions] == keys, positions, -1)
+
+
+def ingredient_breakdown(rx, factors=None, by=None, width=None, ingredient_map=None):
+    """Return prescribing rows with per-ingredient mg and OME held in
+    fixed-width slots, rather than one row per ingredient
+
+    If `by` is given (e.g. `("month", "bnf_code", "bnf_name")`), quantity
+    is first totalled by those columns, so there is one output row per
+    presentation and month.  Each row has columns `ing_<n>_id`,
+    `ing_<n>_mg` and `ing_<n>_ome` for each slot `n` from 1 to the width
+    of the map, and the total `ome_dose`.  Unused slots have an id of -1.
+    Prescribing rows which don't match any opioid VMP are dropped.
+
+    Pass a prebuilt `IngredientMap` to avoid rebuilding it from `factors`
+    on every call.
+
+    """
+    if ingredient_map is None:
+        ingredient_map = IngredientMap(factors, width=width)
+    rx = rx[included(rx)]
+    if by is not None:
+        # mg and OME are proportional to quantity, so total it first
+        rx = rx.groupby(list(by), as_index=False, sort=False)["quantity"].sum()
+    rows = ingredient_map.lookup(rx["bnf_code"].to_numpy())
+    matched = rows >= 0
+    rx = rx[matched]
+    rows = rows[matched]
+
+    quantity = rx["quantity"].to_numpy(dtype="float64")[:, None]
+    mg = quantity * ingredient_map.mg_per_unit[rows]
+    ome = mg * ingredient_map.ome[rows]
+    ing = ingredient_map.ing[rows]
+
+    slots = {}
+    for n in range(ingredient_map.width):
+        slots[f"ing_{n + 1}_id"] = ing[:, n]
+        slots[f"ing_{n + 1}_mg"] = mg[:, n]
+        slots[f"ing_{n + 1}_ome"] = ome[:, n]
+    return rx.assign(**slots, ome_dose=ome.sum(axis=1))
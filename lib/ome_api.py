@@ -0,0 +1,234 @@
+"""A read-only HTTP API over computed OME results.
+
+The results live in a columnar store (see `lib.columnar`) written by
+`write_store`, with one row per month, practice and presentation.  Rows
+are stored sorted by practice and month, with precomputed orderings for
+CCG and BNF code, so every query is a couple of binary searches over
+memory-mapped arrays followed by a `bincount` to total the matching
+rows by month.  Responses are kept in an in-memory LRU cache.
+
+Endpoints (all return JSON; `from` and `to` are optional months, e.g.
+`2020-01` (a date, e.g. `2020-01-01`, means its month), and `group` is
+`month` (default) or `bnf_code`):
+
+    /ome/practice/<practice>?from=&to=&group=
+    /ome/ccg/<ccg>?from=&to=&group=
+    /ome/bnf_code/<bnf code or prefix>?from=&to=&group=
+
+Run with
+
+    python -m lib.ome_api <store path> [--port 8000]
+
+or inside the notebook container with `python run.py api`.  See
+`lib.ome_api_loadtest` for a load test.
+
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import sys
+import traceback
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from lib import columnar
+
+STORE_COLUMNS = ["month", "practice", "pct", "bnf_code", "quantity", "ome_dose"]
+VALUE_COLUMNS = ["quantity", "ome_dose"]
+
+# URL path segment -> store column
+KINDS = {"practice": "practice", "ccg": "pct", "bnf_code": "bnf_code"}
+GROUPS = ("month", "bnf_code")
+
+DEFAULT_CACHE_SIZE = 4096
+
+# BNF codes only contain digits and upper case letters, so appending this
+# to a prefix gives an upper bound for every code starting with it
+_UPPER_BOUND = "\x7f"
+
+
+def write_store(df, path):
+    """Write OME results with `STORE_COLUMNS` as a store at `path`
+    """
+    df = df[STORE_COLUMNS].copy()
+    df["month"] = df["month"].astype(str).str[:7]
+    # rows without a practice (code -1) go first, so the practice codes of
+    # all the rows are in order and can be binary searched
+    df = df.sort_values(["practice", "month"], kind="mergesort", na_position="first")
+    columnar.write_table(path, df.reset_index(drop=True))
+    table = columnar.open_table(path)
+    for column in ("pct", "bnf_code"):
+        codes = np.asarray(table.codes(column))
+        order = np.argsort(codes, kind="stable").astype(np.int64)
+        np.save(os.path.join(path, f"{column}.order.npy"), order)
+        np.save(os.path.join(path, f"{column}.sorted_codes.npy"), codes[order])
+
+
+class OMEStore:
+    """Query interface over a store written by `write_store`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.table = columnar.open_table(path)
+        self._values = {name: self.table.array(name) for name in VALUE_COLUMNS}
+        self._month_codes = self.table.codes("month")
+        self._months = self.table.dictionary("month")
+        self._indexes = {"practice": (None, self.table.codes("practice"))}
+        for column in ("pct", "bnf_code"):
+            self._indexes[column] = (
+                np.load(os.path.join(path, f"{column}.order.npy"), mmap_mode="r"),
+                np.load(
+                    os.path.join(path, f"{column}.sorted_codes.npy"), mmap_mode="r"
+                ),
+            )
+
+    def positions(self, column, value, start=None, end=None):
+        """Return the row positions matching `value` in `column` (a prefix
+        for BNF codes), within the month range if given
+        """
+        dictionary = self.table.dictionary(column)
+        if column == "bnf_code":
+            lo = np.searchsorted(dictionary, value, side="left")
+            hi = np.searchsorted(dictionary, value + _UPPER_BOUND, side="left")
+        else:
+            lo = np.searchsorted(dictionary, value, side="left")
+            hi = np.searchsorted(dictionary, value, side="right")
+        order, sorted_codes = self._indexes[column]
+        first = np.searchsorted(sorted_codes, lo, side="left")
+        last = np.searchsorted(sorted_codes, hi, side="left")
+        if order is None:
+            positions = np.arange(first, last)
+        else:
+            positions = np.asarray(order[first:last])
+
+        if start is not None or end is not None:
+            months = self._month_codes[positions]
+            lo_month = np.searchsorted(self._months, start or "", side="left")
+            hi_month = np.searchsorted(self._months, end or _UPPER_BOUND, side="right")
+            positions = positions[(months >= lo_month) & (months < hi_month)]
+        return positions
+
+    def summary(self, kind, value, start=None, end=None, group="month"):
+        """Return a list of totals of each value column for the rows
+        matching the query, one entry per `group`
+        """
+        column = KINDS[kind]
+        positions = self.positions(column, value, start, end)
+        if group == "month":
+            codes, labels = self._month_codes, self._months
+        else:
+            codes, labels = self.table.codes(group), self.table.dictionary(group)
+        group_codes = np.asarray(codes[positions])
+        present, inverse = np.unique(group_codes, return_inverse=True)
+        totals = {
+            name: np.bincount(
+                inverse, weights=values[positions], minlength=len(present)
+            )
+            for name, values in self._values.items()
+        }
+        return [
+            dict(
+                {group: str(labels[code])},
+                **{name: float(totals[name][i]) for name in totals},
+            )
+            for i, code in enumerate(present)
+        ]
+
+
+def parse_month(value):
+    """Return the month (`YYYY-MM`) of a month or date given as a query
+    parameter, or None if it's missing; raise ValueError if it's neither
+    """
+    if value is None or value == "":
+        return None
+    for format in ("%Y-%m", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, format).strftime("%Y-%m")
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def make_handler(store, cache_size=DEFAULT_CACHE_SIZE):
+    """Return a request handler class serving `store`
+    """
+
+    @functools.lru_cache(maxsize=cache_size)
+    def cached_response(kind, value, start, end, group):
+        rows = store.summary(kind, value, start=start, end=end, group=group)
+        return json.dumps(rows).encode("utf8")
+
+    class OMERequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                self._get()
+            except Exception:
+                # report the error rather than dropping the connection
+                traceback.print_exc(file=sys.stderr)
+                self._send(500, {"error": "Internal server error"})
+
+        def _get(self):
+            url = urllib.parse.urlsplit(self.path)
+            parts = [urllib.parse.unquote(p) for p in url.path.split("/") if p]
+            params = dict(urllib.parse.parse_qsl(url.query))
+            if len(parts) != 3 or parts[0] != "ome" or parts[1] not in KINDS:
+                self._send(404, {"error": "Not found"})
+                return
+            group = params.get("group", "month")
+            if group not in GROUPS:
+                self._send(400, {"error": f"group must be one of {list(GROUPS)}"})
+                return
+            months = {}
+            for name in ("from", "to"):
+                try:
+                    months[name] = parse_month(params.get(name))
+                except ValueError:
+                    self._send(400, {"error": f"{name} must be a month, e.g. 2020-01"})
+                    return
+            body = cached_response(
+                parts[1], parts[2], months["from"], months["to"], group
+            )
+            self._send(200, body)
+
+        def _send(self, status, body):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # logging every request would dominate the cost of serving it
+            pass
+
+    OMERequestHandler.cache_info = cached_response.cache_info
+    return OMERequestHandler
+
+
+def serve(store_path, host="0.0.0.0", port=8000, cache_size=DEFAULT_CACHE_SIZE):
+    server = ThreadingHTTPServer(
+        (host, port), make_handler(OMEStore(store_path), cache_size)
+    )
+    print(f"Serving OME results from {store_path} on http://{host}:{port}/ome/")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve OME results over HTTP")
+    parser.add_argument("store", help="path to a store written by write_store")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE)
+    args = parser.parse_args()
+    serve(args.store, args.host, args.port, args.cache_size)
+
+
+if __name__ == "__main__":
+    main()
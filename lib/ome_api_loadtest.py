@@ -0,0 +1,79 @@
+"""A simple load test for the OME API (`lib.ome_api`).
+
+Requests random practice, CCG and BNF code queries drawn from the store
+being served, from several threads at once, and reports throughput and
+latency percentiles:
+
+    python -m lib.ome_api_loadtest <store path> --url http://localhost:8000 \
+        --requests 5000 --concurrency 16
+
+A small pool of distinct queries (`--distinct`) exercises the response
+cache; a large one mostly measures uncached queries.
+
+"""
+import argparse
+import concurrent.futures
+import random
+import time
+import urllib.request
+
+import numpy as np
+
+from lib import columnar
+
+
+def sample_paths(store_path, count, seed=0):
+    """Return `count` query paths for values that exist in the store
+    """
+    table = columnar.open_table(store_path)
+    months = list(table.dictionary("month"))
+    choices = {
+        "practice": list(table.dictionary("practice")),
+        "ccg": list(table.dictionary("pct")),
+        "bnf_code": [code[:9] for code in table.dictionary("bnf_code")],
+    }
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        kind = rng.choice(list(choices))
+        start, end = sorted(rng.sample(months, 2)) if len(months) > 1 else (None, None)
+        path = f"/ome/{kind}/{rng.choice(choices[kind])}"
+        if start:
+            path += f"?from={start}&to={end}"
+        paths.append(path)
+    return paths
+
+
+def fetch(url):
+    started = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def run(base_url, paths, requests, concurrency, seed=0):
+    rng = random.Random(seed)
+    urls = [base_url + rng.choice(paths) for _ in range(requests)]
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(fetch, urls)))
+    elapsed = time.perf_counter() - started
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+    print(f"{requests} requests in {elapsed:.2f}s: {requests / elapsed:.0f} req/s")
+    print(f"latency ms: p50={p50:.1f} p95={p95:.1f} p99={p99:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the OME API")
+    parser.add_argument("store", help="path to the store being served")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--distinct", type=int, default=500)
+    args = parser.parse_args()
+    paths = sample_paths(args.store, args.distinct)
+    run(args.url.rstrip("/"), paths, args.requests, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""Light-weight charts of OME time series.
+
+Plotting every practice's OME for every month puts tens of thousands of
+points in each figure, which makes notebooks slow to render and their
+saved outputs (which nbval compares) large.  This module keeps figures
+small in three ways:
+
+* series are downsampled before plotting, with largest-triangle-three-
+  buckets (`lttb`, which keeps the visual shape of a line) or the
+  minimum and maximum of each bucket (`minmax`, which keeps every
+  spike);
+* decile fan charts are drawn from precomputed percentiles (e.g. from
+  `percentiles_from_rates`, or a percentile query in BigQuery), one
+  value per month and percentile, rather than from every organisation's
+  series;
+* `cached_figure` renders a figure to PNG once and keeps it on disk,
+  keyed on a fingerprint of the data and the drawing parameters, so
+  re-running a notebook doesn't redraw unchanged charts:
+
+    cached_figure(fan_chart, percentiles, title="OME per 1000 patients")
+
+"""
+import functools
+import hashlib
+import io
+import os
+import warnings
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from IPython.display import Image
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", ".chart_cache")
+DEFAULT_MAX_POINTS = 500
+DECILES = tuple(range(10, 100, 10))
+
+
+def _numeric(x):
+    """Return `x` as floats, with dates as nanoseconds since the epoch
+    """
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype("datetime64[ns]").astype(np.int64).astype("float64")
+    if x.dtype == object:
+        return _numeric(pd.to_datetime(x))
+    return x.astype("float64")
+
+
+def lttb(x, y, n_out):
+    """Return the positions of `n_out` points of (x, y), chosen by
+    largest-triangle-three-buckets, in order
+
+    The first and last points are always kept; the rest are split into
+    `n_out - 2` buckets, and from each the point forming the largest
+    triangle with the previous kept point and the average of the next
+    bucket is kept.
+
+    """
+    x = _numeric(x)
+    y = np.asarray(y, dtype="float64")
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    positions = np.empty(n_out, dtype=np.int64)
+    positions[0] = 0
+    positions[-1] = n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[stop:next_stop].mean()
+        next_y = y[stop:next_stop].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        positions[i + 1] = previous
+    return positions
+
+
+def minmax(x, y, n_out):
+    """Return the positions of the smallest and largest values of y in
+    each of `n_out // 2` buckets, plus the first and last points, in
+    order
+    """
+    y = np.asarray(y, dtype="float64")
+    n = len(y)
+    n_buckets = max(n_out // 2, 1)
+    if n_out >= n:
+        return np.arange(n)
+    buckets = np.minimum(np.arange(n) * n_buckets // n, n_buckets - 1)
+    order = np.lexsort((y, buckets))
+    starts = np.searchsorted(buckets[order], np.arange(n_buckets))
+    stops = np.r_[starts[1:], n]
+    keep = np.r_[order[starts], order[stops - 1], 0, n - 1]
+    return np.unique(keep)
+
+
+METHODS = {"lttb": lttb, "minmax": minmax}
+
+
+def downsample(x, y, max_points=DEFAULT_MAX_POINTS, method="lttb"):
+    """Return (x, y) reduced to at most about `max_points` points, with
+    missing values of y dropped
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype="float64")
+    present = ~np.isnan(y)
+    x, y = x[present], y[present]
+    positions = METHODS[method](x, y, max_points)
+    return x[positions], y[positions]
+
+
+def plot_series(ax, x, y, max_points=DEFAULT_MAX_POINTS, method="lttb", **plot_kwargs):
+    """Plot a downsampled line of (x, y) on `ax`
+    """
+    x, y = downsample(x, y, max_points, method)
+    return ax.plot(x, y, **plot_kwargs)
+
+
+def percentiles_from_rates(rates, percentiles=DECILES):
+    """Return a dataframe of the given percentiles of rate across
+    organisations, with `month`, `percentile` and `value` columns, from
+    `lib.rates.Rates`
+    """
+    with warnings.catch_warnings():
+        # months without any rates are NaN, as intended
+        warnings.filterwarnings("ignore", "All-NaN slice", RuntimeWarning)
+        values = np.nanpercentile(rates.rate, percentiles, axis=1)
+    return pd.DataFrame(
+        {
+            "month": np.tile(rates.months.codes, len(percentiles)),
+            "percentile": np.repeat(percentiles, len(rates.months)),
+            "value": values.ravel(),
+        }
+    )
+
+
+def fan_chart(ax, percentiles, highlight=None, highlight_label=None, title=None):
+    """Draw a decile fan chart on `ax` from precomputed percentiles, with
+    `month`, `percentile` and `value` columns
+
+    Each pair of percentiles symmetric about the median (10th and 90th,
+    20th and 80th, ...) is shaded, darker towards the middle, and the
+    median drawn as a line.  `highlight` is an optional series of values
+    by month for one organisation, drawn on top.
+
+    """
+    table = percentiles.pivot(index="month", columns="percentile", values="value")
+    table = table.sort_index()
+    months = pd.to_datetime(table.index)
+    levels = sorted(table.columns)
+    pairs = [
+        (low, high)
+        for low, high in zip(levels, reversed(levels))
+        if low < high and low + high == 100
+    ]
+    for i, (low, high) in enumerate(pairs):
+        ax.fill_between(
+            months,
+            table[low],
+            table[high],
+            color="tab:blue",
+            alpha=0.15 + 0.1 * i,
+            linewidth=0,
+            label=f"{low}th-{high}th percentile",
+        )
+    if 50 in table.columns:
+        ax.plot(months, table[50], color="tab:blue", linestyle="--", label="median")
+    if highlight is not None:
+        highlight = highlight.sort_index()
+        ax.plot(
+            pd.to_datetime(highlight.index),
+            highlight.to_numpy(),
+            color="tab:red",
+            label=highlight_label,
+        )
+    if title:
+        ax.set_title(title)
+    ax.set_ylim(bottom=0)
+    ax.legend(loc="upper left", fontsize="small")
+    return ax
+
+
+def fingerprint(*data, **params):
+    """Return a hex digest of dataframes, series, arrays and parameters
+    """
+    digest = hashlib.sha256()
+    for item in data:
+        _update(digest, item)
+    for name, value in sorted(params.items()):
+        digest.update(name.encode("utf8"))
+        _update(digest, value)
+    return digest.hexdigest()
+
+
+def _update(digest, item):
+    if isinstance(item, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(item).to_numpy().tobytes())
+        columns = item.columns if isinstance(item, pd.DataFrame) else [item.name]
+        digest.update(repr(list(columns)).encode("utf8"))
+    elif isinstance(item, np.ndarray):
+        digest.update(str(item.dtype).encode("utf8"))
+        digest.update(np.ascontiguousarray(item).tobytes())
+    else:
+        digest.update(repr(item).encode("utf8"))
+
+
+def _drawing(draw):
+    """Return the name of a drawing function and, if it has any, its
+    bytecode and constants, so that a changed function draws afresh
+    """
+    if isinstance(draw, functools.partial):
+        return _drawing(draw.func) + (draw.args, sorted(draw.keywords.items()))
+    name = getattr(draw, "__qualname__", type(draw).__qualname__)
+    code = getattr(draw, "__code__", None)
+    if code is None:
+        return (f"{draw.__module__}.{name}",)
+    return f"{draw.__module__}.{name}", code.co_code, code.co_consts
+
+
+def cached_figure(
+    draw, *data, cache_dir=DEFAULT_CACHE_DIR, figsize=(10, 5), dpi=80, **params
+):
+    """Return an `IPython.display.Image` of `draw(ax, *data, **params)`,
+    rendering it only if the same drawing of the same data isn't already
+    in `cache_dir`
+    """
+    key = fingerprint(*_drawing(draw), *data, figsize=figsize, dpi=dpi, **params)
+    path = os.path.join(cache_dir, f"{key}.png")
+    if not os.path.exists(path):
+        fig, ax = plt.subplots(figsize=figsize)
+        draw(ax, *data, **params)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=dpi, bbox_inches="tight")
+        plt.close(fig)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+    return Image(filename=path)
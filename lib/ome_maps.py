@@ -0,0 +1,265 @@
+"""Precomputed choropleth maps of OME rates by CCG (or region).
+
+Drawing a map of OME by CCG with `ebmdatalab.maps` means joining the
+rates to the boundary shapes and re-aggregating for every month drawn.
+Here the work is split into stages which are each done once:
+
+* `write_geometry` simplifies the boundaries in a GeoJSON file
+  (Douglas-Peucker, per ring) and stores them as flat numpy arrays,
+  sorted by organisation code -- the geometry index;
+* `write_map_rates` aligns a `lib.rates.Rates` with that index, giving
+  a months x shapes array of rates;
+* `ChoroplethMap` classes every rate into a colour bin once, so drawing
+  a month (or animating across months) only looks up each shape's
+  colour and updates the face colours of an existing collection.
+
+    write_geometry("ccg_boundaries.geojson", "data/ccg_geometry", "ccg_code")
+    write_map_rates(compute_rates(ome, denominators), "data/ccg_geometry",
+                    "data/ccg_ome_map")
+    ChoroplethMap("data/ccg_ome_map", "data/ccg_geometry").draw(ax, "2020-01-01")
+
+"""
+import json
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib import animation
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+
+DEFAULT_TOLERANCE = 0.001
+MISSING_COLOUR = (0.85, 0.85, 0.85, 1.0)
+
+
+def simplify_ring(coords, tolerance=DEFAULT_TOLERANCE):
+    """Return the points of a closed ring kept by Douglas-Peucker
+    simplification with `tolerance` (in the units of the coordinates)
+    """
+    coords = np.asarray(coords, dtype="float64")
+    n = len(coords)
+    if n <= 4:
+        return coords
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    # split the ring at the point furthest from its start, so each half
+    # is a line with distinct ends
+    far = int(np.argmax(((coords - coords[0]) ** 2).sum(axis=1)))
+    keep[far] = True
+    stack = [(0, far), (far, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = coords[start], coords[end]
+        points = coords[start + 1 : end]
+        direction = b - a
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(*(points - a).T)
+        else:
+            distances = (
+                np.abs(
+                    direction[0] * (points[:, 1] - a[1])
+                    - direction[1] * (points[:, 0] - a[0])
+                )
+                / length
+            )
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            middle = start + 1 + furthest
+            keep[middle] = True
+            stack.extend([(start, middle), (middle, end)])
+    simplified = coords[keep]
+    if len(simplified) < 4:
+        # too small to survive simplification; keep its outline
+        return coords[np.linspace(0, n - 1, 4).astype(int)]
+    return simplified
+
+
+def _polygons(geometry):
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    raise ValueError(f"Unsupported geometry type {geometry['type']}")
+
+
+def write_geometry(
+    geojson_path, path, code_property, name_property=None, tolerance=DEFAULT_TOLERANCE
+):
+    """Simplify the boundaries in a GeoJSON file and store them at `path`
+    as a geometry index, one shape per organisation code
+    """
+    with open(geojson_path) as f:
+        features = json.load(f)["features"]
+    features = sorted(
+        features, key=lambda feature: str(feature["properties"][code_property])
+    )
+    coords, ring_offsets, shape_offsets = [], [0], [0]
+    for feature in features:
+        for polygon in _polygons(feature["geometry"]):
+            for ring in polygon:
+                ring = simplify_ring(ring, tolerance)
+                coords.append(ring[:, :2])
+                ring_offsets.append(ring_offsets[-1] + len(ring))
+        shape_offsets.append(len(ring_offsets) - 1)
+
+    os.makedirs(path, exist_ok=True)
+    codes = np.array(
+        [str(feature["properties"][code_property]) for feature in features]
+    )
+    np.save(os.path.join(path, "codes.npy"), codes)
+    if name_property:
+        names = [
+            str(feature["properties"].get(name_property, "")) for feature in features
+        ]
+        np.save(os.path.join(path, "names.npy"), np.array(names))
+    np.save(os.path.join(path, "coords.npy"), np.concatenate(coords))
+    np.save(
+        os.path.join(path, "ring_offsets.npy"), np.array(ring_offsets, dtype=np.int64)
+    )
+    np.save(
+        os.path.join(path, "shape_offsets.npy"), np.array(shape_offsets, dtype=np.int64)
+    )
+
+
+class Geometry:
+    """A geometry index written by `write_geometry`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.codes = np.load(os.path.join(path, "codes.npy"))
+        names_path = os.path.join(path, "names.npy")
+        self.names = np.load(names_path) if os.path.exists(names_path) else None
+        self.coords = np.load(os.path.join(path, "coords.npy"), mmap_mode="r")
+        self.ring_offsets = np.load(os.path.join(path, "ring_offsets.npy"))
+        self.shape_offsets = np.load(os.path.join(path, "shape_offsets.npy"))
+        self._paths = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def paths(self):
+        """Return a matplotlib `Path` for each shape, with one closed
+        sub-path per ring
+        """
+        if self._paths is None:
+            self._paths = []
+            for shape in range(len(self.codes)):
+                rings = range(self.shape_offsets[shape], self.shape_offsets[shape + 1])
+                vertices, codes = [], []
+                for ring in rings:
+                    points = np.asarray(
+                        self.coords[
+                            self.ring_offsets[ring] : self.ring_offsets[ring + 1]
+                        ]
+                    )
+                    ring_codes = np.full(len(points), Path.LINETO, dtype=Path.code_type)
+                    ring_codes[0] = Path.MOVETO
+                    ring_codes[-1] = Path.CLOSEPOLY
+                    vertices.append(points)
+                    codes.append(ring_codes)
+                self._paths.append(
+                    Path(np.concatenate(vertices), np.concatenate(codes))
+                )
+        return self._paths
+
+    def bounds(self):
+        """Return (min x, min y, max x, max y) of every shape together
+        """
+        coords = np.asarray(self.coords)
+        return (*coords.min(axis=0), *coords.max(axis=0))
+
+
+def write_map_rates(rates, geometry_path, path):
+    """Store the rates in `rates` (a `lib.rates.Rates`) at `path`, as a
+    months x shapes array aligned with the geometry index at
+    `geometry_path`, with NaN for shapes without a rate
+    """
+    geometry = Geometry(geometry_path)
+    columns = rates.orgs.encode(geometry.codes)
+    aligned = np.where(columns >= 0, rates.rate[:, np.maximum(columns, 0)], np.nan)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "rates.npy"), aligned.astype("float32"))
+    np.save(os.path.join(path, "months.npy"), np.asarray(rates.months.codes))
+    np.save(os.path.join(path, "codes.npy"), geometry.codes)
+
+
+class ChoroplethMap:
+    """Colour lookup over precomputed rates, for drawing or animating a
+    choropleth of any month
+
+    Rates are classed into `bins` (default: the deciles of every rate in
+    every month, so colours are comparable across months), and each bin
+    given a colour from `cmap`.
+
+    """
+
+    def __init__(self, map_path, geometry_path, cmap="viridis", bins=None):
+        self.geometry = Geometry(geometry_path)
+        self.rates = np.load(os.path.join(map_path, "rates.npy"), mmap_mode="r")
+        self.months = np.load(os.path.join(map_path, "months.npy"))
+        codes = np.load(os.path.join(map_path, "codes.npy"))
+        if not np.array_equal(codes, self.geometry.codes):
+            raise ValueError("Rates were aligned with a different geometry index")
+        rates = np.asarray(self.rates)
+        if bins is None:
+            present = rates[~np.isnan(rates)]
+            bins = (
+                np.unique(np.percentile(present, np.arange(10, 100, 10)))
+                if len(present)
+                else []
+            )
+        self.bins = np.asarray(bins)
+        colours = plt.get_cmap(cmap)(np.linspace(0, 1, len(self.bins) + 1))
+        # the last entry is for missing rates
+        self.palette = np.vstack([colours, MISSING_COLOUR])
+        self.classes = np.digitize(rates, self.bins).astype(np.uint8)
+        self.classes[np.isnan(rates)] = len(self.palette) - 1
+        self._collections = {}
+
+    def month_index(self, month):
+        position = np.searchsorted(self.months, month)
+        if position == len(self.months) or self.months[position] != month:
+            raise KeyError(f"No rates for {month}")
+        return position
+
+    def colours(self, month):
+        """Return the RGBA colour of every shape for `month`
+        """
+        return self.palette[self.classes[self.month_index(month)]]
+
+    def draw(self, ax, month, title=None):
+        """Draw (or redraw) the map for `month` on `ax`
+        """
+        collection = self._collections.get(ax)
+        if collection is None:
+            collection = PathCollection(
+                self.geometry.paths(), edgecolor="white", linewidth=0.2
+            )
+            ax.add_collection(collection)
+            x0, y0, x1, y1 = self.geometry.bounds()
+            ax.set_xlim(x0, x1)
+            ax.set_ylim(y0, y1)
+            ax.set_aspect(1 / np.cos(np.radians((y0 + y1) / 2)))
+            ax.set_axis_off()
+            self._collections[ax] = collection
+        collection.set_facecolor(self.colours(month))
+        ax.set_title(title or month)
+        return collection
+
+    def animate(self, fig=None, ax=None, months=None, interval=500):
+        """Return a `matplotlib.animation.FuncAnimation` of the map over
+        `months` (default: all)
+        """
+        if ax is None:
+            fig, ax = plt.subplots(figsize=(6, 8))
+        months = list(self.months if months is None else months)
+        return animation.FuncAnimation(
+            fig or ax.figure,
+            lambda i: [self.draw(ax, months[i])],
+            frames=len(months),
+            interval=interval,
+        )
@@ -0,0 +1,884 @@
+"""The OME measure as a declarative plan, runnable in SQL or locally.
+
+The measure has been defined twice: as the BigQuery SQL in the DMD
+notebook, and step by step in `lib.ome`.  Here it is defined once, as a
+small plan of relations (tables, filters, derived columns, joins,
+aggregations) over expressions (columns, literals, arithmetic, CASE
+rules, the BNF code substrings used in the join), with two executors:
+
+* `to_sql` generates a query, one CTE per step of the plan.  Each table
+  is read with only the columns the plan declares for it, and filters
+  on a table are applied in the same step that reads it, so BigQuery
+  only scans (and bills for) the columns and partitions used.  Dialect
+  differences -- `CONCAT` vs `||`, `STRPOS` vs `INSTR`, integer division
+  -- are handled by the generator, so the plan only says what it means;
+* `execute` runs the plan on dataframes.  Expressions over a single
+  string column (the join keys, the form rules) are evaluated once per
+  distinct value rather than once per row, and each step's result is
+  reused if the plan refers to it more than once.
+
+So the same definition can be run wherever is cheaper:
+
+    plan = ome_plan(by=("month", "pct"), start="2020-01-01", end="2020-12-01")
+    sql = to_sql(plan)                         # for bq.cached_read
+    df = execute(plan, {"prescribing": rx, "vpi": vpi, ...})
+
+`parity_check` runs a plan both ways on the same data -- locally, and as
+generated SQL in an in-memory SQLite database -- and raises an
+`AssertionError` if the results differ.
+
+"""
+import functools
+import operator
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from lib.ome import (
+    BUPRENORPHINE,
+    BUPRENORPHINE_4_DAY_STRENGTHS,
+    BUPRENORPHINE_7_DAY_STRENGTHS,
+    EXCLUDED_PREFIXES,
+    FENTANYL,
+    FENTANYL_PATCH_HOURS,
+)
+from lib.spill import SpillingAggregator
+
+# BigQuery tables for each source in `ome_plan`
+BIGQUERY_TABLES = {
+    "prescribing": "ebmdatalab.hscic.normalised_prescribing",
+    "vpi": "ebmdatalab.dmd.vpi",
+    "ing": "ebmdatalab.dmd.ing",
+    "vmp": "ebmdatalab.dmd.vmp",
+    "ont": "ebmdatalab.dmd.ont",
+    "ontformroute": "ebmdatalab.dmd.ontformroute",
+    "unitofmeasure": "ebmdatalab.dmd.unitofmeasure",
+    "opioid_class": "ebmdatalab.richard.opioid_class",
+}
+
+
+# Expressions
+
+
+class Expr:
+    """A scalar expression over the columns of a relation
+    """
+
+    def __mul__(self, other):
+        return BinaryOp("*", self, _expr(other))
+
+    def __rmul__(self, other):
+        return BinaryOp("*", _expr(other), self)
+
+    def __truediv__(self, other):
+        return BinaryOp("/", self, _expr(other))
+
+    def __add__(self, other):
+        return BinaryOp("+", self, _expr(other))
+
+    def __sub__(self, other):
+        return BinaryOp("-", self, _expr(other))
+
+    def __eq__(self, other):
+        return BinaryOp("=", self, _expr(other))
+
+    def __ne__(self, other):
+        return BinaryOp("!=", self, _expr(other))
+
+    def __le__(self, other):
+        return BinaryOp("<=", self, _expr(other))
+
+    def __ge__(self, other):
+        return BinaryOp(">=", self, _expr(other))
+
+    def __and__(self, other):
+        return BinaryOp("AND", self, _expr(other))
+
+    def __or__(self, other):
+        return BinaryOp("OR", self, _expr(other))
+
+    def __invert__(self):
+        return Not(self)
+
+    def isin(self, values):
+        return IsIn(self, values)
+
+    def startswith(self, prefix):
+        return StartsWith(self, prefix)
+
+    def contains(self, text):
+        return Contains(self, text)
+
+    def after(self, separator):
+        return After(self, separator)
+
+    def substr(self, start, length):
+        return Substr(self, start, length)
+
+    def coalesce(self, default):
+        return Coalesce(self, _expr(default))
+
+    __hash__ = None
+
+
+class Column(Expr):
+    def __init__(self, name):
+        self.name = name
+        self.children = ()
+
+
+class Literal(Expr):
+    def __init__(self, value):
+        self.value = value
+        self.children = ()
+
+
+class BinaryOp(Expr):
+    def __init__(self, op, left, right):
+        self.op = op
+        self.children = (left, right)
+
+
+class Not(Expr):
+    def __init__(self, operand):
+        self.children = (operand,)
+
+
+class IsIn(Expr):
+    def __init__(self, operand, values):
+        self.values = list(values)
+        self.children = (operand,)
+
+
+class StartsWith(Expr):
+    def __init__(self, operand, prefix):
+        self.prefix = prefix
+        self.children = (operand,)
+
+
+class Contains(Expr):
+    def __init__(self, operand, text):
+        self.text = text
+        self.children = (operand,)
+
+
+class After(Expr):
+    """The part of a string after the first `separator` (or all of it, if
+    there isn't one)
+    """
+
+    def __init__(self, operand, separator):
+        self.separator = separator
+        self.children = (operand,)
+
+
+class Substr(Expr):
+    """`length` characters from 1-based position `start`, or from the end
+    if `start` is negative (as SQL `SUBSTR`)
+    """
+
+    def __init__(self, operand, start, length):
+        if start == 0:
+            raise ValueError("Substring positions start at 1")
+        self.start = start
+        self.length = length
+        self.children = (operand,)
+
+
+class Concat(Expr):
+    def __init__(self, *parts):
+        self.children = tuple(_expr(part) for part in parts)
+
+
+class Coalesce(Expr):
+    def __init__(self, operand, default):
+        self.children = (operand, default)
+
+
+class Case(Expr):
+    """The value for the first of `whens` (a list of (condition, value))
+    whose condition holds, else `default`
+    """
+
+    def __init__(self, whens, default=None):
+        self.whens = [(_expr(when), _expr(value)) for when, value in whens]
+        self.default = _expr(default)
+        self.children = tuple(e for pair in self.whens for e in pair) + (self.default,)
+
+
+def col(name):
+    return Column(name)
+
+
+def lit(value):
+    return Literal(value)
+
+
+def _expr(value):
+    return value if isinstance(value, Expr) else Literal(value)
+
+
+def expr_columns(expr):
+    """Return the names of the columns used in `expr`
+    """
+    if isinstance(expr, Column):
+        return {expr.name}
+    return set().union(*(expr_columns(child) for child in expr.children))
+
+
+# Relations.  Each is a plain object holding its inputs and parameters,
+# and the names of its output columns.
+
+
+class Table:
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = list(columns)
+        self.inputs = ()
+
+
+class Filter:
+    def __init__(self, input, predicate):
+        self.predicate = predicate
+        self.columns = input.columns
+        self.inputs = (input,)
+
+
+class Derive:
+    """Adds (or replaces) columns
+    """
+
+    def __init__(self, input, **exprs):
+        self.exprs = exprs
+        self.columns = [c for c in input.columns if c not in exprs] + list(exprs)
+        self.inputs = (input,)
+
+
+class Select:
+    """Only the given columns, as {name: expression} or a list of names
+    """
+
+    def __init__(self, input, exprs):
+        if not isinstance(exprs, dict):
+            exprs = {name: col(name) for name in exprs}
+        self.exprs = exprs
+        self.columns = list(exprs)
+        self.inputs = (input,)
+
+
+class Distinct:
+    def __init__(self, input):
+        self.columns = input.columns
+        self.inputs = (input,)
+
+
+class Join:
+    """Rows of `left` and `right` where each pair of expressions in `on`
+    (over left and right columns respectively) is equal; `how` is
+    "inner" or "left"
+    """
+
+    def __init__(self, left, right, on, how="inner"):
+        shared = set(left.columns) & set(right.columns)
+        if shared:
+            raise ValueError(f"Both sides of a join have columns {sorted(shared)}")
+        if how not in ("inner", "left"):
+            raise ValueError(f"Unsupported join {how!r}")
+        self.on = [
+            (_expr(left_expr), _expr(right_expr)) for left_expr, right_expr in on
+        ]
+        self.how = how
+        self.columns = left.columns + right.columns
+        self.inputs = (left, right)
+
+
+class Aggregate:
+    """Sums of `sums` ({name: expression}) grouped by the `by` columns
+    """
+
+    def __init__(self, input, by, sums):
+        self.by = list(by)
+        self.sums = sums
+        self.columns = self.by + list(sums)
+        self.inputs = (input,)
+
+
+def ome_plan(
+    by=("month", "practice", "pct", "bnf_code", "bnf_name"), start=None, end=None
+):
+    """Return the plan for total quantity and OME dose by `by` and
+    ingredient, as the main query in the DMD notebook, optionally for
+    months `start` to `end` (inclusive)
+    """
+    by = list(by)
+
+    # the `simp_form` subquery: one simplified route per VMP
+    descr = col("descr")
+    forms = Join(
+        Table("ont", ["vmp", "form"]),
+        Table("ontformroute", ["cd", "descr"]),
+        on=[(col("form"), col("cd"))],
+    )
+    simple_forms = Distinct(
+        Select(
+            forms,
+            {
+                "form_vmp": col("vmp"),
+                "simple_form": Case(
+                    [
+                        (descr.contains("injection"), "injection"),
+                        (descr.contains("infusion"), "injection"),
+                        (descr == "filmbuccal.buccal", "film"),
+                    ],
+                    descr.after("."),
+                ),
+            },
+        )
+    )
+
+    # the `norm_vpi` subquery: strengths in mg and ml
+    units = Table("unitofmeasure", ["cd", "descr"])
+    vpi = Join(
+        Join(
+            Table(
+                "vpi",
+                [
+                    "vmp",
+                    "ing",
+                    "strnt_nmrtr_val",
+                    "strnt_nmrtr_uom",
+                    "strnt_dnmtr_val",
+                    "strnt_dnmtr_uom",
+                ],
+            ),
+            Select(units, {"num_cd": col("cd"), "num_unit": col("descr")}),
+            on=[(col("strnt_nmrtr_uom"), col("num_cd"))],
+            how="left",
+        ),
+        Select(units, {"den_cd": col("cd"), "den_unit": col("descr")}),
+        on=[(col("strnt_dnmtr_uom"), col("den_cd"))],
+        how="left",
+    )
+    numerator, denominator = col("strnt_nmrtr_val"), col("strnt_dnmtr_val")
+    vpi = Derive(
+        vpi,
+        strnt_nmrtr_val_mg=Case(
+            [
+                (col("num_unit") == "microgram", numerator / 1000),
+                (col("num_unit") == "gram", numerator * 1000),
+                (col("num_unit") == "mg", numerator),
+            ]
+        ),
+        strnt_dnmtr_val_ml=Case(
+            [
+                (col("den_unit") == "litre", denominator * 1000),
+                (col("den_unit") == "ml", denominator),
+            ]
+        ),
+    )
+
+    # ingredient factors: mg of each opioid ingredient per unit of quantity
+    factors = Join(
+        Join(
+            Join(
+                Join(
+                    vpi,
+                    Select(
+                        Table("ing", ["id", "nm"]),
+                        {"ing_id": col("id"), "nm": col("nm")},
+                    ),
+                    on=[(col("ing"), col("ing_id"))],
+                ),
+                Select(
+                    Table("vmp", ["id", "bnf_code", "udfs"]),
+                    {
+                        "vmp_id": col("id"),
+                        "vmp_bnf_code": col("bnf_code"),
+                        "udfs": col("udfs"),
+                    },
+                ),
+                on=[(col("vmp"), col("vmp_id"))],
+            ),
+            simple_forms,
+            on=[(col("vmp_id"), col("form_vmp"))],
+        ),
+        Select(
+            Table("opioid_class", ["id", "form", "ome"]),
+            {"class_id": col("id"), "class_form": col("form"), "ome": col("ome")},
+        ),
+        on=[(col("ing_id"), col("class_id")), (col("simple_form"), col("class_form"))],
+    )
+    mg = col("strnt_nmrtr_val_mg")
+    per_ml = col("strnt_dnmtr_val_ml").coalesce(1)
+    transdermal = col("simple_form") == "transdermal"
+    buprenorphine_patch = transdermal & (col("ing_id") == BUPRENORPHINE)
+    factors = Derive(
+        factors,
+        mg_per_unit=Case(
+            [
+                (
+                    transdermal & (col("ing_id") == FENTANYL),
+                    mg * FENTANYL_PATCH_HOURS / per_ml,
+                ),
+                (
+                    buprenorphine_patch & numerator.isin(BUPRENORPHINE_7_DAY_STRENGTHS),
+                    mg * 168 / per_ml,
+                ),
+                (
+                    buprenorphine_patch & numerator.isin(BUPRENORPHINE_4_DAY_STRENGTHS),
+                    mg * 96 / per_ml,
+                ),
+                (col("simple_form") == "injection", mg * col("udfs") / per_ml),
+            ],
+            mg / per_ml,
+        ),
+    )
+
+    # prescribing, joined to generic VMPs on the concatenated BNF code key
+    bnf_code = col("bnf_code")
+    conditions = [~bnf_code.startswith(prefix) for prefix in EXCLUDED_PREFIXES]
+    if start is not None:
+        conditions.append(col("month") >= start)
+    if end is not None:
+        conditions.append(col("month") <= end)
+    predicate = functools.reduce(operator.and_, conditions)
+    # the month range may be on a column that isn't grouped by
+    rx_columns = by + ["bnf_code", "quantity"] + sorted(expr_columns(predicate))
+    rx = Filter(Table("prescribing", list(dict.fromkeys(rx_columns))), predicate)
+    vmp_bnf_code = col("vmp_bnf_code")
+    joined = Join(
+        rx,
+        factors,
+        on=[
+            (
+                Concat(bnf_code.substr(1, 9), "AA", bnf_code.substr(-2, 2)),
+                Concat(vmp_bnf_code.substr(1, 11), vmp_bnf_code.substr(-2, 2)),
+            )
+        ],
+    )
+    return Aggregate(
+        joined,
+        by + ["ing_id", "nm", "ome"],
+        {
+            "quantity": col("quantity"),
+            "ome_dose": col("quantity") * col("ome") * col("mg_per_unit"),
+        },
+    )
+
+
+# SQL generation
+
+
+class BigQueryDialect:
+    def table(self, name):
+        return f"`{name}`"
+
+    def concat(self, parts):
+        return f"CONCAT({', '.join(parts)})"
+
+    def position(self, text, search):
+        return f"STRPOS({text}, {search})"
+
+    def divide(self, left, right):
+        return f"({left} / {right})"
+
+
+class SQLiteDialect:
+    def table(self, name):
+        return f'"{name}"'
+
+    def concat(self, parts):
+        return f"({' || '.join(parts)})"
+
+    def position(self, text, search):
+        return f"INSTR({text}, {search})"
+
+    def divide(self, left, right):
+        # SQLite divides integers by integers as integers
+        return f"(CAST({left} AS REAL) / {right})"
+
+
+DIALECTS = {"bigquery": BigQueryDialect(), "sqlite": SQLiteDialect()}
+
+
+def _literal_sql(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        escaped = value.replace("'", "''")
+        return f"'{escaped}'"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return repr(value)
+
+
+def expr_sql(expr, dialect, alias=None):
+    """Return `expr` as SQL in `dialect`, with columns qualified by
+    `alias` if given
+    """
+    if isinstance(dialect, str):
+        dialect = DIALECTS[dialect]
+
+    def sql(e):
+        return expr_sql(e, dialect, alias)
+
+    if isinstance(expr, Column):
+        return f"{alias}.{expr.name}" if alias else expr.name
+    if isinstance(expr, Literal):
+        return _literal_sql(expr.value)
+    if isinstance(expr, BinaryOp):
+        left, right = (sql(child) for child in expr.children)
+        if expr.op == "/":
+            return dialect.divide(left, right)
+        return f"({left} {expr.op} {right})"
+    operand = sql(expr.children[0]) if expr.children else None
+    if isinstance(expr, Not):
+        return f"(NOT {operand})"
+    if isinstance(expr, IsIn):
+        values = ", ".join(_literal_sql(value) for value in expr.values)
+        return f"({operand} IN ({values}))"
+    if isinstance(expr, StartsWith):
+        return (
+            f"(SUBSTR({operand}, 1, {len(expr.prefix)}) = "
+            f"{_literal_sql(expr.prefix)})"
+        )
+    if isinstance(expr, Contains):
+        return f"({dialect.position(operand, _literal_sql(expr.text))} > 0)"
+    if isinstance(expr, After):
+        position = dialect.position(operand, _literal_sql(expr.separator))
+        return f"SUBSTR({operand}, {position} + {len(expr.separator)})"
+    if isinstance(expr, Substr):
+        return f"SUBSTR({operand}, {expr.start}, {expr.length})"
+    if isinstance(expr, Concat):
+        return dialect.concat([sql(child) for child in expr.children])
+    if isinstance(expr, Coalesce):
+        return f"COALESCE({operand}, {sql(expr.children[1])})"
+    if isinstance(expr, Case):
+        whens = " ".join(
+            f"WHEN {sql(when)} THEN {sql(value)}" for when, value in expr.whens
+        )
+        return f"CASE {whens} ELSE {sql(expr.default)} END"
+    raise TypeError(f"Unsupported expression {type(expr).__name__}")
+
+
+def to_sql(plan, dialect="bigquery", tables=None):
+    """Return SQL for `plan`, with each `Table` read from `tables[name]`
+    (default: `BIGQUERY_TABLES` for BigQuery, and the plan's own table
+    names otherwise)
+    """
+    if tables is None:
+        tables = BIGQUERY_TABLES if dialect == "bigquery" else {}
+    dialect = DIALECTS[dialect]
+    steps = []
+    names = {}
+
+    def read(table):
+        name = dialect.table(tables.get(table.name, table.name))
+        return f"SELECT {', '.join(table.columns)}\nFROM {name}"
+
+    def select(exprs, source):
+        columns = ",\n  ".join(
+            name
+            if isinstance(expr, Column) and expr.name == name
+            else f"{expr_sql(expr, dialect)} AS {name}"
+            for name, expr in exprs.items()
+        )
+        return f"SELECT\n  {columns}\nFROM {source}"
+
+    def step_sql(node):
+        if isinstance(node, Table):
+            return read(node)
+        if isinstance(node, Filter) and isinstance(node.inputs[0], Table):
+            # filter as the table is read
+            return f"{read(node.inputs[0])}\nWHERE {expr_sql(node.predicate, dialect)}"
+        if isinstance(node, Join):
+            left, right = (visit(child) for child in node.inputs)
+            columns = [f"l.{name}" for name in node.inputs[0].columns] + [
+                f"r.{name}" for name in node.inputs[1].columns
+            ]
+            conditions = " AND ".join(
+                f"{expr_sql(left_expr, dialect, 'l')} = "
+                f"{expr_sql(right_expr, dialect, 'r')}"
+                for left_expr, right_expr in node.on
+            )
+            join = "LEFT JOIN" if node.how == "left" else "INNER JOIN"
+            return (
+                f"SELECT {', '.join(columns)}\nFROM {left} AS l\n"
+                f"{join} {right} AS r ON {conditions}"
+            )
+        source = visit(node.inputs[0])
+        if isinstance(node, Filter):
+            return (
+                f"SELECT {', '.join(node.columns)}\nFROM {source}\n"
+                f"WHERE {expr_sql(node.predicate, dialect)}"
+            )
+        if isinstance(node, Derive):
+            exprs = {name: col(name) for name in node.columns}
+            exprs.update(node.exprs)
+            return select(exprs, source)
+        if isinstance(node, Select):
+            return select(node.exprs, source)
+        if isinstance(node, Distinct):
+            return f"SELECT DISTINCT {', '.join(node.columns)}\nFROM {source}"
+        if isinstance(node, Aggregate):
+            sums = [
+                f"SUM({expr_sql(expr, dialect)}) AS {name}"
+                for name, expr in node.sums.items()
+            ]
+            columns = ",\n  ".join(node.by + sums)
+            return (
+                f"SELECT\n  {columns}\nFROM {source}\n" f"GROUP BY {', '.join(node.by)}"
+            )
+        raise TypeError(f"Unsupported plan node {type(node).__name__}")
+
+    def visit(node):
+        # a step used more than once is only defined once
+        if id(node) not in names:
+            sql = step_sql(node)
+            names[id(node)] = f"step_{len(steps) + 1}"
+            steps.append(f"{names[id(node)]} AS (\n{sql}\n)")
+        return names[id(node)]
+
+    final = visit(plan)
+    return "WITH\n" + ",\n".join(steps) + f"\nSELECT * FROM {final}"
+
+
+# Local execution
+
+
+def _is_text(values):
+    return values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype)
+
+
+def evaluate(expr, df):
+    """Return the values of `expr` for the rows of `df`, as an array
+
+    An expression over a single text column is evaluated for each
+    distinct value of the column only.
+
+    """
+    columns = expr_columns(expr)
+    if len(columns) == 1 and not isinstance(expr, Column):
+        (name,) = columns
+        if _is_text(df[name]) and len(df) > 0:
+            codes, uniques = pd.factorize(df[name])
+            # one extra row for missing values (code -1)
+            distinct = pd.DataFrame(
+                {name: np.append(np.asarray(uniques, dtype=object), None)}
+            )
+            return _evaluate(expr, distinct).to_numpy()[codes]
+    return _evaluate(expr, df).to_numpy()
+
+
+def _evaluate(expr, df):
+    """Return the values of `expr` for the rows of `df`, as a series
+    """
+    if isinstance(expr, Column):
+        return pd.Series(df[expr.name].to_numpy())
+    if isinstance(expr, Literal):
+        return pd.Series(np.repeat(expr.value, len(df)), dtype=object).infer_objects()
+    values = [_evaluate(child, df) for child in expr.children]
+    if isinstance(expr, BinaryOp):
+        left, right = values
+        if expr.op in ("AND", "OR"):
+            left, right = (
+                left.fillna(False).astype(bool),
+                right.fillna(False).astype(bool),
+            )
+        return {
+            "*": lambda: left * right,
+            "/": lambda: left / right,
+            "+": lambda: left + right,
+            "-": lambda: left - right,
+            "=": lambda: left == right,
+            "!=": lambda: (left != right) & left.notnull() & right.notnull(),
+            "<=": lambda: left <= right,
+            ">=": lambda: left >= right,
+            "AND": lambda: left & right,
+            "OR": lambda: left | right,
+        }[expr.op]()
+    operand = values[0]
+    if isinstance(expr, Not):
+        return ~operand.fillna(False).astype(bool)
+    if isinstance(expr, IsIn):
+        return operand.isin(expr.values)
+    if isinstance(expr, StartsWith):
+        return operand.str.startswith(expr.prefix).fillna(False).astype(bool)
+    if isinstance(expr, Contains):
+        return operand.str.contains(expr.text, regex=False).fillna(False).astype(bool)
+    if isinstance(expr, After):
+        return operand.str.split(expr.separator, n=1).str[-1]
+    if isinstance(expr, Substr):
+        start = expr.start - 1 if expr.start > 0 else expr.start
+        stop = start + expr.length
+        if start < 0 <= stop:
+            stop = None
+        return operand.str[start:stop]
+    if isinstance(expr, Concat):
+        result = values[0].astype(object)
+        for value in values[1:]:
+            result = result + value
+        return result
+    if isinstance(expr, Coalesce):
+        return operand.where(operand.notnull(), values[1])
+    if isinstance(expr, Case):
+        result = values[-1]
+        for i in reversed(range(len(expr.whens))):
+            condition = values[2 * i].fillna(False).astype(bool)
+            result = values[2 * i + 1].where(condition, result)
+        return result.infer_objects()
+    raise TypeError(f"Unsupported expression {type(expr).__name__}")
+
+
+def _join(left, right, node):
+    keys = [f"_key_{i}" for i in range(len(node.on))]
+    for key, (left_expr, right_expr) in zip(keys, node.on):
+        left = left.assign(**{key: evaluate(left_expr, left)})
+        right = right.assign(**{key: evaluate(right_expr, right)})
+    # as in SQL, missing keys match nothing
+    right = right[right[keys].notnull().all(axis=1)]
+    return left.merge(right, on=keys, how=node.how).drop(columns=keys)
+
+
+def _aggregate_values(node, df):
+    """Return the `by` columns of `df` and the values to sum for an
+    `Aggregate` step
+
+    The values are given temporary names, so that a sum can't replace a
+    `by` column of the same name; `_aggregate_columns` restores them.
+
+    """
+    return df[node.by].assign(
+        **{
+            f"_sum_{name}": evaluate(expr, df).astype("float64")
+            for name, expr in node.sums.items()
+        }
+    )
+
+
+def _aggregate_columns(node, df):
+    """Return the sums of `_aggregate_values`, `by` columns first, with
+    the `Aggregate` step's own column names
+    """
+    names = node.by + [f"_sum_{name}" for name in node.sums]
+    return df.reindex(columns=names).set_axis(node.columns, axis=1)
+
+
+def _reads(node, names):
+    """Return whether `node` reads any of the tables `names`
+    """
+    if isinstance(node, Table):
+        return node.name in names
+    return any(_reads(child, names) for child in node.inputs)
+
+
+def _run(node, sources, results, chunk_results, chunked=()):
+    """Return the result of `node`, reusing results of steps already run:
+    those which read a table in `chunked` are kept in `chunk_results`,
+    and the rest in `results`
+    """
+    for store in (results, chunk_results):
+        if id(node) in store:
+            return store[id(node)]
+
+    def run(child):
+        return _run(child, sources, results, chunk_results, chunked)
+
+    if isinstance(node, Table):
+        df = sources[node.name][node.columns].reset_index(drop=True)
+    elif isinstance(node, Join):
+        df = _join(run(node.inputs[0]), run(node.inputs[1]), node)
+    else:
+        df = run(node.inputs[0])
+        if isinstance(node, Filter):
+            mask = evaluate(node.predicate, df).astype(bool)
+            df = df[mask].reset_index(drop=True)
+        elif isinstance(node, Derive):
+            df = df.assign(
+                **{name: evaluate(expr, df) for name, expr in node.exprs.items()}
+            )[node.columns]
+        elif isinstance(node, Select):
+            df = pd.DataFrame(
+                {name: evaluate(expr, df) for name, expr in node.exprs.items()}
+            )
+        elif isinstance(node, Distinct):
+            df = df.drop_duplicates(ignore_index=True)
+        elif isinstance(node, Aggregate):
+            df = _aggregate_columns(
+                node,
+                _aggregate_values(node, df)
+                .groupby(node.by, dropna=False, observed=True, sort=True)
+                .sum()
+                .reset_index(),
+            )
+        else:
+            raise TypeError(f"Unsupported plan node {type(node).__name__}")
+    store = chunk_results if _reads(node, chunked) else results
+    store[id(node)] = df
+    return df
+
+
+def execute(plan, sources, memory_budget=None, spill_dir=None):
+    """Run `plan` on `sources`, a dict of dataframes by table name, and
+    return the result as a dataframe
+
+    One source may instead be an iterable of dataframes (e.g. the parts
+    of a prescribing dataset), if the plan ends with an `Aggregate`: the
+    plan is run a chunk at a time, reusing the results of steps which
+    don't read that source, and the sums combined.  With `memory_budget`
+    (in bytes), the sums are kept within about that much memory,
+    spilling to `spill_dir` (default: the system temporary directory) if
+    there are too many groups; see `lib.spill`.
+
+    """
+    chunked = [
+        name for name, source in sources.items() if not isinstance(source, pd.DataFrame)
+    ]
+    if not chunked and memory_budget is None:
+        return _run(plan, sources, {}, {})
+    if not isinstance(plan, Aggregate):
+        raise ValueError("Only aggregations can be run in chunks or within a budget")
+    if len(chunked) > 1:
+        raise ValueError(f"Only one source can be chunked, not {chunked}")
+    chunks = sources[chunked[0]] if chunked else [None]
+    aggregator = SpillingAggregator(plan.by, memory_budget, spill_dir)
+    results = {}
+    for chunk in chunks:
+        chunk_sources = dict(sources, **{chunked[0]: chunk}) if chunked else sources
+        df = _run(plan.inputs[0], chunk_sources, results, {}, chunked)
+        aggregator.add(_aggregate_values(plan, df))
+    return _aggregate_columns(plan, aggregator.result())
+
+
+def _canonical(df):
+    """Return `df` with plain column types and rows in a fixed order
+    """
+    df = df.copy()
+    for name in df.columns:
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            df[name] = df[name].astype(object)
+        if df[name].dtype.kind in "iub":
+            df[name] = df[name].astype("float64")
+    keys = [name for name in df.columns if df[name].dtype != "float64"]
+    keys += [name for name in df.columns if name not in keys]
+    return df.sort_values(keys, na_position="last").reset_index(drop=True)
+
+
+def parity_check(plan, sources, rtol=1e-9):
+    """Run `plan` locally and as SQL in an in-memory SQLite database, and
+    raise an `AssertionError` unless the results are the same; return the
+    local result
+    """
+    local = execute(plan, sources)
+    connection = sqlite3.connect(":memory:")
+    try:
+        for name, df in sources.items():
+            df.to_sql(name, connection, index=False)
+        remote = pd.read_sql_query(to_sql(plan, dialect="sqlite"), connection)
+    finally:
+        connection.close()
+    pd.testing.assert_frame_equal(
+        _canonical(local), _canonical(remote), check_dtype=False, rtol=rtol
+    )
+    return local
@@ -0,0 +1,281 @@
+"""Versioned OME conversion tables, and what-if recalculation of the
+measure for proposed changes to them.
+
+The OME multipliers (e.g. `richard.opioid_class`: one `ome` per
+ingredient `id` and `form`) are expected to change after clinical
+review.  `OMETableStore` keeps every version of such a table locally:
+
+    <root>/<table>/versions.json     list of versions, with notes
+    <root>/<table>/v0001.csv         the table at each version
+
+and can diff any two versions.
+
+`WhatIf` answers "what happens to the measure if this multiplier
+changes" without recomputing from prescribing data.  The measure is
+linear in the multipliers -- each organisation's OME is the sum over
+ingredient and form of (total mg) x (multiplier) -- so from cached total
+mg per organisation, ingredient and form (`ingredient_mg_totals`), the
+change for a proposed table only needs the rows for the ingredients
+whose multiplier changed:
+
+    what_if = WhatIf(mg_totals, store.load())
+    what_if.delta({oxycodone_id: 2.0})
+
+Only (ingredient, form) pairs with mg totals can be re-priced, and
+`lib.ome.ingredient_factors` leaves out pairs missing from the OME
+table it's given.  To try a table adding new pairs, compute the mg
+totals from the factors for that table (the multipliers of pairs the
+current table lacks count as zero in the baseline); otherwise `WhatIf`
+warns that the new pairs are ignored.
+
+"""
+import datetime
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from lib.alignment import align
+from lib.ome import included, prescribing_join_key, vmp_join_key
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(__file__), "..", "data", "ome_tables")
+OPIOID_CLASS_KEY = ("id", "form")
+
+
+class OMETableStore:
+    """All versions of one OME conversion table, keyed by `key` columns
+    """
+
+    def __init__(self, name, key=OPIOID_CLASS_KEY, root=DEFAULT_ROOT):
+        self.name = name
+        self.key = list(key)
+        self.path = os.path.join(root, name)
+        self._manifest_path = os.path.join(self.path, "versions.json")
+        os.makedirs(self.path, exist_ok=True)
+
+    def versions(self):
+        """Return the list of versions, oldest first
+        """
+        try:
+            with open(self._manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def save(self, df, note=""):
+        """Store `df` as a new version and return its name, or the name of
+        the latest version if `df` is identical to it
+        """
+        df = df.sort_values(self.key).reset_index(drop=True)
+        text = df.to_csv(index=False)
+        digest = hashlib.sha256(text.encode("utf8")).hexdigest()
+        versions = self.versions()
+        if versions and versions[-1]["sha256"] == digest:
+            return versions[-1]["version"]
+        version = f"v{len(versions) + 1:04d}"
+        with open(os.path.join(self.path, f"{version}.csv"), "w") as f:
+            f.write(text)
+        versions.append(
+            {
+                "version": version,
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "note": note,
+                "sha256": digest,
+            }
+        )
+        tmp_path = f"{self._manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(versions, f, indent=2)
+        os.replace(tmp_path, self._manifest_path)
+        return version
+
+    def load(self, version=None):
+        """Return the table at `version` (default: the latest)
+        """
+        if version is None:
+            versions = self.versions()
+            if not versions:
+                raise ValueError(f"No versions of {self.name} have been saved")
+            version = versions[-1]["version"]
+        return pd.read_csv(os.path.join(self.path, f"{version}.csv"))
+
+    def diff(self, old_version, new_version, value="ome"):
+        """Return the rows added, removed or changed between two versions,
+        with `<value>_old` and `<value>_new` columns and a `change` column
+        """
+        return diff_tables(
+            self.load(old_version), self.load(new_version), self.key, value
+        )
+
+
+def diff_tables(old, new, key=OPIOID_CLASS_KEY, value="ome"):
+    """Return the differences in `value` between two versions of a table
+    """
+    key = list(key)
+    if old.duplicated(key).any() or new.duplicated(key).any():
+        # an alignment needs unique keys; an outer merge pairs up every
+        # old and new row of a repeated key
+        return _diff_merged(old, new, key, value)
+    aligned = align(old, new, on=key)
+    old_values = aligned.left(value)
+    new_values = aligned.right(value)
+    change = aligned.status().rename_categories(["removed", "added", "changed"])
+    changed = (change != "changed") | ~np.isclose(
+        old_values, new_values, rtol=0, atol=0
+    )
+    return aligned.frame(
+        mask=changed,
+        **{
+            f"{value}_old": old_values,
+            f"{value}_new": new_values,
+            "change": pd.Series(change, dtype=object),
+        },
+    )
+
+
+def _diff_merged(old, new, key, value):
+    merged = old[key + [value]].merge(
+        new[key + [value]],
+        on=key,
+        how="outer",
+        suffixes=("_old", "_new"),
+        indicator=True,
+    )
+    merged["change"] = (
+        merged["_merge"]
+        .map({"left_only": "removed", "right_only": "added", "both": "changed"})
+        .astype(object)
+    )
+    changed = (merged["change"] != "changed") | ~np.isclose(
+        merged[f"{value}_old"], merged[f"{value}_new"], rtol=0, atol=0
+    )
+    return merged[changed].drop(columns="_merge").reset_index(drop=True)
+
+
+def ingredient_mg_totals(rx, factors, by=("practice",)):
+    """Return total mg of each opioid ingredient by `by`, ingredient (`ing`)
+    and form (`simple_form`): the part of the OME calculation that
+    doesn't depend on the multipliers
+
+    `factors` is the output of `lib.ome.ingredient_factors`.
+
+    """
+    by = list(by)
+    rx = rx[included(rx)]
+    rx = rx.assign(join_key=prescribing_join_key(rx["bnf_code"]))
+    factors = factors.assign(join_key=vmp_join_key(factors["vmp_bnf_code"]))
+    joined = rx[by + ["join_key", "quantity"]].merge(
+        factors[["join_key", "ing", "simple_form", "mg_per_unit"]], on="join_key"
+    )
+    joined["mg"] = joined["quantity"] * joined["mg_per_unit"]
+    return joined.groupby(by + ["ing", "simple_form"], as_index=False)["mg"].sum()
+
+
+class WhatIf:
+    """Fast recalculation of OME per organisation for changed multipliers
+
+    `mg_totals` is the output of `ingredient_mg_totals` (with `org` as
+    the grouping column(s)), and `table` the current OME table, with
+    `id`, `form` and `ome` columns.
+
+    """
+
+    def __init__(self, mg_totals, table, org="practice"):
+        self.org_columns = [org] if isinstance(org, str) else list(org)
+        # sort by ingredient and form, so the rows affected by changing
+        # one multiplier are a contiguous slice
+        mg_totals = mg_totals.sort_values(["ing", "simple_form"], kind="mergesort")
+        org_keys = mg_totals[self.org_columns]
+        self.org_codes, self.orgs = _factorize_rows(org_keys)
+        factor_keys = mg_totals[["ing", "simple_form"]]
+        factor_codes, self.factors = _factorize_rows(factor_keys, sort=True)
+        self.mg = mg_totals["mg"].to_numpy(dtype="float64")
+        self.bounds = np.searchsorted(
+            factor_codes, np.arange(len(self.factors) + 1), side="left"
+        )
+        self.multipliers = self._multipliers(table)
+        self.baseline = self._measure(self.multipliers)
+
+    def _multipliers(self, table):
+        """Return the multiplier for each (ing, simple_form) in `factors`
+        """
+        lookup = table.set_index(["id", "form"])["ome"]
+        index = pd.MultiIndex.from_frame(self.factors)
+        return lookup.reindex(index).to_numpy(dtype="float64")
+
+    def _measure(self, multipliers):
+        weights = self.mg * np.repeat(np.nan_to_num(multipliers), np.diff(self.bounds))
+        return np.bincount(self.org_codes, weights=weights, minlength=len(self.orgs))
+
+    def _changed_factors(self, changes):
+        """Return (factor positions, new multipliers) for `changes`, a dict
+        of {(ing, form): ome} or {ing: ome} (for every form), or a
+        proposed table with id, form and ome columns
+        """
+        if isinstance(changes, pd.DataFrame):
+            pairs = pd.MultiIndex.from_frame(
+                changes.loc[changes["ome"].notna(), ["id", "form"]]
+            )
+            self._warn_unknown(pairs.difference(pd.MultiIndex.from_frame(self.factors)))
+            proposed = self._multipliers(changes)
+            positions = np.flatnonzero(
+                ~np.isclose(proposed, self.multipliers, rtol=0, atol=0, equal_nan=True)
+            )
+            return positions, proposed[positions]
+        ings = self.factors["ing"].to_numpy()
+        forms = self.factors["simple_form"].to_numpy()
+        new = self.multipliers.copy()
+        changed = np.zeros(len(new), dtype=bool)
+        unknown = []
+        for key, value in changes.items():
+            if isinstance(key, tuple):
+                match = (ings == key[0]) & (forms == key[1])
+            else:
+                match = ings == key
+            if not match.any():
+                unknown.append(key)
+            new[match] = value
+            changed |= match
+        self._warn_unknown(unknown)
+        positions = np.flatnonzero(changed)
+        return positions, new[positions]
+
+    def _warn_unknown(self, keys):
+        if len(keys):
+            warnings.warn(
+                f"No mg totals for {list(keys)}, so changes to them are "
+                "ignored; compute the mg totals from factors for a table "
+                "including them"
+            )
+
+    def delta(self, changes):
+        """Return a dataframe of the baseline OME, the OME under `changes`,
+        and the difference, for each organisation
+        """
+        positions, new_multipliers = self._changed_factors(changes)
+        delta = np.zeros(len(self.orgs))
+        old_multipliers = np.nan_to_num(self.multipliers[positions])
+        for position, old, new in zip(positions, old_multipliers, new_multipliers):
+            start, stop = self.bounds[position], self.bounds[position + 1]
+            delta += np.bincount(
+                self.org_codes[start:stop],
+                weights=self.mg[start:stop] * (np.nan_to_num(new) - old),
+                minlength=len(self.orgs),
+            )
+        result = self.orgs.copy()
+        result["ome_baseline"] = self.baseline
+        result["ome_proposed"] = self.baseline + delta
+        result["ome_delta"] = delta
+        return result
+
+
+def _factorize_rows(df, sort=False):
+    """Return (codes, unique rows) for the rows of `df`
+    """
+    index = pd.MultiIndex.from_frame(df)
+    codes, uniques = pd.factorize(index, sort=sort)
+    uniques = pd.DataFrame(list(uniques), columns=df.columns)
+    return codes, uniques
@@ -0,0 +1,214 @@
+"""Screening prescribing rows for quantity anomalies before OME is
+calculated.
+
+Some presentations have quantities recorded in inconsistent units -- for
+PecFent the quantity is packs when dispensed from the 8 dose container
+and doses when dispensed from the 32 dose pack (see the DMD notebook) --
+which inflates OME by 8x or more for the affected rows.  Such rows stand
+out against the other rows for the same presentation on two measures:
+
+* quantity per item, and
+* cost per unit (net ingredient cost / quantity).
+
+For each BNF code we estimate the median and median absolute deviation
+(MAD) of the log of each measure across all practices and months, and
+flag rows whose robust z-score is outside the expected band.  Working in
+log space means a row with 8x the usual quantity is as far out as one
+with 1/8 of it.
+
+The statistics are accumulated from fixed-size log-spaced histograms,
+one per BNF code, so they can be built in a single streaming pass over
+chunks of national data using constant memory, then applied to each
+chunk in a second pass:
+
+    screen = OutlierScreen()
+    for chunk in read_chunks():
+        screen.update(chunk)
+    for chunk in read_chunks():
+        flagged = screen.flag(chunk)
+
+The second pass is needed because a row is judged against its code's
+statistics over all of the data: flagging chunks as they arrive would
+judge the first rows of each code against only a handful of others, and
+the results would depend on the order of the chunks.  A `screen` built
+over one extract can also flag other data without reading that extract
+again.
+
+"""
+import numpy as np
+import pandas as pd
+
+# scale factor making the MAD a consistent estimator of the standard
+# deviation for normally distributed data
+MAD_SCALE = 1.4826
+
+METRICS = {
+    "quantity_per_item": ("quantity", "items"),
+    "cost_per_unit": ("net_cost", "quantity"),
+}
+
+
+class LogHistograms:
+    """Per-key histograms of log10(value), from which approximate medians
+    and MADs can be read off
+    """
+
+    def __init__(self, low=1e-4, high=1e8, bins_per_decade=50):
+        self.log_low = np.log10(low)
+        self.bins_per_decade = bins_per_decade
+        self.n_bins = int(round((np.log10(high) - self.log_low) * bins_per_decade))
+        self.centres = self.log_low + (np.arange(self.n_bins) + 0.5) / bins_per_decade
+        self.counts = np.zeros((0, self.n_bins), dtype=np.int64)
+
+    def _grow(self, n_keys):
+        if n_keys > len(self.counts):
+            extra = max(n_keys - len(self.counts), len(self.counts))
+            self.counts = np.vstack(
+                [self.counts, np.zeros((extra, self.n_bins), dtype=np.int64)]
+            )
+
+    def bin_index(self, values):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            logs = np.log10(values)
+        bins = np.floor((logs - self.log_low) * self.bins_per_decade)
+        return np.clip(bins, 0, self.n_bins - 1), np.isfinite(logs)
+
+    def update(self, key_ids, values, n_keys):
+        """Add `values` to the histograms of the keys in `key_ids`
+        """
+        self._grow(n_keys)
+        bins, valid = self.bin_index(values)
+        flat = key_ids[valid] * self.n_bins + bins[valid].astype(np.int64)
+        self.counts.reshape(-1)[:] += np.bincount(flat, minlength=self.counts.size)
+
+    def median_mad(self, n_keys):
+        """Return arrays of the median and MAD of log10(value) for each key
+        """
+        counts = self.counts[:n_keys]
+        totals = counts.sum(axis=1)
+        medians = _weighted_median(np.broadcast_to(self.centres, counts.shape), counts)
+        deviations = np.abs(self.centres[None, :] - medians[:, None])
+        mads = _weighted_median(deviations, counts)
+        medians[totals == 0] = np.nan
+        mads[totals == 0] = np.nan
+        return medians, mads
+
+
+class OutlierScreen:
+    """Robust per-BNF code statistics of quantity per item and cost per
+    unit, and flagging of rows outside the expected band
+
+    A row is flagged when either measure has a robust z-score beyond
+    `threshold`.  Because many presentations are almost always prescribed
+    in the same quantity (so the MAD is close to zero), the band is never
+    narrower than a factor of `min_ratio` either side of the median.
+    Codes with fewer than `min_rows` rows are not flagged.
+
+    """
+
+    def __init__(self, threshold=5.0, min_ratio=3.0, min_rows=20, **histogram_kwargs):
+        self.threshold = threshold
+        self.min_log_band = np.log10(min_ratio)
+        self.min_rows = min_rows
+        self.histograms = {name: LogHistograms(**histogram_kwargs) for name in METRICS}
+        self.key_ids = {}
+        self._stats = None
+
+    def _ids(self, codes, add):
+        """Return an array of integer ids for `codes`, assigning new ids
+        if `add` is set (and -1 for unknown codes otherwise), and -1 for
+        missing codes
+        """
+        ids, uniques = pd.factorize(codes)
+        # the extra last entry maps the missing code (-1) to -1
+        mapped = np.full(len(uniques) + 1, -1, dtype=np.int64)
+        for i, code in enumerate(uniques):
+            if add:
+                mapped[i] = self.key_ids.setdefault(code, len(self.key_ids))
+            else:
+                mapped[i] = self.key_ids.get(code, -1)
+        return mapped[ids]
+
+    def update(self, chunk):
+        """Add a chunk of prescribing rows (with bnf_code, items, quantity
+        and net_cost columns) to the statistics
+        """
+        ids = self._ids(chunk["bnf_code"].to_numpy(), add=True)
+        known = ids >= 0
+        for name, values in _metrics(chunk).items():
+            self.histograms[name].update(ids[known], values[known], len(self.key_ids))
+        self._stats = None
+
+    def statistics(self):
+        """Return a dataframe of the median and MAD of each measure, and
+        the number of rows seen, for each BNF code
+        """
+        if self._stats is None:
+            n = len(self.key_ids)
+            stats = pd.DataFrame(index=pd.Index(list(self.key_ids), name="bnf_code"))
+            for name, histograms in self.histograms.items():
+                medians, mads = histograms.median_mad(n)
+                stats[f"{name}_median"] = 10 ** medians
+                stats[f"{name}_log_median"] = medians
+                stats[f"{name}_log_mad"] = mads
+                stats[f"{name}_rows"] = histograms.counts[:n].sum(axis=1)
+            self._stats = stats
+        return self._stats
+
+    def flag(self, chunk):
+        """Return `chunk` with a robust z-score column for each measure and
+        an `outlier` column
+        """
+        stats = self.statistics()
+        ids = self._ids(chunk["bnf_code"].to_numpy(), add=False)
+        known = ids >= 0
+        safe_ids = np.where(known, ids, 0)
+        outlier = np.zeros(len(chunk), dtype=bool)
+        result = chunk.copy()
+        for name, values in _metrics(chunk).items():
+            median = stats[f"{name}_log_median"].to_numpy()[safe_ids]
+            spread = MAD_SCALE * stats[f"{name}_log_mad"].to_numpy()[safe_ids]
+            band = np.maximum(self.threshold * spread, self.min_log_band)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                deviation = np.log10(values) - median
+                scores = np.where(known, deviation / spread, np.nan)
+            enough = known & (
+                stats[f"{name}_rows"].to_numpy()[safe_ids] >= self.min_rows
+            )
+            with np.errstate(invalid="ignore"):
+                outlier |= enough & (np.abs(deviation) > band)
+            result[f"{name}_score"] = scores
+        result["outlier"] = outlier
+        return result
+
+
+def screen(read_chunks, **screen_kwargs):
+    """Yield the flagged rows of each chunk from `read_chunks()`, which is
+    called twice: once to gather statistics, and once to flag rows
+    """
+    outlier_screen = OutlierScreen(**screen_kwargs)
+    for chunk in read_chunks():
+        outlier_screen.update(chunk)
+    for chunk in read_chunks():
+        flagged = outlier_screen.flag(chunk)
+        yield flagged[flagged["outlier"]]
+
+
+def _metrics(chunk):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            name: chunk[numerator].to_numpy(dtype="float64")
+            / chunk[denominator].to_numpy(dtype="float64")
+            for name, (numerator, denominator) in METRICS.items()
+        }
+
+
+def _weighted_median(values, weights):
+    """Return the weighted median of each row of `values`
+    """
+    order = np.argsort(values, axis=1, kind="stable")
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+    half = cumulative[:, -1:] / 2
+    position = np.minimum((cumulative < half).sum(axis=1), values.shape[1] - 1)
+    return sorted_values[np.arange(len(values)), position]
@@ -0,0 +1,248 @@
+"""Reduce NHSBSA practice level prescribing CSVs to columnar opioid
+extracts.
+
+Offline, the equivalent of `ebmdatalab.hscic.normalised_prescribing` is
+the monthly practice level prescribing files published by NHSBSA, each
+several GB.  Only a few percent of rows are for opioids, so most of the
+work of parsing them is wasted.  Instead, each file is read in blocks of
+`DEFAULT_BLOCK_SIZE` bytes, and the lines whose BNF code field starts
+with one of the wanted prefixes (`0407`, analgesics: opioids, by
+default) are picked out of the raw bytes before anything is parsed: a
+byte search for each prefix finds candidate lines, and a regular
+expression checks that the prefix is at the start of the right field.
+Only those lines are handed to `pandas.read_csv`, and each block's rows
+are written as a part of a `lib.columnar` dataset, so memory use
+doesn't depend on the size of the file.
+
+Both the original layout (`PCT,PRACTICE,BNF CODE,...,PERIOD`) and the
+English Prescribing Dataset layout (`YEAR_MONTH,...,BNF_CODE,...`) are
+understood, and columns are renamed as in `normalised_prescribing`.
+In the English Prescribing Dataset, `QUANTITY` is the quantity of each
+item, so `TOTAL_QUANTITY` is used for `quantity` instead.
+The output for each input file is a partition directory named after the
+file, written to a temporary directory and moved into place when
+complete, so files can be converted in parallel and reconverted safely:
+
+    convert_files(glob.glob("raw/*.csv"), "data/opioid_prescribing")
+    read_table("data/opioid_prescribing")
+
+or
+
+    python -m lib.prescribing_csv data/opioid_prescribing raw/*.csv
+
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+
+import pandas as pd
+
+from lib import columnar
+
+DEFAULT_BLOCK_SIZE = 64 * 1024 * 1024
+OPIOID_PREFIXES = ("0407",)
+
+# CSV header (stripped and upper cased) -> normalised_prescribing column,
+# for the original layout
+COLUMN_NAMES = {
+    "PCT": "pct",
+    "PRACTICE": "practice",
+    "BNF CODE": "bnf_code",
+    "BNF NAME": "bnf_name",
+    "ITEMS": "items",
+    "NIC": "net_cost",
+    "ACT COST": "actual_cost",
+    "QUANTITY": "quantity",
+    "PERIOD": "month",
+}
+# and for the English Prescribing Dataset, whose QUANTITY (per item) is
+# left out
+EPD_COLUMN_NAMES = {
+    "PCO_CODE": "pct",
+    "PRACTICE_CODE": "practice",
+    "BNF_CODE": "bnf_code",
+    "BNF_DESCRIPTION": "bnf_name",
+    "ITEMS": "items",
+    "NIC": "net_cost",
+    "ACTUAL_COST": "actual_cost",
+    "TOTAL_QUANTITY": "quantity",
+    "YEAR_MONTH": "month",
+}
+NUMERIC_COLUMNS = ("items", "net_cost", "actual_cost", "quantity")
+
+# one CSV field: quoted (possibly containing commas and doubled quotes)
+# or unquoted
+_FIELD = rb'(?:"(?:[^"\n]|"")*"|[^,"\n]*)'
+
+
+def column_names(header):
+    """Return the normalised_prescribing column for each of the names in
+    a CSV `header`, or None for columns which aren't kept
+    """
+    header = [name.strip(' "\r\n').upper() for name in header]
+    names = EPD_COLUMN_NAMES if "YEAR_MONTH" in header else COLUMN_NAMES
+    return [names.get(name) for name in header]
+
+
+def line_pattern(field_index, prefixes):
+    """Return a compiled pattern matching whole lines whose field number
+    `field_index` starts (after any spaces or quote) with one of
+    `prefixes`
+    """
+    alternatives = b"|".join(re.escape(prefix.encode("ascii")) for prefix in prefixes)
+    return re.compile(
+        rb"^(?:%s,){%d} *\"?(?:%s)[^\n]*\n" % (_FIELD, field_index, alternatives),
+        re.MULTILINE,
+    )
+
+
+def filter_lines(block, prefixes, pattern):
+    """Return the lines of `block` (bytes of whole lines) which contain one
+    of `prefixes` and match `pattern` (from `line_pattern`), in order
+    """
+    starts = set()
+    for prefix in prefixes:
+        prefix = prefix.encode("ascii")
+        position = block.find(prefix)
+        while position != -1:
+            starts.add(block.rfind(b"\n", 0, position) + 1)
+            # blocks end with a newline, so there's always one to find
+            position = block.find(prefix, block.find(b"\n", position) + 1)
+    lines = []
+    for start in sorted(starts):
+        match = pattern.match(block, start)
+        if match:
+            lines.append(match.group())
+    return b"".join(lines)
+
+
+def read_blocks(f, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield blocks of whole lines of about `block_size` bytes from the
+    binary file `f`
+    """
+    remainder = b""
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        data = remainder + data
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            remainder = data
+            continue
+        remainder = data[end:]
+        yield data[:end]
+    if remainder:
+        yield remainder + b"\n"
+
+
+def parse_lines(header, lines):
+    """Return a dataframe of the CSV `lines` (bytes), with columns renamed
+    and typed as in `normalised_prescribing`
+    """
+    df = pd.read_csv(
+        io.BytesIO(header + lines),
+        dtype=str,
+        skipinitialspace=True,
+        keep_default_na=False,
+    )
+    names = column_names(df.columns)
+    result = {}
+    for position, name in enumerate(names):
+        if name is None:
+            continue
+        values = df.iloc[:, position].str.strip()
+        if name in NUMERIC_COLUMNS:
+            values = pd.to_numeric(values, errors="coerce")
+        elif name == "month":
+            values = values.str[:4] + "-" + values.str[4:6] + "-01"
+        result[name] = values
+    return pd.DataFrame(result)
+
+
+def convert_file(path, output, prefixes=OPIOID_PREFIXES, block_size=DEFAULT_BLOCK_SIZE):
+    """Write the rows of the CSV at `path` with BNF codes starting with
+    one of `prefixes` as a partition of the dataset at `output`, and
+    return the number of rows written
+    """
+    partition = os.path.splitext(os.path.basename(path))[0]
+    os.makedirs(output, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=output, prefix=".tmp-")
+    writer = columnar.DatasetWriter(tmp_dir)
+    rows = 0
+    try:
+        with open(path, "rb") as f:
+            header = f.readline()
+            # NHSBSA downloads often start with a byte order mark
+            names = column_names(header.decode("utf-8-sig").split(","))
+            if "bnf_code" not in names:
+                raise ValueError(f"{path} has no BNF code column")
+            pattern = line_pattern(names.index("bnf_code"), prefixes)
+            for block in read_blocks(f, block_size):
+                lines = filter_lines(block, prefixes, pattern)
+                if lines:
+                    df = parse_lines(header, lines)
+                    writer.write(df)
+                    rows += len(df)
+        destination = os.path.join(output, partition)
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        os.replace(tmp_dir, destination)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    return rows
+
+
+def _convert_file(args):
+    path = args[0]
+    return path, convert_file(*args)
+
+
+def convert_files(
+    paths,
+    output,
+    prefixes=OPIOID_PREFIXES,
+    block_size=DEFAULT_BLOCK_SIZE,
+    processes=None,
+):
+    """Convert each CSV in `paths` with `convert_file`, in parallel, and
+    return a dict of the number of rows written for each
+    """
+    tasks = [(path, output, tuple(prefixes), block_size) for path in paths]
+    with multiprocessing.Pool(processes) as pool:
+        return dict(pool.imap_unordered(_convert_file, tasks))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert prescribing CSVs to a columnar opioid extract"
+    )
+    parser.add_argument("output", help="path of the dataset to write")
+    parser.add_argument("paths", nargs="+", help="prescribing CSV files")
+    parser.add_argument(
+        "--prefix",
+        action="append",
+        dest="prefixes",
+        help=f"BNF code prefix to keep (default: {', '.join(OPIOID_PREFIXES)})",
+    )
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    args = parser.parse_args()
+    counts = convert_files(
+        args.paths,
+        args.output,
+        prefixes=args.prefixes or OPIOID_PREFIXES,
+        block_size=args.block_size,
+        processes=args.processes,
+    )
+    for path in args.paths:
+        print(f"{path}: {counts[path]} rows")
+
+
+if __name__ == "__main__":
+    main()
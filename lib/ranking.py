@@ -0,0 +1,144 @@
+"""Top-N selection for OME ranking views without sorting whole frames.
+
+`df.sort_values(col, ascending=False).head(n)` sorts every row just to
+show `n` of them.  The helpers here use partial selection
+(`np.argpartition`) instead, so picking the top `n` rows costs time
+linear in the number of rows, and only the selected rows are sorted.
+Results are identical to a stable sort followed by `head(n)`: ties keep
+their original order and missing values sort last.
+
+`top_n_by_group` applies the same selection within each month or
+organisation, and `TopNTracker` keeps per-group rankings up to date as
+new months of data are appended, e.g. the top 20 practices by OME in
+every month:
+
+    tracker = TopNTracker(by="month", column="ome_dose", n=20)
+    for month_df in monthly_extracts:
+        tracker.update(month_df)
+    tracker.result()
+
+"""
+import numpy as np
+import pandas as pd
+
+
+def top_n_positions(values, n, largest=True):
+    """Return the positions of the top `n` entries of `values`, in ranked
+    order
+    """
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    values = np.asarray(values, dtype="float64")
+    missing = np.isnan(values)
+    valid = np.flatnonzero(~missing)
+    keys = -values[valid] if largest else values[valid]
+
+    if n < len(keys):
+        # take everything strictly better than the n-th best value, then
+        # fill up with the earliest rows equal to it, as a stable sort would
+        threshold = np.partition(keys, n - 1)[n - 1]
+        better = np.flatnonzero(keys < threshold)
+        tied = np.flatnonzero(keys == threshold)[: n - len(better)]
+        chosen = np.concatenate([better, tied])
+    else:
+        chosen = np.arange(len(keys))
+
+    chosen = chosen[np.lexsort((chosen, keys[chosen]))]
+    positions = valid[chosen]
+    if len(positions) < n:
+        positions = np.concatenate([positions, np.flatnonzero(missing)])[:n]
+    return positions
+
+
+def top_n(df, column, n, largest=True):
+    """Return the top `n` rows of `df` by `column`
+    """
+    return df.iloc[top_n_positions(df[column].to_numpy(), n, largest=largest)]
+
+
+def top_n_by_group(df, by, column, n, largest=True, rank_col=None):
+    """Return the top `n` rows by `column` within each group of `by`
+
+    Groups are returned in sorted order, and rows within each group in
+    ranked order.  If `rank_col` is given, a column of that name holding
+    each row's 1-based rank within its group is added.  Rows with a
+    missing group key are dropped, as they are by `groupby`.
+
+    """
+    # rows with a missing key are numbered -1 (or NaN, in later pandas)
+    groups = df.groupby(by, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    if (groups < 0).any():
+        df, groups = df[groups >= 0], groups[groups >= 0]
+    if len(df) == 0:
+        result = df.iloc[:0]
+        return result.assign(**{rank_col: []}) if rank_col else result
+    values = df[column].to_numpy(dtype="float64")
+
+    # bucket rows by group; extracts are usually already ordered by month
+    # or organisation, which the stable sort handles in linear time
+    order = np.argsort(groups, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(groups))])
+
+    picked = []
+    ranks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        segment = order[start:stop]
+        positions = top_n_positions(values[segment], n, largest=largest)
+        picked.append(segment[positions])
+        ranks.append(np.arange(1, len(positions) + 1))
+    result = df.iloc[np.concatenate(picked)]
+    if rank_col:
+        result = result.assign(**{rank_col: np.concatenate(ranks)})
+    return result
+
+
+class TopNTracker:
+    """Per-group top-N rankings which can be updated incrementally
+
+    Each call to `update` only ranks the new rows together with the
+    rows already held for the same groups, so appending a month costs
+    time proportional to that month's data rather than the full history.
+
+    """
+
+    def __init__(self, by, column, n, largest=True):
+        self.by = by
+        self.column = column
+        self.n = n
+        self.largest = largest
+        self._top = None
+
+    def update(self, df):
+        """Add the rows of `df` to the rankings
+        """
+        new = top_n_by_group(df, self.by, self.column, self.n, self.largest)
+        if self._top is None:
+            self._top = new
+            return
+        keys = _group_keys(new, self.by)
+        affected = _group_keys(self._top, self.by).isin(keys).to_numpy()
+        reranked = top_n_by_group(
+            pd.concat([self._top[affected], new]),
+            self.by,
+            self.column,
+            self.n,
+            self.largest,
+        )
+        self._top = pd.concat([self._top[~affected], reranked])
+
+    def result(self, rank_col="rank"):
+        """Return the current top `n` rows for every group seen so far
+        """
+        if self._top is None:
+            return None
+        return top_n_by_group(
+            self._top, self.by, self.column, self.n, self.largest, rank_col=rank_col
+        )
+
+
+def _group_keys(df, by):
+    """Return a series with one hashable key per row for the `by` columns
+    """
+    if isinstance(by, (list, tuple)):
+        return pd.Series(list(zip(*[df[c] for c in by])), index=df.index)
+    return df[by]
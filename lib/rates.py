@@ -0,0 +1,204 @@
+"""OME per 1000 patients (or per STAR-PU) for every organisation and month.
+
+Organisations and months are coded as dense integers (`CodeIndex`), and
+list sizes are held as a months x organisations array (`Denominators`).
+Numerators are scattered into an array of the same shape, so rates for
+every practice (or CCG) and month come from one vectorised division:
+
+    denominators = load_denominators(list_sizes, org="practice")
+    rates = compute_rates(ome_by_practice_month, denominators)
+    rates.to_frame()
+
+`load_denominators` caches the arrays it builds, in memory and optionally
+on disk, so running several variants of a measure against the same list
+sizes only builds them once.
+
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+_cache = {}
+
+
+class CodeIndex:
+    """Dense integer ids for a set of codes, in sorted order
+    """
+
+    def __init__(self, codes):
+        self.codes = np.unique(np.asarray(codes).astype(str))
+
+    @classmethod
+    def from_sorted(cls, codes):
+        """Return an index over `codes`, which are already sorted and unique
+        """
+        index = cls.__new__(cls)
+        index.codes = codes
+        return index
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, values):
+        """Return the id of each value, or -1 for values not in the index
+        """
+        values = np.asarray(values).astype(str)
+        if len(self.codes) == 0:
+            return np.full(len(values), -1, dtype=np.int32)
+        positions = np.searchsorted(self.codes, values)
+        positions = np.minimum(positions, len(self.codes) - 1)
+        found = self.codes[positions] == values
+        return np.where(found, positions, -1).astype(np.int32)
+
+    def decode(self, ids):
+        return self.codes[np.asarray(ids)]
+
+
+def normalise_months(values):
+    """Return months as "YYYY-MM-DD" strings, whether they were given as
+    dates, timestamps or strings
+    """
+    codes, uniques = pd.factorize(pd.Series(values))
+    months = pd.to_datetime(pd.Series(uniques)).dt.strftime("%Y-%m-%d").to_numpy()
+    return months[codes]
+
+
+class Denominators:
+    """List sizes (or another denominator) as a months x organisations
+    array, with NaN where an organisation has no list size in a month
+    """
+
+    def __init__(self, list_sizes, org="practice", value="total_list_size"):
+        self.org = org
+        self.value = value
+        months = normalise_months(list_sizes["month"])
+        self.months = CodeIndex(months)
+        self.orgs = CodeIndex(list_sizes[org])
+        month_ids = self.months.encode(months)
+        org_ids = self.orgs.encode(list_sizes[org])
+        self.array = _scatter(
+            month_ids,
+            org_ids,
+            list_sizes[value].to_numpy(dtype="float64"),
+            (len(self.months), len(self.orgs)),
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "array.npy"), self.array)
+        np.save(os.path.join(path, "months.npy"), self.months.codes)
+        np.save(os.path.join(path, "orgs.npy"), self.orgs.codes)
+
+    @classmethod
+    def load(cls, path, org, value):
+        denominators = cls.__new__(cls)
+        denominators.org = org
+        denominators.value = value
+        denominators.array = np.load(os.path.join(path, "array.npy"), mmap_mode="r")
+        denominators.months = CodeIndex.from_sorted(
+            np.load(os.path.join(path, "months.npy"))
+        )
+        denominators.orgs = CodeIndex.from_sorted(
+            np.load(os.path.join(path, "orgs.npy"))
+        )
+        return denominators
+
+
+def load_denominators(
+    list_sizes, org="practice", value="total_list_size", cache_dir=None
+):
+    """Return `Denominators` for `list_sizes`, reusing previously built
+    arrays for the same list sizes, organisation level and value
+
+    Summing to a higher level (e.g. `org="pct"` for CCGs) happens as the
+    array is built.  If `cache_dir` is given, arrays are also kept there
+    between sessions.
+
+    """
+    columns = ["month", org, value]
+    fingerprint = "%016x" % (
+        pd.util.hash_pandas_object(list_sizes[columns], index=False).sum()
+        & 0xFFFFFFFFFFFFFFFF
+    )
+    key = (fingerprint, org, value)
+    if key in _cache:
+        return _cache[key]
+    path = cache_dir and os.path.join(cache_dir, f"{fingerprint}_{org}_{value}")
+    if path and os.path.exists(os.path.join(path, "array.npy")):
+        denominators = Denominators.load(path, org, value)
+    else:
+        denominators = Denominators(list_sizes, org, value)
+        if path:
+            denominators.save(path)
+    _cache[key] = denominators
+    return denominators
+
+
+class Rates:
+    """Numerators, denominators and rates as aligned months x
+    organisations arrays
+    """
+
+    def __init__(self, months, orgs, numerator, denominator, per):
+        self.months = months
+        self.orgs = orgs
+        self.numerator = numerator
+        self.denominator = denominator
+        self.per = per
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.rate = np.where(denominator > 0, numerator / denominator * per, np.nan)
+
+    def to_frame(self, org="org", dropna=True):
+        """Return the rates as a long dataframe with one row per month and
+        organisation
+        """
+        n_months, n_orgs = self.rate.shape
+        df = pd.DataFrame(
+            {
+                "month": np.repeat(self.months.codes, n_orgs),
+                org: np.tile(self.orgs.codes, n_months),
+                "numerator": self.numerator.ravel(),
+                "denominator": np.asarray(self.denominator).ravel(),
+                "rate": self.rate.ravel(),
+            }
+        )
+        if dropna:
+            df = df[df["rate"].notnull()].reset_index(drop=True)
+        return df
+
+
+def compute_rates(numerators, denominators, value="ome_dose", per=1000):
+    """Return `Rates` of `value` per `per` units of denominator
+
+    `numerators` has `month`, the organisation column of `denominators`
+    and `value` columns; rows for organisations or months without a
+    denominator are ignored.
+
+    """
+    month_ids = denominators.months.encode(normalise_months(numerators["month"]))
+    org_ids = denominators.orgs.encode(numerators[denominators.org])
+    numerator = _scatter(
+        month_ids,
+        org_ids,
+        numerators[value].to_numpy(dtype="float64"),
+        denominators.array.shape,
+        fill=0.0,
+    )
+    return Rates(
+        denominators.months, denominators.orgs, numerator, denominators.array, per
+    )
+
+
+def _scatter(row_ids, col_ids, values, shape, fill=np.nan):
+    """Return an array of `shape` holding the sum of `values` at each
+    (row, column), and `fill` where there are none; ids of -1 are ignored
+    """
+    valid = (row_ids >= 0) & (col_ids >= 0)
+    flat = row_ids[valid].astype(np.int64) * shape[1] + col_ids[valid]
+    size = shape[0] * shape[1]
+    sums = np.bincount(flat, weights=values[valid], minlength=size)
+    if np.isnan(fill):
+        counts = np.bincount(flat, minlength=size)
+        sums = np.where(counts > 0, sums, np.nan)
+    return sums.reshape(shape)
@@ -0,0 +1,236 @@
+"""Quick-look estimates of OME measures from a stratified sample.
+
+Checks like "does the new method roughly match the old one" don't need
+every practice and month.  `StratifiedSample` draws a sample of
+practice-months -- by default 1% of those in each CCG, so every CCG is
+represented -- and `quick_look` computes the measures for just the
+sampled rows, with the same factor tables and engine as a full run
+(`lib.measures`), then scales them up:
+
+    frame = practice_months[["practice", "month", "pct"]]
+    quick_look(rx_chunks, [ome_measure(factors), table_measure(...), ITEMS],
+               frame, fraction=0.01,
+               ratios=[("ome_dose", "items")])
+
+Totals are estimated as the sum over strata of the stratum size times
+the mean of the sampled practice-months, and ratios as the ratio of two
+estimated totals.  Standard errors are the usual ones for stratified
+random sampling without replacement (linearised, for ratios), and
+confidence intervals use the normal approximation, so they are only
+reliable when each stratum has a reasonable number of sampled units.
+Practice-months without any prescribing count as zeros, so `frame`
+should list every practice-month in the population, not just those in
+the data.
+
+Given dataframes, every row still has to be read to find the sampled
+ones, so only the aggregation is cheaper.  Given the path of a
+`lib.columnar` dataset (such as `lib.prescribing_csv` writes) instead,
+the sample is pushed into the read: parts without a sampled month are
+skipped, the sampled rows of the rest are found from the practice and
+month codes alone, and only those rows of the other columns are loaded.
+
+"""
+import collections
+import statistics
+
+import numpy as np
+import pandas as pd
+
+from lib import columnar
+from lib.measures import MeasureBatch
+
+UNIT = ("practice", "month")
+
+Estimate = collections.namedtuple(
+    "Estimate", ["estimate", "standard_error", "lower", "upper"]
+)
+
+
+def _unit_index(df, unit):
+    return pd.MultiIndex.from_frame(df[unit].astype(str))
+
+
+class StratifiedSample:
+    """A stratified random sample of the units (practice-months) in
+    `frame`, of `fraction` of each stratum but at least
+    `min_per_stratum` units (or all of them, if fewer)
+    """
+
+    def __init__(
+        self, frame, fraction=0.01, strata=("pct",), seed=0, min_per_stratum=2
+    ):
+        self.fraction = fraction
+        self.strata = list(strata)
+        self.unit = list(UNIT)
+        frame = frame[self.unit + self.strata].drop_duplicates(self.unit)
+        stratum_ids, self.stratum_keys = pd.factorize(
+            pd.MultiIndex.from_frame(frame[self.strata])
+        )
+        self.population_sizes = np.bincount(stratum_ids)
+        self.sample_sizes = np.minimum(
+            self.population_sizes,
+            np.maximum(
+                min_per_stratum, np.rint(fraction * self.population_sizes)
+            ).astype(np.int64),
+        )
+
+        # a random order within each stratum, taking the first n_h units
+        rng = np.random.default_rng(seed)
+        order = np.lexsort((rng.random(len(frame)), stratum_ids))
+        starts = np.concatenate([[0], np.cumsum(self.population_sizes)[:-1]])
+        ranks = np.empty(len(frame), dtype=np.int64)
+        ranks[order] = np.arange(len(frame)) - starts[stratum_ids[order]]
+        selected = ranks < self.sample_sizes[stratum_ids]
+        self.units = frame[selected].reset_index(drop=True)
+        self.unit_strata = stratum_ids[selected]
+        # units are matched on their keys as strings, so sampling frames
+        # and prescribing data needn't use the same column types
+        self._index = _unit_index(self.units, self.unit)
+
+    def __len__(self):
+        return len(self.units)
+
+    def weights(self):
+        """Return the number of population units each sampled unit stands
+        for
+        """
+        return (self.population_sizes / self.sample_sizes)[self.unit_strata]
+
+    def select(self, rx):
+        """Return the rows of `rx` in sampled units
+        """
+        return rx[_unit_index(rx, self.unit).isin(self._index)]
+
+    def _wanted(self, table, name):
+        """Return a mask of the rows of `table` whose `name` column holds a
+        value of a sampled unit
+        """
+        wanted = self.units[name].astype(str).unique()
+        if table.is_dictionary(name):
+            # the extra False is for the missing value code, -1
+            found = np.append(pd.Index(table.dictionary(name)).isin(wanted), False)
+            return found[table.codes(name)]
+        return pd.Index(np.asarray(table.array(name)).astype(str)).isin(wanted)
+
+    def read(self, path, columns=None):
+        """Yield the rows in sampled units of each part of the
+        `lib.columnar` dataset at `path`, loading only those rows
+        """
+        for part in columnar.dataset_parts(path):
+            table = columnar.open_table(part)
+            candidates = np.ones(len(table), dtype=bool)
+            for name in self.unit:
+                candidates &= self._wanted(table, name)
+                if not candidates.any():
+                    break
+            positions = np.flatnonzero(candidates)
+            if not len(positions):
+                continue
+            # a sampled practice in a sampled month needn't be a sampled unit
+            units = table.to_frame(self.unit, positions)
+            positions = positions[_unit_index(units, self.unit).isin(self._index)]
+            yield table.to_frame(columns, positions)
+
+    def unit_values(self, totals, columns):
+        """Return `columns` of `totals` (one row per unit) for each sampled
+        unit, in the order of `units`, with zeros for units not in `totals`
+        """
+        totals = totals[columns].set_axis(_unit_index(totals, self.unit))
+        return totals.reindex(self._index, fill_value=0).to_numpy(dtype="float64")
+
+    def _variance(self, values):
+        """Return the variance of the estimated total of `values` (one per
+        sampled unit)
+        """
+        n_strata = len(self.population_sizes)
+        counts = self.sample_sizes.astype("float64")
+        sums = np.bincount(self.unit_strata, weights=values, minlength=n_strata)
+        means = sums / counts
+        squares = np.bincount(
+            self.unit_strata,
+            weights=(values - means[self.unit_strata]) ** 2,
+            minlength=n_strata,
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sample_variances = np.where(counts > 1, squares / (counts - 1), 0.0)
+        finite_population = 1 - counts / self.population_sizes
+        return float(
+            (
+                self.population_sizes ** 2
+                * finite_population
+                * sample_variances
+                / counts
+            ).sum()
+        )
+
+    def _estimate(self, value, variance, confidence):
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        error = np.sqrt(max(variance, 0.0))
+        return Estimate(value, error, value - z * error, value + z * error)
+
+    def total(self, values, confidence=0.95):
+        """Return the `Estimate` of the population total of `values`, one
+        per sampled unit
+        """
+        values = np.asarray(values, dtype="float64")
+        total = float((values * self.weights()).sum())
+        return self._estimate(total, self._variance(values), confidence)
+
+    def ratio(self, numerator, denominator, confidence=0.95):
+        """Return the `Estimate` of the ratio of the population totals of
+        `numerator` and `denominator`, one value per sampled unit each
+        """
+        numerator = np.asarray(numerator, dtype="float64")
+        denominator = np.asarray(denominator, dtype="float64")
+        weights = self.weights()
+        denominator_total = (denominator * weights).sum()
+        ratio = (numerator * weights).sum() / denominator_total
+        residuals = numerator - ratio * denominator
+        variance = self._variance(residuals) / denominator_total ** 2
+        return self._estimate(float(ratio), variance, confidence)
+
+
+def quick_look(
+    rx,
+    measures,
+    frame,
+    fraction=0.01,
+    strata=("pct",),
+    seed=0,
+    ratios=(),
+    confidence=0.95,
+):
+    """Return estimated totals of `measures` (and ratios between them,
+    given as (numerator, denominator) names) from a stratified sample of
+    the practice-months in `frame`
+
+    `rx` is a dataframe of prescribing rows, an iterable of chunks of
+    them, or the path of a `lib.columnar` dataset of them, from which only
+    rows in sampled practice-months are read.
+
+    """
+    sample = StratifiedSample(frame, fraction, strata, seed)
+    batch = MeasureBatch(measures, by=UNIT)
+    if isinstance(rx, str):
+        columns = list(UNIT) + ["bnf_code"]
+        columns += sorted({measure.value for measure in batch.measures})
+        chunks = sample.read(rx, columns)
+    else:
+        chunks = [rx] if isinstance(rx, pd.DataFrame) else rx
+        chunks = (sample.select(chunk) for chunk in chunks)
+    for chunk in chunks:
+        batch.add(chunk)
+    names = [measure.name for measure in batch.measures]
+    values = sample.unit_values(batch.result(), names)
+    estimates = {
+        name: sample.total(values[:, i], confidence) for i, name in enumerate(names)
+    }
+    for numerator, denominator in ratios:
+        estimates[f"{numerator}/{denominator}"] = sample.ratio(
+            values[:, names.index(numerator)],
+            values[:, names.index(denominator)],
+            confidence,
+        )
+    df = pd.DataFrame.from_dict(estimates, orient="index", columns=Estimate._fields)
+    df.index.name = "estimate_of"
+    return df.reset_index().assign(sampled_units=len(sample))
@@ -0,0 +1,230 @@
+"""Grouped sums within a memory budget, spilling partitions to disk.
+
+Grouping practice-level OME by month, practice and ingredient (as in the
+`Untitled2` notebook) over the full history gives far more groups than
+a pandas groupby can hold on an analysis VM.  `SpillingAggregator` takes
+the rows a chunk at a time and keeps partial sums in memory; when they
+outgrow `memory_budget` bytes, they are hash partitioned on the group
+key and each partition is appended to its own `lib.columnar` dataset in
+a temporary directory.  Every group lands in the same partition each
+time, so once the input is exhausted each partition can be summed on
+its own, needing only about 1/`partitions` of the memory:
+
+    aggregator = SpillingAggregator(["month", "practice", "ing"],
+                                    memory_budget=4 * 2 ** 30)
+    for chunk in chunks:
+        aggregator.add(chunk)
+    aggregator.write("data/ome_by_ingredient")    # or .result()
+
+While everything fits in the budget, nothing is written to disk.  A
+partition which is still too big to sum within the budget (because
+there were more groups than `partitions` times the budget allows) is
+itself read back a spilled part at a time and partitioned again, on
+other bits of the same hashes.  Either way, the result has the column
+types of the input, except that a categorical column (e.g. from the
+parts of a `lib.columnar` dataset, each with its own dictionary) has all
+the categories seen in any chunk.
+
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from lib import columnar
+
+DEFAULT_PARTITIONS = 16
+HASH_BITS = 64
+
+
+def _memory(df):
+    """Return the memory used by the rows of `df`, leaving out the
+    categories of categorical columns, which don't grow with the number
+    of groups
+    """
+    return sum(
+        df[name].cat.codes.nbytes
+        if isinstance(df[name].dtype, pd.CategoricalDtype)
+        else df[name].memory_usage(deep=True, index=False)
+        for name in df.columns
+    )
+
+
+def _with_dtypes(df, dtypes, categorical_only=False):
+    """Return `df` with the columns types `dtypes`, or only its
+    categorical columns, if `categorical_only`
+    """
+    for name, dtype in dtypes.items():
+        if categorical_only and not isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if df[name].dtype != dtype:
+            df = df.assign(**{name: df[name].astype(dtype)})
+    return df
+
+
+def _sum(df, by):
+    return df.groupby(by, dropna=False, observed=True, sort=False).sum().reset_index()
+
+
+class SpillingAggregator:
+    """Sums of every column other than `by`, grouped by `by`, using about
+    `memory_budget` bytes for partial sums (or unbounded, if None)
+    """
+
+    def __init__(
+        self,
+        by,
+        memory_budget=None,
+        spill_dir=None,
+        partitions=DEFAULT_PARTITIONS,
+        level=0,
+    ):
+        self.by = list(by)
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.partitions = partitions
+        # spilled partitions are partitioned again at the next level, on
+        # the next digits (base `partitions`) of each row's hash
+        self.level = level
+        self._dtypes = None
+        self._partials = []
+        self._memory = 0
+        self._tmp_dir = None
+        self._writers = None
+
+    @property
+    def spilled(self):
+        return self._writers is not None
+
+    def add(self, df):
+        """Add the rows of `df` (the `by` columns and columns to sum)
+        """
+        partial = _sum(df, self.by)
+        self._update_dtypes(partial)
+        self._partials.append(partial)
+        self._memory += _memory(partial)
+        if self.memory_budget is not None and self._memory > self.memory_budget:
+            combined = self._combine()
+            memory = _memory(combined)
+            if memory > self.memory_budget / 2 and self._can_spill(combined):
+                self._spill(combined)
+                combined, memory = combined.iloc[:0], 0
+            self._partials, self._memory = [combined], memory
+
+    def _update_dtypes(self, partial):
+        """Record the column types of the result: those of the first chunk,
+        with the categories of every chunk for categorical columns
+        """
+        if self._dtypes is None:
+            self._dtypes = partial.dtypes.copy()
+            return
+        for name, dtype in partial.dtypes.items():
+            current = self._dtypes[name]
+            if (
+                isinstance(current, pd.CategoricalDtype)
+                and isinstance(dtype, pd.CategoricalDtype)
+                and not dtype.categories.isin(current.categories).all()
+            ):
+                self._dtypes[name] = pd.CategoricalDtype(
+                    current.categories.union(dtype.categories)
+                )
+
+    def _combine(self):
+        """Return the partial sums in memory summed together
+        """
+        partials = [
+            _with_dtypes(partial, self._dtypes, categorical_only=True)
+            for partial in self._partials
+        ]
+        return _sum(pd.concat(partials, ignore_index=True), self.by)
+
+    def _can_spill(self, df):
+        # a single group can't be split, nor can a partition once every
+        # bit of the hashes has been used
+        return len(df) > 1 and self.partitions ** (self.level + 1) <= 2 ** HASH_BITS
+
+    def _spill(self, df):
+        if self._writers is None:
+            if self.spill_dir is not None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._tmp_dir = tempfile.mkdtemp(dir=self.spill_dir, prefix="spill-")
+            self._writers = [
+                columnar.DatasetWriter(os.path.join(self._tmp_dir, f"{i:03d}"))
+                for i in range(self.partitions)
+            ]
+        # numeric keys are hashed as floats, so that a group gets the same
+        # partition whether a chunk held its key as an int or a float
+        keys = df[self.by].apply(
+            lambda column: column.astype("float64")
+            if column.dtype.kind in "iub"
+            else column
+        )
+        hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+        hashes = hashes // np.uint64(self.partitions) ** np.uint64(self.level)
+        partitions = (hashes % np.uint64(self.partitions)).astype(np.int64)
+        order = np.argsort(partitions, kind="stable")
+        bounds = np.searchsorted(
+            partitions[order], np.arange(self.partitions + 1), side="left"
+        )
+        for i, writer in enumerate(self._writers):
+            rows = order[bounds[i] : bounds[i + 1]]
+            if len(rows):
+                writer.write(df.iloc[rows].reset_index(drop=True))
+
+    def _read(self, path):
+        """Return a spilled part, with the column types of the input
+        """
+        return _with_dtypes(columnar.read_table(path), self._dtypes)
+
+    def results(self):
+        """Yield the sums, one dataframe per partition, and remove any
+        spilled files
+        """
+        combined = self._combine() if self._partials else None
+        self._partials, self._memory = [], 0
+        if not self.spilled:
+            if combined is not None:
+                yield combined
+            return
+        try:
+            if combined is not None and len(combined):
+                self._spill(combined)
+            for writer in self._writers:
+                # sum the partition within the budget too, partitioning
+                # it again if need be
+                partition = SpillingAggregator(
+                    self.by,
+                    self.memory_budget,
+                    self._tmp_dir,
+                    self.partitions,
+                    self.level + 1,
+                )
+                for path in columnar.dataset_parts(writer.path):
+                    partition.add(self._read(path))
+                yield from partition.results()
+        finally:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir, self._writers = None, None
+
+    def result(self):
+        """Return all the sums as one dataframe, sorted by `by`
+        """
+        frames = list(self.results())
+        if not frames:
+            columns = self.by if self._dtypes is None else list(self._dtypes.index)
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(frames, ignore_index=True)
+        return df.sort_values(self.by, na_position="last", ignore_index=True)
+
+    def write(self, path):
+        """Write the sums as a `lib.columnar` dataset at `path`, one part
+        per partition, and return the number of groups
+        """
+        writer = columnar.DatasetWriter(path)
+        groups = 0
+        for df in self.results():
+            writer.write(df)
+            groups += len(df)
+        return groups
@@ -0,0 +1,276 @@
+"""Synthetic practice level opioid prescribing, for benchmarks and scale
+tests.
+
+The presentations, and how much of each is prescribed nationally, come
+from the extracts in `data/` (`df_opioid_total_ome_old_class_dmd.csv`
+and `df_opioid_total_ome_old_class_measure.csv`), which give the total
+quantity and OME of each presentation.  Each presentation gets a typical
+quantity per item (`typical_quantities`) from its OME per unit, as
+prescriptions of stronger presentations are for fewer units: patches
+come a few at a time, weak oral solutions by the hundred ml.  Its share
+of the rows is its total quantity over its typical quantity, so in
+expectation every presentation's share of the quantity, and so of the
+OME, is that in the extracts.
+
+For each practice and month a Poisson number of rows is drawn (scaled
+by a per-practice size), each row's presentation is drawn from those
+shares, its items from a fixed distribution and its quantity per item
+from a lognormal around the presentation's typical quantity; rows for
+the same practice, month and presentation are combined, so the output
+has the same key as `normalised_prescribing`.
+
+Output is generated in blocks of practices, each from its own random
+generator seeded with `(seed, block)`, so the same arguments always
+give the same rows, and a block can be regenerated on its own:
+
+    SyntheticPrescribing(n_practices=7000, n_months=120).write("data/synthetic")
+
+or
+
+    python -m lib.synthetic data/synthetic --practices 7000 --months 120
+
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from lib import columnar
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+DMD_EXTRACT = os.path.join(DATA_DIR, "df_opioid_total_ome_old_class_dmd.csv")
+MEASURE_EXTRACT = os.path.join(DATA_DIR, "df_opioid_total_ome_old_class_measure.csv")
+
+# per row: items ~ 1 + Poisson(EXTRA_ITEMS_MEAN); quantity per item is
+# lognormal with sigma QUANTITY_PER_ITEM_SIGMA and the presentation's
+# typical quantity as median.  Typical quantities are proportional to
+# (OME per unit) ** -QUANTITY_OME_EXPONENT, have this median over the
+# OME prescribed, and are kept within QUANTITY_PER_ITEM_RANGE
+EXTRA_ITEMS_MEAN = 1.5
+QUANTITY_OME_EXPONENT = 0.5
+QUANTITY_PER_ITEM_MEDIAN = 56
+QUANTITY_PER_ITEM_RANGE = (1, 500)
+QUANTITY_PER_ITEM_SIGMA = 0.6
+# spread of practice sizes (lognormal sigma)
+PRACTICE_SIZE_SIGMA = 0.5
+
+
+def load_presentations(dmd_path=DMD_EXTRACT, measure_path=MEASURE_EXTRACT):
+    """Return each presentation in either extract, with its total
+    quantity and OME per unit, sorted by BNF code
+    """
+    dmd = pd.read_csv(dmd_path).rename(columns={"new_quantity": "quantity"})
+    measure = pd.read_csv(measure_path).rename(
+        columns={"old_quantity": "quantity", "total_ome": "ome_dose"}
+    )
+    columns = ["bnf_code", "bnf_name", "quantity", "ome_dose"]
+    # prefer the dm+d figures where a presentation is in both
+    presentations = pd.concat([dmd[columns], measure[columns]], ignore_index=True)
+    presentations = presentations.drop_duplicates("bnf_code", keep="first")
+    presentations = presentations[presentations["quantity"] > 0]
+    presentations = presentations.sort_values("bnf_code").reset_index(drop=True)
+    presentations["ome_per_unit"] = (
+        presentations["ome_dose"] / presentations["quantity"]
+    )
+    return presentations.drop(columns="ome_dose")
+
+
+def typical_quantities(presentations, median=QUANTITY_PER_ITEM_MEDIAN):
+    """Return the typical quantity per item of each presentation from
+    `load_presentations`
+
+    This falls with the OME per unit (though not in proportion: a
+    prescription of co-codamol 8/500 is for fewer mg of morphine
+    equivalent than one of morphine tablets), scaled so that its median,
+    weighted by the OME prescribed, is `median`.  Presentations without
+    an OME per unit get `median`.
+
+    """
+    ome_per_unit = presentations["ome_per_unit"].to_numpy(dtype="float64")
+    priced = ome_per_unit > 0
+    typical = np.full(len(presentations), float(median))
+    if priced.any():
+        relative = ome_per_unit[priced] ** -QUANTITY_OME_EXPONENT
+        ome = (presentations["quantity"] * presentations["ome_per_unit"])[priced]
+        order = np.argsort(relative, kind="stable")
+        cumulative = np.cumsum(ome.to_numpy(dtype="float64")[order])
+        middle = relative[order][np.searchsorted(cumulative, cumulative[-1] / 2)]
+        typical[priced] = median * relative / middle
+    return np.clip(typical, *QUANTITY_PER_ITEM_RANGE)
+
+
+class SyntheticPrescribing:
+    """A reproducible synthetic prescribing table of `n_practices`
+    practices (in `n_ccgs` CCGs) over `n_months` months from `start`,
+    with on average `rows_per_practice_month` rows per practice and month
+    """
+
+    def __init__(
+        self,
+        n_practices=7000,
+        n_months=12,
+        start="2019-01-01",
+        rows_per_practice_month=60,
+        n_ccgs=200,
+        seed=0,
+        presentations=None,
+    ):
+        self.n_practices = n_practices
+        self.n_months = n_months
+        self.rows_per_practice_month = rows_per_practice_month
+        self.seed = seed
+        if presentations is None:
+            presentations = load_presentations()
+        self.presentations = presentations
+        self._typical_quantity = typical_quantities(presentations)
+        weights = (
+            presentations["quantity"].to_numpy(dtype="float64") / self._typical_quantity
+        )
+        self._cumulative = np.cumsum(weights / weights.sum())
+        # names aren't unique to a code, so they get their own dictionary
+        self._name_ids, self._names = pd.factorize(presentations["bnf_name"])
+        self.months = pd.date_range(start, periods=n_months, freq="MS").strftime(
+            "%Y-%m-%d"
+        )
+        self.practices = np.array([f"S{i:05d}" for i in range(n_practices)])
+        self.ccgs = np.array([f"{i:02d}S" for i in range(n_ccgs)])
+        rng = np.random.default_rng([seed, 2 ** 32 - 1])
+        self.practice_ccg = rng.integers(0, n_ccgs, n_practices)
+        self.practice_size = rng.lognormal(0, PRACTICE_SIZE_SIGMA, n_practices)
+
+    def _sorted_presentations(self, rng, rows):
+        """Return (cell, presentation) for `rows[i]` random rows in each
+        cell `i`, with presentations in ascending order within each cell
+
+        The uniform variates for each cell are generated already sorted,
+        as the normalised cumulative sums of `rows[i] + 1` exponential
+        variates, so no sort is needed.
+
+        """
+        slots = rows + 1
+        slot_cell = np.repeat(np.arange(len(rows)), slots)
+        cumulative = np.cumsum(rng.standard_exponential(int(slots.sum())))
+        ends = np.cumsum(slots) - 1
+        starts = ends - rows
+        base = np.where(starts > 0, cumulative[np.maximum(starts - 1, 0)], 0.0)
+        totals = cumulative[ends] - base
+        keep = np.ones(len(slot_cell), dtype=bool)
+        keep[ends] = False
+        row_cell = slot_cell[keep]
+        uniform = (cumulative[keep] - base[row_cell]) / totals[row_cell]
+        ids = np.searchsorted(self._cumulative, uniform, side="right")
+        return row_cell, np.minimum(ids, len(self._cumulative) - 1)
+
+    def block(self, number, practices_per_block=1000):
+        """Return the rows for practices `number * practices_per_block` up
+        to the next block, for every month
+        """
+        rng = np.random.default_rng([self.seed, number])
+        first = number * practices_per_block
+        practices = np.arange(first, min(first + practices_per_block, self.n_practices))
+        # one cell per practice and month, practice major
+        cell_practice = np.repeat(practices, self.n_months)
+        cell_month = np.tile(np.arange(self.n_months), len(practices))
+        rows = rng.poisson(
+            self.rows_per_practice_month * self.practice_size[cell_practice]
+        )
+        row_cell, presentation = self._sorted_presentations(rng, rows)
+        n = len(row_cell)
+        items = 1 + rng.poisson(EXTRA_ITEMS_MEAN, n)
+        quantity_per_item = np.maximum(
+            np.rint(
+                self._typical_quantity[presentation]
+                * rng.lognormal(0, QUANTITY_PER_ITEM_SIGMA, n)
+            ),
+            1,
+        )
+
+        # rows are sorted by cell and presentation, so rows for the same
+        # cell and presentation are adjacent and can be combined in place
+        n_presentations = len(self._cumulative)
+        row_keys = row_cell.astype(np.int64) * n_presentations + presentation
+        starts = np.flatnonzero(np.diff(row_keys, prepend=-1) != 0)
+        keys = row_keys[starts]
+        quantity = np.add.reduceat(items * quantity_per_item, starts)
+        items = np.add.reduceat(items, starts)
+        cells, presentation = np.divmod(keys, n_presentations)
+        return self._frame(
+            cell_practice[cells], cell_month[cells], presentation, items, quantity
+        )
+
+    def _frame(self, practice, month, presentation, items, quantity):
+        codes = self.presentations["bnf_code"].to_numpy()
+        return pd.DataFrame(
+            {
+                "month": pd.Categorical.from_codes(month, categories=self.months),
+                "practice": pd.Categorical.from_codes(
+                    practice, categories=self.practices
+                ),
+                "pct": pd.Categorical.from_codes(
+                    self.practice_ccg[practice], categories=self.ccgs
+                ),
+                "bnf_code": pd.Categorical.from_codes(presentation, categories=codes),
+                "bnf_name": pd.Categorical.from_codes(
+                    self._name_ids[presentation], categories=self._names
+                ),
+                "items": items,
+                "quantity": quantity,
+            }
+        )
+
+    def blocks(self, practices_per_block=1000):
+        n_blocks = -(-self.n_practices // practices_per_block)
+        for number in range(n_blocks):
+            yield self.block(number, practices_per_block)
+
+    def write(self, path, practices_per_block=1000):
+        """Write the table as a `lib.columnar` dataset at `path`, one part
+        per block, replacing any existing dataset, and return the number
+        of rows
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        try:
+            writer = columnar.DatasetWriter(tmp_dir)
+            rows = 0
+            for df in self.blocks(practices_per_block):
+                writer.write(df)
+                rows += len(df)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp_dir, path)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic prescribing data")
+    parser.add_argument("path", help="path of the dataset to write")
+    parser.add_argument("--practices", type=int, default=7000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--start", default="2019-01-01")
+    parser.add_argument("--rows-per-practice-month", type=float, default=60)
+    parser.add_argument("--ccgs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--practices-per-block", type=int, default=1000)
+    args = parser.parse_args()
+    synthetic = SyntheticPrescribing(
+        n_practices=args.practices,
+        n_months=args.months,
+        start=args.start,
+        rows_per_practice_month=args.rows_per_practice_month,
+        n_ccgs=args.ccgs,
+        seed=args.seed,
+    )
+    rows = synthetic.write(args.path, args.practices_per_block)
+    print(f"Wrote {rows} rows to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
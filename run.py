@@ -2,12 +2,15 @@
 browser on the correct port, and handle shutdowns gracefully
 
 """
+import hashlib
+import http.client
 import os
 import signal
 import subprocess
 import socket
 import sys
 import time
+import urllib.error
 import urllib.request
 import webbrowser
 
@@ -15,26 +18,42 @@ tag = "datalab-notebook"
 current_dir = os.getcwd()
 target_dir = "/home/app/notebook"
 
-
-def await_jupyter_http(port):
-    """Wait up to 10 seconds for Jupyter to be available
+# Everything the Dockerfile copies into the image; if none of these have
+# changed since the image was last built, we don't need to rebuild it
+build_inputs = [
+    "Dockerfile",
+    "requirements.txt",
+    "config/kernel.json",
+    "config/prewarm_imports.py",
+    "config/profile_cells.py",
+]
+build_hash_label = "org.ebmdatalab.build-hash"
+
+
+def await_jupyter_http(port, timeout=120):
+    """Wait up to `timeout` seconds for the Jupyter API to respond,
+    backing off exponentially between attempts
     """
     print(f"Waiting for Jupyter to be ready on port {port}")
-    timeout = 10
-    increment = 0.1
-    counter = 0
-    url = f"http://localhost:{port}"
-    while counter < (timeout / increment):
+    url = f"http://localhost:{port}/api"
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while True:
         try:
-            with urllib.request.urlopen(url, timeout=timeout):
+            with urllib.request.urlopen(url, timeout=5):
                 return
-        except ConnectionResetError:
-            counter += 1
-            time.sleep(increment)
-        except socket.timeout:
-            break
-
-    raise SystemError(f"Unable to reach Jupyter at {url}")
+        except (
+            ConnectionError,
+            http.client.HTTPException,
+            socket.timeout,
+            urllib.error.URLError,
+        ):
+            # the server isn't listening yet, or is still starting up
+            pass
+        if time.monotonic() + delay > deadline:
+            raise SystemError(f"Unable to reach Jupyter at {url}")
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
 
 
 def stream_subprocess_output(cmd):
@@ -54,19 +73,66 @@ def stream_subprocess_output(cmd):
             raise subprocess.CalledProcessError(cmd=cmd, returncode=p.returncode)
 
 
+def build_hash():
+    """Return a hash of all the files that go into the docker image
+    """
+    digest = hashlib.sha256()
+    for path in build_inputs:
+        digest.update(path.encode("utf8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def docker_image_hash(tag):
+    """Return the build hash the image `tag` was labelled with, or None if
+    there is no such image
+    """
+    completed_process = subprocess.run(
+        [
+            "docker",
+            "image",
+            "inspect",
+            "--format",
+            f'{{{{ index .Config.Labels "{build_hash_label}" }}}}',
+            tag,
+        ],
+        capture_output=True,
+    )
+    if completed_process.returncode != 0:
+        return None
+    return completed_process.stdout.decode("utf8").strip() or None
+
+
 def docker_build(tag):
-    """Build container for Dockerfile in current directory
+    """Build container for Dockerfile in current directory, unless an
+    image built from the same inputs already exists
     """
+    current_hash = build_hash()
+    if docker_image_hash(tag) == current_hash:
+        print("Docker image is up to date; skipping build")
+        return
     print(
         "Building docker image. This may take some time (particularly on the first run)..."
     )
-    buildcmd = ["docker", "build", "-t", tag, "-f", "Dockerfile", "."]
+    buildcmd = [
+        "docker",
+        "build",
+        "-t",
+        tag,
+        "--label",
+        f"{build_hash_label}={current_hash}",
+        "-f",
+        "Dockerfile",
+        ".",
+    ]
     stream_subprocess_output(buildcmd)
 
 
-def docker_run(tag):
+def docker_run(tag, cmd=None):
     """Run docker in background, and install signal handler to stop it
-    again
+    again.  If `cmd` is given, run that in the container instead of
+    Jupyter
 
     """
     print("Running docker...")
@@ -78,8 +144,10 @@ def docker_run(tag):
         "--mount",
         f"source={current_dir},dst={target_dir},type=bind",
         "--publish-all",
-        tag,
     ]
+    if cmd:
+        runcmd += ["--workdir", target_dir, "--env", f"PYTHONPATH={target_dir}"]
+    runcmd += [tag] + (cmd or [])
     completed_process = subprocess.run(runcmd, check=True, capture_output=True)
     container_id = completed_process.stdout.decode("utf8").strip()
 
@@ -93,18 +161,38 @@ def docker_run(tag):
     return container_id
 
 
-def docker_port(container_id):
-    """Return the port that the specified container is listening on
+def docker_port(container_id, container_port="8888/tcp"):
+    """Return the host port that `container_port` in the specified
+    container is published on
     """
     completed_process = subprocess.run(
-        ["docker", "port", container_id], check=True, capture_output=True
+        ["docker", "port", container_id, container_port],
+        check=True,
+        capture_output=True,
     )
     port_mapping = completed_process.stdout.decode("utf8").strip()
     port = port_mapping.split(":")[-1]
     return port
 
 
+def serve_ome_api(store_path):
+    """Serve the OME results store at `store_path` (relative to this
+    directory) with `lib.ome_api`
+    """
+    docker_build(tag)
+    container_id = docker_run(
+        tag, ["python", "-m", "lib.ome_api", store_path, "--port", "8000"]
+    )
+    port = docker_port(container_id, "8000/tcp")
+    print(f"Serving OME API at http://localhost:{port}/ome/; use Ctrl+C to stop")
+    stream_subprocess_output(["docker", "logs", "--follow", container_id])
+
+
 def main():
+    if sys.argv[1:2] == ["api"]:
+        store_path = sys.argv[2] if len(sys.argv) > 2 else "data/ome_store"
+        serve_ome_api(store_path)
+        return
     docker_build(tag)
     container_id = docker_run(tag)
     port = docker_port(container_id)
@@ -0,0 +1,217 @@
+"""Run the notebook tests (pytest with nbval) in parallel, skipping
+notebooks that haven't changed since they last passed
+
+Each notebook is fingerprinted from its own contents, the files in
+`data/` that it refers to, the modules in `lib/` that it imports
+(directly or through other `lib` modules), the pinned requirements and
+the test configuration (`config/nbval_sanitize_file.conf` and
+`notebooks/conftest.py`).  Notebooks whose fingerprint matches their last
+passing run are skipped; the rest are run as separate pytest processes,
+several at a time.
+
+With `--profile`, every cell is timed as it runs and a report written
+next to each notebook's jupytext output (see `lib/cell_profiler.py`).
+
+"""
+import argparse
+import ast
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+
+cache_path = os.environ.get("NOTEBOOK_TEST_CACHE", ".notebook_test_cache.json")
+sanitize_config = os.path.join("config", "nbval_sanitize_file.conf")
+shared_inputs = [
+    sanitize_config,
+    os.path.join("notebooks", "conftest.py"),
+    "requirements.txt",
+]
+
+# A python warning filter.  For this one, see #20
+warning_filter = "ignore:KernelManager._kernel_spec_manager_changed:DeprecationWarning"
+
+# pytest's exit code when no tests are collected, which we don't treat
+# as a failure
+NO_TESTS_COLLECTED = 5
+
+
+def find_notebooks(root="notebooks"):
+    return sorted(
+        path
+        for path in glob.glob(os.path.join(root, "**", "*.ipynb"), recursive=True)
+        if ".ipynb_checkpoints" not in path
+    )
+
+
+def lib_imports(source):
+    """Return the names of the `lib` modules imported by python `source`
+    """
+    # IPython magics and shell escapes aren't python
+    source = re.sub(r"(?m)^\s*[%!].*$", "", source)
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return set(re.findall(r"\blib\.(\w+)", source))
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            # `from lib import x` may import the module lib.x
+            names = [node.module] + [
+                f"{node.module}.{alias.name}" for alias in node.names
+            ]
+        else:
+            continue
+        for name in names:
+            parts = name.split(".")
+            if parts[0] == "lib" and len(parts) > 1:
+                modules.add(parts[1])
+    return modules
+
+
+def notebook_inputs(notebook_path):
+    """Return the data files that a notebook refers to and the lib modules
+    that it imports, directly or through other lib modules
+    """
+    with open(notebook_path, encoding="utf8") as f:
+        text = f.read()
+    inputs = []
+    for path in sorted(glob.glob(os.path.join("data", "**", "*"), recursive=True)):
+        if os.path.isfile(path) and os.path.basename(path) in text:
+            inputs.append(path)
+
+    cells = json.loads(text).get("cells", [])
+    to_visit = set()
+    for cell in cells:
+        if cell.get("cell_type") == "code":
+            source = cell.get("source", "")
+            to_visit |= lib_imports(
+                "".join(source) if isinstance(source, list) else source
+            )
+    modules = set()
+    while to_visit:
+        module = to_visit.pop()
+        path = os.path.join("lib", f"{module}.py")
+        if module in modules or not os.path.exists(path):
+            continue
+        modules.add(module)
+        with open(path, encoding="utf8") as f:
+            to_visit |= lib_imports(f.read()) - modules
+    inputs.extend(os.path.join("lib", f"{module}.py") for module in sorted(modules))
+    return inputs
+
+
+def fingerprint(notebook_path):
+    digest = hashlib.sha256()
+    for path in [notebook_path] + shared_inputs + notebook_inputs(notebook_path):
+        digest.update(path.encode("utf8"))
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_cache():
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def run_notebook(notebook_path, profile=False):
+    """Run the nbval tests for one notebook, returning its exit code and
+    output
+    """
+    cmd = [
+        sys.executable,
+        "-m",
+        "pytest",
+        "--sanitize-with",
+        sanitize_config,
+        "--nbval",
+        notebook_path,
+        "-W",
+        warning_filter,
+    ]
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    if profile:
+        env["NOTEBOOK_PROFILE"] = "1"
+        env["NOTEBOOK_PROFILE_NAME"] = os.path.splitext(
+            os.path.basename(notebook_path)
+        )[0]
+    completed_process = subprocess.run(
+        cmd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    return completed_process.returncode, completed_process.stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of notebooks to test at once",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="test every notebook, ignoring the cache"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write a per-cell profile report for each notebook tested",
+    )
+    parser.add_argument("notebooks", nargs="*", help="notebooks to test (default: all)")
+    args = parser.parse_args()
+
+    cache = load_cache()
+    to_run = {}
+    for notebook_path in args.notebooks or find_notebooks():
+        current = fingerprint(notebook_path)
+        if not args.force and cache.get(notebook_path) == current:
+            print(f"Skipping {notebook_path} (unchanged since it last passed)")
+        else:
+            to_run[notebook_path] = current
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(run_notebook, path, args.profile): path for path in to_run
+        }
+        for future in concurrent.futures.as_completed(futures):
+            notebook_path = futures[future]
+            returncode, output = future.result()
+            print(output, end="")
+            if returncode in (0, NO_TESTS_COLLECTED):
+                cache[notebook_path] = to_run[notebook_path]
+            else:
+                cache.pop(notebook_path, None)
+                failed.append(notebook_path)
+
+    save_cache(cache)
+    if failed:
+        print("Failed notebooks:\n" + "\n".join(sorted(failed)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
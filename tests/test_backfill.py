@@ -0,0 +1,55 @@
+"""Shards can be claimed, released, requeued and claimed again"""
+import os
+
+import pandas as pd
+import pytest
+
+from lib.backfill import FileCoordinator, Shard, make_shards, run_worker, shard_id
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+    coordinator = FileCoordinator(str(tmp_path))
+    coordinator.submit([Shard("2020-01", "North/East")])
+    return coordinator
+
+
+def test_claim_after_release(coordinator):
+    shard = coordinator.claim("a")
+    coordinator.release(shard)
+    assert coordinator.claim("b") == shard
+    assert coordinator.claim("c") is None
+
+
+def test_claim_after_requeue_stale(coordinator):
+    shard = coordinator.claim("a")
+    assert coordinator.requeue_stale(-1) == 1
+    assert coordinator.claim("b") == shard
+    assert coordinator.status() == {"pending": 0, "claimed": 1, "done": 0}
+
+
+def test_shard_ids_are_file_names():
+    ids = {shard_id(shard) for shard in make_shards(["2020_01"], ["a/b", "a_b"])}
+    assert len(ids) == 2
+    assert all(os.sep not in name for name in ids)
+
+
+def compute(shard):
+    return pd.DataFrame({"month": [shard.month], "region": [shard.region]})
+
+
+def test_run_worker_retries_failures(tmp_path):
+    root = str(tmp_path)
+    shards = make_shards(["2020-01", "2020-02"], ["A", "B"])
+    FileCoordinator(root).submit(shards)
+    calls = []
+
+    def flaky(shard):
+        calls.append(shard)
+        if calls.count(shard) == 1:
+            raise ValueError(shard)
+        return compute(shard)
+
+    assert run_worker(root, flaky, heartbeat=0.1) == len(shards)
+    result = FileCoordinator(root).merge_results()
+    assert sorted(map(tuple, result.to_numpy())) == sorted(shards)
@@ -0,0 +1,46 @@
+"""BNF hierarchy rollups match a pandas groupby on the code prefix"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.bnf_hierarchy import BNFHierarchy
+
+VALUES = ["old_quantity", "total_ome"]
+
+
+@pytest.fixture
+def df():
+    df = pd.read_csv("data/df_opioid_total_ome_old_class_measure.csv")
+    assert df[VALUES].isna().any().any()
+    return df
+
+
+def expected(df, length, prefix=""):
+    df = df[df["bnf_code"].str.startswith(prefix)]
+    return (
+        df.groupby(df["bnf_code"].str[:length])[VALUES]
+        .sum()
+        .reset_index()
+        .sort_values("bnf_code", ignore_index=True)
+    )
+
+
+@pytest.mark.parametrize("exact", [False, True])
+@pytest.mark.parametrize(
+    "level,length,prefix", [("chapter", 2, ""), ("chemical", 9, "0407")]
+)
+def test_rollup_matches_groupby(df, exact, level, length, prefix):
+    hierarchy = BNFHierarchy(df, values=VALUES, exact=exact)
+    result = hierarchy.rollup(level, prefix)
+    pd.testing.assert_frame_equal(result, expected(df, length, prefix))
+
+
+def test_total_matches_sum(df):
+    hierarchy = BNFHierarchy(df, values=VALUES)
+    total = hierarchy.total("04")
+    assert not total[VALUES].isna().any()
+    np.testing.assert_allclose(
+        total[VALUES].astype(float),
+        df.loc[df["bnf_code"].str.startswith("04"), VALUES].sum().to_numpy(),
+        rtol=1e-12,
+    )
@@ -0,0 +1,60 @@
+"""Coverage deltas find the same presentations as an outer merge"""
+import pandas as pd
+import pytest
+
+from lib.coverage import PresentationCoverage
+
+
+@pytest.fixture
+def frames():
+    return {
+        "dmd": pd.read_csv("data/df_opioid_total_ome_old_class_dmd.csv"),
+        "measure": pd.read_csv("data/df_opioid_total_ome_old_class_measure.csv"),
+    }
+
+
+def test_compare_matches_outer_merge(frames):
+    coverage = PresentationCoverage()
+    for methodology, df in frames.items():
+        coverage.add_frame(df, methodology)
+    result = coverage.compare("measure", "dmd")
+
+    merged = (
+        frames["dmd"][["bnf_code"]]
+        .drop_duplicates()
+        .merge(
+            frames["measure"][["bnf_code"]].drop_duplicates(),
+            how="outer",
+            indicator=True,
+        )
+    )
+    for change, side in (("added", "left_only"), ("removed", "right_only")):
+        codes = result.loc[result["change"] == change, "bnf_code"]
+        expected = merged.loc[merged["_merge"] == side, "bnf_code"]
+        assert list(codes) == sorted(expected)
+    assert result["bnf_name"].notna().all()
+    assert set(result["methodology_old"]) == {"measure"}
+
+
+def test_release_changes_by_month():
+    coverage = PresentationCoverage()
+    releases = {
+        "2020-01": {"1": ["A", "B"], "2": ["A", "C"]},
+        "2020-02": {"1": ["A"], "2": ["A"], "3": ["B"]},
+    }
+    for month, by_release in releases.items():
+        for release, codes in by_release.items():
+            df = pd.DataFrame({"bnf_code": codes, "month": month})
+            coverage.add_frame(df, "dmd", release=release, month_column="month")
+    result = coverage.release_changes("dmd")
+    assert list(
+        result[
+            ["month", "release_old", "release_new", "bnf_code", "change"]
+        ].itertuples(index=False, name=None)
+    ) == [
+        ("2020-01", "1", "2", "C", "added"),
+        ("2020-01", "1", "2", "B", "removed"),
+        ("2020-02", "2", "3", "B", "added"),
+        ("2020-02", "2", "3", "A", "removed"),
+    ]
+    assert list(coverage.codes("dmd", "3", "2020-02")) == ["B"]
@@ -0,0 +1,139 @@
+"""dm+d releases, as XML or CSV, survive a round trip through a snapshot"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.dmd import COLUMNS, DmdSnapshot, load_release, write_snapshot
+
+TABLES = {
+    "vmp": pd.DataFrame(
+        {
+            "id": [322, 111, 205],
+            "nm": ["Morphine 10mg tablets", "Fentanyl patches", "Co-codamol"],
+            "bnf_code": ["0407020Q0AAAEAE", "0407020A0AAAHAH", None],
+            "udfs": [1.0, np.nan, 2.5],
+        }
+    ),
+    "vpi": pd.DataFrame(
+        {
+            "vmp": [322, 111, 205, 205, 999],
+            "ing": [3, 1, 2, 4, 1],
+            "strnt_nmrtr_val": [10.0, 25.0, 30.0, 500.0, 1.0],
+            "strnt_nmrtr_uom": [10, 20, 10, 10, 30],
+            "strnt_dnmtr_val": [np.nan, 1.0, np.nan, np.nan, np.nan],
+            "strnt_dnmtr_uom": [-1, 40, -1, -1, -1],
+        }
+    ),
+    "ing": pd.DataFrame(
+        {"id": [3, 1, 2, 4], "nm": ["Morphine", "Fentanyl", "Codeine", "Paracetamol"]}
+    ),
+    "ont": pd.DataFrame({"vmp": [322, 111, 205], "form": [7, 5, 7]}),
+    "ontformroute": pd.DataFrame(
+        {"cd": [7, 5], "descr": ["tablet.oral", "patch.transdermal"]}
+    ),
+    "unitofmeasure": pd.DataFrame(
+        {"cd": [10, 20, 40], "descr": ["mg", "microgram/hour", "patch"]}
+    ),
+}
+
+
+def element(tag, fields):
+    children = "".join(
+        f"<{name}>{value}</{name}>"
+        for name, value in fields.items()
+        if not pd.isna(value) and value != -1
+    )
+    return f"<{tag}>{children}</{tag}>"
+
+
+def records(df, tag, names):
+    rows = df.rename(columns={v: k for k, v in names.items()})[list(names)]
+    return "".join(element(tag, row) for row in rows.to_dict("records"))
+
+
+def write_xml_release(directory):
+    vmp = TABLES["vmp"]
+    files = {
+        "f_vmp2_3010.xml": "<VIRTUAL_MED_PRODUCTS>"
+        # unmatched elements, including one sharing a tag with a record
+        "<CONTROL_INFO><VMP>ignored</VMP></CONTROL_INFO>"
+        + "<VMPS>"
+        + records(vmp, "VMP", {"VPID": "id", "NM": "nm", "UDFS": "udfs"})
+        + "</VMPS><VIRTUAL_PRODUCT_INGREDIENT>"
+        + records(
+            TABLES["vpi"],
+            "VPI",
+            {
+                "VPID": "vmp",
+                "ISID": "ing",
+                "STRNT_NMRTR_VAL": "strnt_nmrtr_val",
+                "STRNT_NMRTR_UOMCD": "strnt_nmrtr_uom",
+                "STRNT_DNMTR_VAL": "strnt_dnmtr_val",
+                "STRNT_DNMTR_UOMCD": "strnt_dnmtr_uom",
+            },
+        )
+        + "</VIRTUAL_PRODUCT_INGREDIENT><ONT_DRUG_FORM>"
+        + records(TABLES["ont"], "ONT", {"VPID": "vmp", "FORMCD": "form"})
+        + "</ONT_DRUG_FORM></VIRTUAL_MED_PRODUCTS>",
+        "f_ingredient2_3010.xml": "<INGREDIENT_SUBSTANCES>"
+        + records(TABLES["ing"], "ING", {"ISID": "id", "NM": "nm"})
+        + "</INGREDIENT_SUBSTANCES>",
+        "f_lookup2_3010.xml": "<LOOKUP><UNIT_OF_MEASURE>"
+        + records(TABLES["unitofmeasure"], "INFO", {"CD": "cd", "DESC": "descr"})
+        + "</UNIT_OF_MEASURE><ONT_FORM_ROUTE>"
+        + records(TABLES["ontformroute"], "INFO", {"CD": "cd", "DESC": "descr"})
+        + "</ONT_FORM_ROUTE></LOOKUP>",
+        "f_bnf1_3010.xml": "<BNF_DETAILS><VMPS>"
+        + records(
+            vmp.dropna(subset=["bnf_code"]), "VMP", {"VPID": "id", "BNF": "bnf_code"}
+        )
+        + "</VMPS></BNF_DETAILS>",
+    }
+    for name, text in files.items():
+        (directory / name).write_text(f'<?xml version="1.0"?>{text}')
+
+
+def write_csv_release(directory):
+    for table, df in TABLES.items():
+        name = "vmp_full" if table == "vmp" else table
+        df.replace(-1, np.nan).to_csv(directory / f"{name}.csv", index=False)
+
+
+def plain(df):
+    """Return `df` with categorical (and string) columns as objects
+    """
+    return df.apply(
+        lambda column: column.astype(object).where(column.notna(), None)
+        if column.dtype.kind not in "iufb"
+        else column
+    )
+
+
+@pytest.mark.parametrize("write_release", [write_xml_release, write_csv_release])
+def test_round_trip(tmp_path, write_release):
+    release = tmp_path / "release"
+    release.mkdir()
+    write_release(release)
+    tables = load_release(str(release))
+    for table, df in TABLES.items():
+        pd.testing.assert_frame_equal(
+            plain(tables[table]), plain(df), check_dtype=False
+        )
+
+    write_snapshot(tables, str(tmp_path / "snapshot"), release="3010")
+    snapshot = DmdSnapshot(str(tmp_path / "snapshot"))
+    assert snapshot.meta["release"] == "3010"
+    keys = {"vmp": "id", "ing": "id", "ontformroute": "cd", "unitofmeasure": "cd"}
+    for table, df in snapshot.tables().items():
+        assert list(df.columns) == list(COLUMNS[table])
+        expected = tables[table]
+        if table in keys:
+            expected = expected.sort_values(keys[table], ignore_index=True)
+        pd.testing.assert_frame_equal(plain(df), plain(expected), check_dtype=False)
+
+    np.testing.assert_array_equal(snapshot.rows("vmp", [205, 111, 12]), [1, 0, -1])
+    vpi_ing = snapshot.join_index("vpi", "ing")
+    ing_ids = snapshot.frame("ing")["id"].to_numpy()
+    np.testing.assert_array_equal(ing_ids[vpi_ing], TABLES["vpi"]["ing"])
+    # a VPI whose VMP isn't in the release
+    assert snapshot.join_index("vpi", "vmp")[-1] == -1
@@ -0,0 +1,78 @@
+"""Fixed point sums don't depend on the order or chunking of the rows"""
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.exact_sum import (
+    FixedPointAccumulator,
+    exact_groupby_sum,
+    exact_sum,
+    from_fixed,
+    to_fixed,
+)
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    n = 10_000
+    return pd.DataFrame(
+        {
+            "month": rng.choice(["2020-01", "2020-02", "2020-03"], n),
+            "practice": rng.choice(["A", "B"], n),
+            "quantity": np.round(rng.lognormal(4, 1, n), 2),
+            "ome_dose": rng.lognormal(6, 2, n),
+        }
+    )
+
+
+def test_exact_sum_is_order_independent(df):
+    values = df["ome_dose"].to_numpy()
+    total = exact_sum(values)
+    shuffled = np.random.default_rng(1).permutation(values)
+    assert exact_sum(shuffled) == total
+    assert total == pytest.approx(math.fsum(values), abs=len(values) * 1e-6)
+
+
+def test_missing_values_count_as_zero():
+    assert exact_sum([1.5, np.nan, 2.25]) == 3.75
+    np.testing.assert_array_equal(from_fixed(to_fixed([0.1, np.nan])), [0.1, 0])
+
+
+def test_overflow_raises():
+    with pytest.raises(OverflowError):
+        to_fixed([3e12, 3e12])
+
+
+def test_groupby_sum_matches_fsum(df):
+    by = ["month", "practice"]
+    columns = ["quantity", "ome_dose"]
+    fixed = exact_groupby_sum(df, by, columns)
+    fsum = exact_groupby_sum(df, by, columns, method="fsum")
+    pd.testing.assert_frame_equal(fixed, fsum, rtol=0, atol=1e-2)
+    with pytest.raises(ValueError):
+        exact_groupby_sum(df, by, columns, method="kahan")
+
+
+def test_accumulators_merge_in_any_order(df):
+    by = ["month", "practice"]
+    columns = ["quantity", "ome_dose"]
+    workers = []
+    for start in range(0, len(df), 3000):
+        accumulator = FixedPointAccumulator(by, columns)
+        for chunk_start in range(start, min(start + 3000, len(df)), 700):
+            accumulator.add(df.iloc[chunk_start : min(chunk_start + 700, start + 3000)])
+        workers.append(accumulator)
+
+    results = []
+    for order in (workers, workers[::-1]):
+        merged = FixedPointAccumulator(by, columns)
+        for worker in order:
+            merged.merge(worker)
+        results.append(merged.result())
+    pd.testing.assert_frame_equal(results[0], results[1], rtol=0, atol=0)
+    pd.testing.assert_frame_equal(
+        results[0], exact_groupby_sum(df, by, columns).sort_index(), rtol=0, atol=0
+    )
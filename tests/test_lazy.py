@@ -0,0 +1,84 @@
+"""Lazy queries give the same results as the equivalent pandas, read a
+chunk at a time or not"""
+import pandas as pd
+import pytest
+
+from lib.lazy import col, from_frame, scan_csv
+
+PATH = "data/df_opioid_total_ome_old_class_dmd.csv"
+
+
+@pytest.fixture
+def df():
+    return pd.read_csv(PATH)
+
+
+@pytest.fixture(params=["csv", "frame"])
+def frame(request, df):
+    if request.param == "csv":
+        return scan_csv(PATH, chunksize=50)
+    return from_frame(df)
+
+
+QUERIES = {
+    "filter then top-n": (
+        lambda lf: lf.filter(col("bnf_code").startswith("0407020"))
+        .sort("ome_dose", ascending=False)
+        .head(10),
+        lambda df: df[df["bnf_code"].str.startswith("0407020")]
+        .sort_values("ome_dose", ascending=False, kind="mergesort")
+        .head(10),
+    ),
+    "top-n by two keys": (
+        lambda lf: lf.sort(["new_quantity", "bnf_code"], ascending=[True, False]).head(
+            7
+        ),
+        lambda df: df.sort_values(
+            ["new_quantity", "bnf_code"], ascending=[True, False], kind="mergesort"
+        ).head(7),
+    ),
+    "select, filter, limit": (
+        lambda lf: lf.select(["bnf_code", "ome_dose"])
+        .filter((col("ome_dose") > 1e6) & ~col("bnf_code").startswith("040701"))
+        .head(20),
+        lambda df: df.loc[
+            (df["ome_dose"] > 1e6) & ~df["bnf_code"].str.startswith("040701"),
+            ["bnf_code", "ome_dose"],
+        ].head(20),
+    ),
+    "limit then top-n": (
+        lambda lf: lf.head(100).sort("ome_dose").head(5),
+        lambda df: df.head(100).sort_values("ome_dose", kind="mergesort").head(5),
+    ),
+    "top-n of nothing": (
+        lambda lf: lf.filter(col("bnf_code") == "missing").sort("ome_dose").head(5),
+        lambda df: df[df["bnf_code"] == "missing"].head(0),
+    ),
+}
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_same_as_pandas(frame, df, query):
+    lazy, eager = QUERIES[query]
+    result = lazy(frame).collect()
+    expected = eager(df)
+    if len(expected):
+        pd.testing.assert_frame_equal(result, expected)
+    else:
+        assert len(result) == 0
+        assert list(result.columns) == list(expected.columns)
+
+
+def test_plan_is_optimised():
+    plan = (
+        scan_csv(PATH)
+        .select(["bnf_code", "ome_dose"])
+        .filter(col("ome_dose") > 0)
+        .sort("ome_dose")
+        .head(3)
+        .explain()
+        .splitlines()
+    )
+    assert plan[0].startswith("TopN 3")
+    assert "filter=ome_dose > 0" in plan[1]
+    assert "columns=['bnf_code', 'ome_dose']" in plan[1]
@@ -0,0 +1,170 @@
+"""The OME plan gives the same results run locally, as SQL, and as
+`lib.ome.compute_ome`
+"""
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from lib.ome import compute_ome, ingredient_factors
+from lib.ome_plan import _canonical, execute, ome_plan, to_sql
+
+FENTANYL = 373492002
+BUPRENORPHINE = 387173000
+CODEINE = 387494007
+PARACETAMOL = 387517004
+MORPHINE = 373529000
+
+
+@pytest.fixture
+def dmd():
+    """A few VMPs covering each special case: a fentanyl patch, a
+    buprenorphine 7 day patch, co-codamol (two ingredients, one opioid),
+    a morphine injection with two routes, a fentanyl buccal film, and an
+    excluded opiate dependence drug
+    """
+    return {
+        "unitofmeasure": pd.DataFrame(
+            {"cd": [1, 2, 3, 4, 5], "descr": ["mg", "microgram", "ml", "gram", "litre"]}
+        ),
+        "ing": pd.DataFrame(
+            {
+                "id": [FENTANYL, BUPRENORPHINE, CODEINE, PARACETAMOL, MORPHINE],
+                "nm": [
+                    "Fentanyl",
+                    "Buprenorphine",
+                    "Codeine",
+                    "Paracetamol",
+                    "Morphine",
+                ],
+            }
+        ),
+        "vmp": pd.DataFrame(
+            {
+                "id": [1, 2, 3, 4, 5, 6],
+                "bnf_code": [
+                    "0407020A0AAAHAH",
+                    "0407020B0AAAEAE",
+                    "0407010F0AAABAB",
+                    "0407020Q0AAAEAE",
+                    "0407020A0AAABAB",
+                    "0410030A0AAABAB",
+                ],
+                "udfs": [5, 4, 100, 2, 10, 1],
+            }
+        ),
+        "ont": pd.DataFrame(
+            {"vmp": [1, 2, 3, 4, 4, 5, 6], "form": [10, 10, 11, 12, 13, 14, 11]}
+        ),
+        "ontformroute": pd.DataFrame(
+            {
+                "cd": [10, 11, 12, 13, 14],
+                "descr": [
+                    "patch.transdermal",
+                    "capsule.oral",
+                    "solutioninjection.subcutaneous",
+                    "solutioninjection.intramuscular",
+                    "filmbuccal.buccal",
+                ],
+            }
+        ),
+        "vpi": pd.DataFrame(
+            {
+                "vmp": [1, 2, 3, 3, 4, 5, 6],
+                "ing": [
+                    FENTANYL,
+                    BUPRENORPHINE,
+                    CODEINE,
+                    PARACETAMOL,
+                    MORPHINE,
+                    FENTANYL,
+                    CODEINE,
+                ],
+                "strnt_nmrtr_val": [100, 10, 8, 500, 10, 200, 5],
+                "strnt_nmrtr_uom": [2, 2, 1, 1, 1, 2, 1],
+                "strnt_dnmtr_val": [None, None, None, None, 1, None, None],
+                "strnt_dnmtr_uom": [None, None, None, None, 3, None, None],
+            }
+        ),
+        "opioid_class": pd.DataFrame(
+            {
+                "id": [FENTANYL, FENTANYL, BUPRENORPHINE, CODEINE, MORPHINE],
+                "form": ["transdermal", "film", "transdermal", "oral", "injection"],
+                "ome": [100, 130, 75, 0.15, 2],
+            }
+        ),
+    }
+
+
+@pytest.fixture
+def prescribing():
+    """Generic and branded prescribing of the VMPs above, including a
+    presentation in the excluded 0410 chapter
+    """
+    return pd.DataFrame(
+        {
+            "month": ["2020-01-01"] * 6 + ["2020-02-01"] * 2,
+            "practice": ["A", "A", "B", "B", "A", "A", "A", "B"],
+            "pct": ["X"] * 8,
+            "bnf_code": [
+                "0407020A0AAAHAH",
+                "0407020A0BBAHAH",
+                "0407020B0AAAEAE",
+                "0407010F0AAABAB",
+                "0407020Q0AAAEAE",
+                "0410030A0AAABAB",
+                "0407010F0AAABAB",
+                "0407020A0AAABAB",
+            ],
+            "bnf_name": list("abcdefgh"),
+            "quantity": [10, 5, 4, 100, 3, 7, 50, 2],
+        }
+    )
+
+
+def run_sqlite(plan, sources):
+    connection = sqlite3.connect(":memory:")
+    try:
+        for name, df in sources.items():
+            df.to_sql(name, connection, index=False)
+        return pd.read_sql_query(to_sql(plan, dialect="sqlite"), connection)
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize(
+    "by,start,end",
+    [
+        (("month", "practice", "pct", "bnf_code", "bnf_name"), None, None),
+        (("month", "pct"), "2020-02-01", None),
+        (("practice",), None, "2020-01-01"),
+    ],
+)
+def test_executors_agree(dmd, prescribing, by, start, end):
+    plan = ome_plan(by=by, start=start, end=end)
+    sources = dict(dmd, prescribing=prescribing)
+    local = _canonical(execute(plan, sources))
+    sql = _canonical(run_sqlite(plan, sources))
+    pd.testing.assert_frame_equal(local, sql, check_dtype=False)
+
+    rx = prescribing
+    if start is not None:
+        rx = rx[rx["month"] >= start]
+    if end is not None:
+        rx = rx[rx["month"] <= end]
+    expected = compute_ome(rx, ingredient_factors(**dmd), by=by).rename(
+        columns={"ing": "ing_id"}
+    )
+    expected = _canonical(expected[list(local.columns)])
+    pd.testing.assert_frame_equal(local, expected, check_dtype=False)
+    assert len(local) > 0
+
+
+def test_excluded_and_special_cases(dmd, prescribing):
+    plan = ome_plan(by=("bnf_code",))
+    result = execute(plan, dict(dmd, prescribing=prescribing)).set_index("bnf_code")
+    assert "0410030A0AAABAB" not in result.index
+    # fentanyl patch: 100 micrograms/hour for 72 hours, x 100
+    assert result.loc["0407020A0AAAHAH", "ome_dose"] == pytest.approx(10 * 7.2 * 100)
+    # morphine injection: 10mg/ml in 2ml ampoules, counted once
+    assert result.loc["0407020Q0AAAEAE", "ome_dose"] == pytest.approx(3 * 20 * 2)
@@ -0,0 +1,83 @@
+"""What-if deltas match recomputing the measure, and changes that can't
+be priced are reported"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.ome_versions import WhatIf, diff_tables
+
+TABLE = pd.DataFrame(
+    {"id": [1, 1, 2], "form": ["oral", "injection", "oral"], "ome": [1.0, 3.0, 0.5]}
+)
+
+
+@pytest.fixture
+def mg_totals():
+    rng = np.random.default_rng(0)
+    practices = [f"P{i}" for i in range(20)]
+    pairs = [(1, "oral"), (1, "injection"), (2, "oral"), (3, "oral")]
+    rows = [
+        (practice, ing, form, rng.random() * 100)
+        for practice in practices
+        for ing, form in pairs
+        if rng.random() < 0.7
+    ]
+    return pd.DataFrame(rows, columns=["practice", "ing", "simple_form", "mg"])
+
+
+def measure(mg_totals, table):
+    multipliers = mg_totals.merge(
+        table, left_on=["ing", "simple_form"], right_on=["id", "form"], how="left"
+    )
+    ome = multipliers["mg"] * multipliers["ome"].fillna(0)
+    return ome.groupby(multipliers["practice"]).sum()
+
+
+def check(result, mg_totals, table):
+    expected = measure(mg_totals, table)
+    result = result.set_index("practice")
+    np.testing.assert_allclose(result["ome_proposed"], expected[result.index])
+    np.testing.assert_allclose(
+        result["ome_baseline"], measure(mg_totals, TABLE)[result.index]
+    )
+
+
+def test_delta_for_changed_multipliers(mg_totals):
+    what_if = WhatIf(mg_totals, TABLE)
+    result = what_if.delta({(1, "injection"): 4.0, 2: 1.0})
+    proposed = TABLE.assign(ome=[1.0, 4.0, 1.0])
+    check(result, mg_totals, proposed)
+
+
+def test_delta_for_proposed_table_with_new_pair(mg_totals):
+    # ingredient 3 isn't in the current table, but has mg totals
+    proposed = pd.concat(
+        [TABLE, pd.DataFrame({"id": [3], "form": ["oral"], "ome": [10.0]})],
+        ignore_index=True,
+    )
+    check(WhatIf(mg_totals, TABLE).delta(proposed), mg_totals, proposed)
+
+
+def test_warns_about_pairs_without_mg_totals(mg_totals):
+    what_if = WhatIf(mg_totals, TABLE)
+    proposed = pd.concat(
+        [TABLE, pd.DataFrame({"id": [4], "form": ["oral"], "ome": [2.0]})],
+        ignore_index=True,
+    )
+    with pytest.warns(UserWarning, match=r"\(4, 'oral'\)"):
+        result = what_if.delta(proposed)
+    assert (result["ome_delta"] == 0).all()
+    with pytest.warns(UserWarning, match="5"):
+        what_if.delta({5: 1.0})
+
+
+def test_diff_tables():
+    new = pd.DataFrame(
+        {"id": [1, 1, 3], "form": ["oral", "injection", "oral"], "ome": [1.0, 4.0, 1.0]}
+    )
+    diff = diff_tables(TABLE, new)
+    assert sorted(zip(diff["id"], diff["form"], diff["change"])) == [
+        (1, "injection", "changed"),
+        (2, "oral", "removed"),
+        (3, "oral", "added"),
+    ]
@@ -0,0 +1,64 @@
+"""Rows with quantities recorded in the wrong units are flagged, however
+the data is chunked"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.outliers import OutlierScreen, screen
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    n = 3000
+    codes = rng.choice(["0407020A0AAAHAH", "0407010F0AAABAB", "0407020Q0AAAEAE"], n)
+    items = rng.integers(1, 4, n)
+    quantity = items * rng.choice([28, 56, 60], n)
+    net_cost = quantity * np.where(codes == "0407010F0AAABAB", 0.02, 1.5)
+    df = pd.DataFrame(
+        {"bnf_code": codes, "items": items, "quantity": quantity, "net_cost": net_cost}
+    )
+    # doses recorded as packs of 8: 8x fewer units for the same cost
+    df.loc[[10, 500, 2000], "quantity"] //= 8
+    # a code with too few rows to judge, and rows without a code
+    df.loc[[20, 21], "bnf_code"] = "0407020Z0AAAAAA"
+    df.loc[[20], "quantity"] *= 100
+    df.loc[[30, 31], "bnf_code"] = None
+    return df
+
+
+def flagged(df, chunks):
+    outlier_screen = OutlierScreen()
+    for chunk in chunks:
+        outlier_screen.update(chunk)
+    return outlier_screen, outlier_screen.flag(df)
+
+
+def test_flags_unit_errors(df):
+    outlier_screen, result = flagged(df, [df])
+    assert list(result.index[result["outlier"]]) == [10, 500, 2000]
+    assert result.loc[[30, 31], "quantity_per_item_score"].isna().all()
+
+    stats = outlier_screen.statistics()
+    assert stats.loc["0407020Z0AAAAAA", "quantity_per_item_rows"] == 2
+    assert stats["quantity_per_item_rows"].sum() == len(df) - 2
+    median = stats.loc["0407010F0AAABAB", "cost_per_unit_median"]
+    assert median == pytest.approx(0.02, rel=0.05)
+
+
+def test_chunks_in_any_order(df):
+    chunks = [df.iloc[start : start + 400] for start in range(0, len(df), 400)]
+    _, forwards = flagged(df, chunks)
+    _, backwards = flagged(df, chunks[::-1])
+    _, whole = flagged(df, [df])
+    pd.testing.assert_frame_equal(forwards, whole)
+    pd.testing.assert_frame_equal(backwards, whole)
+
+
+def test_screen_yields_outliers(df):
+    def read_chunks():
+        for start in range(0, len(df), 1000):
+            yield df.iloc[start : start + 1000]
+
+    result = pd.concat(screen(read_chunks))
+    assert list(result.index) == [10, 500, 2000]
@@ -0,0 +1,52 @@
+"""Only the rows for the wanted BNF codes are converted, whatever the
+layout of the CSV"""
+import pytest
+
+from lib.columnar import read_table
+from lib.prescribing_csv import convert_file
+
+ORIGINAL = (
+    b" SHA,PCT,PRACTICE,BNF CODE,BNF NAME,ITEMS,NIC,ACT COST,QUANTITY,PERIOD\r\n"
+    b"Q1,00C,P1,0407010H0AAAMAM,Paracetamol 500mg tablets,2,1.5,1.4,56,201901\r\n"
+    b"Q1,00C,P1,0501013B0AAAAAA,Amoxicillin 250mg capsules,1,1.0,0.9,21,201901\r\n"
+    b"Q1,00C,P2,0407020A0AAAHAH,Co-codamol 30mg/500mg tablets,3,4.5,4.2,300,201901\r\n"
+    b"Q1,00C,P2,0204000H0AAAHAH,Propranolol 40mg (0407 strength),1,1,1,28,201901\r\n"
+)
+
+EPD = (
+    b"YEAR_MONTH,PRACTICE_NAME,PRACTICE_CODE,PCO_CODE,BNF_CODE,BNF_DESCRIPTION,"
+    b"ITEMS,QUANTITY,TOTAL_QUANTITY,NIC,ACTUAL_COST\n"
+    b'201902,"THE ""NEW"" SURGERY, HIGH ST",P1,00C,0407020A0AAAHAH,'
+    b'"Co-codamol 30mg/500mg ""effervescent"" tablets",2,32,64,3.0,2.8\n'
+    b'201902,"OLD SURGERY",P2,00C,0501013B0AAAAAA,Amoxicillin,1,21,21,1.0,0.9\n'
+    b'201902,"0407 SURGERY",P2,00C,0407010H0AAAMAM,Paracetamol,1,100,100,1.0,0.9\n'
+)
+
+
+def convert(tmp_path, name, contents, block_size=64):
+    path = tmp_path / f"{name}.csv"
+    path.write_bytes(contents)
+    rows = convert_file(str(path), str(tmp_path / "out"), block_size=block_size)
+    df = read_table(str(tmp_path / "out"))
+    assert len(df) == rows
+    return df.sort_values("bnf_code", ignore_index=True)
+
+
+@pytest.mark.parametrize("block_size", [16, 64, 1 << 20])
+def test_original_layout(tmp_path, block_size):
+    df = convert(tmp_path, "original", ORIGINAL, block_size)
+    assert list(df["bnf_code"]) == ["0407010H0AAAMAM", "0407020A0AAAHAH"]
+    assert list(df["practice"]) == ["P1", "P2"]
+    assert list(df["quantity"]) == [56, 300]
+    assert list(df["month"]) == ["2019-01-01", "2019-01-01"]
+
+
+@pytest.mark.parametrize("bom", [b"", b"\xef\xbb\xbf"])
+def test_epd_layout(tmp_path, bom):
+    df = convert(tmp_path, "epd", bom + EPD)
+    assert list(df["bnf_code"]) == ["0407010H0AAAMAM", "0407020A0AAAHAH"]
+    assert list(df["practice"]) == ["P2", "P1"]
+    # TOTAL_QUANTITY, not the quantity per item
+    assert list(df["quantity"]) == [100, 64]
+    assert df["bnf_name"][1] == 'Co-codamol 30mg/500mg "effervescent" tablets'
+    assert list(df["month"]) == ["2019-02-01", "2019-02-01"]
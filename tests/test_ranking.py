@@ -0,0 +1,60 @@
+"""Top-N selection gives the same rows as a stable sort and `head`"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.ranking import TopNTracker, top_n, top_n_by_group
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    n = 500
+    # few distinct values, so there are plenty of ties, and some missing
+    values = rng.integers(0, 20, n).astype(float)
+    values[rng.random(n) < 0.1] = np.nan
+    months = rng.choice(["2020-01", "2020-02", "2020-03", None], n, p=[0.3] * 3 + [0.1])
+    return pd.DataFrame(
+        {"month": months, "practice": [f"P{i}" for i in range(n)], "ome_dose": values,}
+    )
+
+
+def expected_top(df, n, largest):
+    return df.sort_values("ome_dose", ascending=not largest, kind="mergesort").head(n)
+
+
+@pytest.mark.parametrize("largest", [True, False])
+@pytest.mark.parametrize("n", [0, 1, 10, 460, 600])
+def test_top_n(df, n, largest):
+    pd.testing.assert_frame_equal(
+        top_n(df, "ome_dose", n, largest=largest), expected_top(df, n, largest)
+    )
+
+
+def expected_by_group(df, n, largest):
+    return (
+        df.dropna(subset=["month"])
+        .sort_values("ome_dose", ascending=not largest, kind="mergesort")
+        .groupby("month")
+        .head(n)
+        .sort_values("month", kind="mergesort")
+    )
+
+
+@pytest.mark.parametrize("largest", [True, False])
+def test_top_n_by_group(df, largest):
+    result = top_n_by_group(
+        df, "month", "ome_dose", 5, largest=largest, rank_col="rank"
+    )
+    expected = expected_by_group(df, 5, largest)
+    pd.testing.assert_frame_equal(result.drop(columns="rank"), expected)
+    assert list(result["rank"]) == [1, 2, 3, 4, 5] * 3
+
+
+def test_tracker_matches_ranking_everything(df):
+    tracker = TopNTracker(by="month", column="ome_dose", n=5)
+    for start in range(0, len(df), 100):
+        tracker.update(df.iloc[start : start + 100])
+    result = tracker.result().drop(columns="rank")
+    expected = expected_by_group(df, 5, True)
+    pd.testing.assert_frame_equal(result, expected)
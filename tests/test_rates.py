@@ -0,0 +1,86 @@
+"""Rates from the months x organisations arrays match a pandas merge"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib import rates
+from lib.rates import compute_rates, load_denominators
+
+
+@pytest.fixture
+def list_sizes():
+    rng = np.random.default_rng(0)
+    months = pd.date_range("2020-01-01", periods=6, freq="MS")
+    df = pd.DataFrame(
+        [
+            (month, f"P{i:02d}", f"C{i % 3}", rng.integers(1000, 20000))
+            for month in months
+            for i in range(30)
+        ],
+        columns=["month", "practice", "pct", "total_list_size"],
+    )
+    # a practice closing, and one with no list size
+    return df[~((df["practice"] == "P05") & (df["month"] >= months[3]))].assign(
+        total_list_size=lambda df: df["total_list_size"].where(
+            df["practice"] != "P07", 0
+        )
+    )
+
+
+@pytest.fixture
+def ome():
+    rng = np.random.default_rng(1)
+    n = 2000
+    return pd.DataFrame(
+        {
+            # months as strings, unlike the list sizes
+            "month": rng.choice(
+                pd.date_range("2020-01-01", periods=7, freq="MS").strftime("%Y-%m-%d"),
+                n,
+            ),
+            "practice": rng.choice([f"P{i:02d}" for i in range(32)], n),
+            "ome_dose": rng.random(n) * 100,
+        }
+    )
+
+
+def expected_rates(ome, list_sizes, org):
+    ome = ome.assign(month=pd.to_datetime(ome["month"]))
+    pct = list_sizes.drop_duplicates("practice").set_index("practice")["pct"]
+    ome = ome.assign(pct=ome["practice"].map(pct))
+    numerators = ome.groupby(["month", org])["ome_dose"].sum()
+    denominators = list_sizes.groupby(["month", org])["total_list_size"].sum()
+    df = denominators.to_frame().join(numerators, how="left").fillna(0).reset_index()
+    df = df[df["total_list_size"] > 0]
+    return pd.DataFrame(
+        {
+            "month": df["month"].dt.strftime("%Y-%m-%d"),
+            org: df[org],
+            "rate": df["ome_dose"] / df["total_list_size"] * 1000,
+        }
+    ).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("org", ["practice", "pct"])
+def test_rates_match_merge(ome, list_sizes, org):
+    denominators = load_denominators(list_sizes, org=org)
+    if org == "pct":
+        pct = list_sizes.drop_duplicates("practice").set_index("practice")["pct"]
+        ome = ome.assign(pct=ome["practice"].map(pct))
+    result = compute_rates(ome, denominators).to_frame(org=org)
+    expected = expected_rates(ome.drop(columns="pct", errors="ignore"), list_sizes, org)
+    pd.testing.assert_frame_equal(
+        result[["month", org, "rate"]], expected, check_dtype=False
+    )
+
+
+def test_denominators_are_cached(list_sizes, tmp_path, monkeypatch):
+    monkeypatch.setattr(rates, "_cache", {})
+    first = load_denominators(list_sizes, cache_dir=str(tmp_path))
+    assert load_denominators(list_sizes.copy(), cache_dir=str(tmp_path)) is first
+
+    monkeypatch.setattr(rates, "_cache", {})
+    loaded = load_denominators(list_sizes, cache_dir=str(tmp_path))
+    assert loaded is not first
+    np.testing.assert_array_equal(loaded.array, first.array)
+    np.testing.assert_array_equal(loaded.orgs.codes, first.orgs.codes)
@@ -0,0 +1,82 @@
+"""Spilled and in-memory grouped sums are the same"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.spill import SpillingAggregator
+
+BY = ["month", "practice", "ing", "generic"]
+
+
+@pytest.fixture
+def chunks():
+    rng = np.random.default_rng(0)
+    n = 4000
+    df = pd.DataFrame(
+        {
+            "month": rng.choice(["2020-01-01", "2020-02-01"], n),
+            "practice": pd.Categorical(rng.choice([f"P{i}" for i in range(100)], n)),
+            "ing": rng.integers(0, 10, n),
+            "generic": rng.random(n) < 0.5,
+            "quantity": rng.random(n),
+            "items": rng.integers(0, 5, n),
+        }
+    )
+    return [df.iloc[start : start + 1000] for start in range(0, n, 1000)]
+
+
+def aggregate(chunks, **kwargs):
+    aggregator = SpillingAggregator(BY, **kwargs)
+    for chunk in chunks:
+        aggregator.add(chunk)
+    return aggregator.spilled, aggregator.result()
+
+
+@pytest.mark.parametrize("memory_budget,partitions", [(40_000, 16), (20_000, 2)])
+def test_spilled_sums_match(chunks, tmp_path, memory_budget, partitions):
+    spilled, in_memory = aggregate(chunks)
+    assert not spilled
+    spilled, result = aggregate(
+        chunks, memory_budget=memory_budget, spill_dir=tmp_path, partitions=partitions
+    )
+    assert spilled
+    pd.testing.assert_frame_equal(result, in_memory)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_categories_differ_between_chunks(tmp_path):
+    # like the parts of a lib.columnar dataset, each chunk has its own
+    # categories
+    rng = np.random.default_rng(1)
+    chunks = []
+    for i in range(4):
+        practices = [f"P{i}{j:02d}" for j in range(100)]
+        chunks.append(
+            pd.DataFrame(
+                {
+                    "month": rng.choice(["2020-01-01", "2020-02-01"], 1000),
+                    "practice": pd.Categorical(rng.choice(practices, 1000)),
+                    "quantity": rng.random(1000),
+                }
+            )
+        )
+    by = ["month", "practice"]
+    expected = (
+        pd.concat(chunks)
+        .astype({"practice": str})
+        .groupby(by)
+        .sum()
+        .reset_index()
+        .sort_values(by, ignore_index=True)
+    )
+
+    for kwargs in ({}, {"memory_budget": 20_000, "spill_dir": tmp_path}):
+        aggregator = SpillingAggregator(by, partitions=2, **kwargs)
+        for chunk in chunks:
+            aggregator.add(chunk)
+        assert aggregator.spilled == bool(kwargs)
+        result = aggregator.result()
+        assert isinstance(result["practice"].dtype, pd.CategoricalDtype)
+        assert result["practice"].notna().all()
+        result = result.astype({"practice": str}).sort_values(by, ignore_index=True)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
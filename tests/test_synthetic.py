@@ -0,0 +1,40 @@
+"""Synthetic prescribing is reproducible, and each presentation's share of
+its quantity and OME is that in the extracts it's drawn from"""
+import numpy as np
+import pandas as pd
+
+from lib.synthetic import SyntheticPrescribing, load_presentations
+
+
+def test_blocks_are_reproducible():
+    first = SyntheticPrescribing(n_practices=50, n_months=3, seed=1)
+    second = SyntheticPrescribing(n_practices=50, n_months=3, seed=1)
+    pd.testing.assert_frame_equal(first.block(1, 20), second.block(1, 20))
+    other = SyntheticPrescribing(n_practices=50, n_months=3, seed=2)
+    assert not first.block(1, 20).equals(other.block(1, 20))
+
+
+def test_shares_match_extracts():
+    presentations = load_presentations()
+    synthetic = SyntheticPrescribing(
+        n_practices=2000, n_months=12, presentations=presentations
+    )
+    df = pd.concat(synthetic.blocks(), ignore_index=True)
+    assert not df.duplicated(["month", "practice", "bnf_code"]).any()
+    totals = (
+        df.groupby("bnf_code", observed=False)["quantity"]
+        .sum()
+        .reindex(presentations["bnf_code"])
+        .to_numpy()
+    )
+    expected = presentations["quantity"].to_numpy()
+    ome_per_unit = presentations["ome_per_unit"].fillna(0).to_numpy()
+    for result, real in (
+        (totals, expected),
+        (totals * ome_per_unit, expected * ome_per_unit),
+    ):
+        # the presentations making up most of the quantity, or the OME
+        top = np.argsort(real)[::-1][:10]
+        np.testing.assert_allclose(
+            result[top] / result.sum(), real[top] / real.sum(), rtol=0.1
+        )